@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Measure the cost of reading an input-only userdata key through a Remapper.
+
+The value is a large message-like object, read the way a state typically
+reads it: a nested field and a large array field, both through the read-only
+views a Remapper builds for input-only keys. This is compared against a
+Remapper with read-only views disabled (the trusted state opt-out) and
+against reading the UserData directly.
+
+Usage: const_read.py [N_POINTS] [N_READS]
+"""
+
+import sys
+import time
+
+import smach
+
+
+class Header(object):
+    def __init__(self):
+        self.seq = 0
+        self.stamp = 0.0
+        self.frame_id = 'map'
+
+
+class Point(object):
+    def __init__(self, x, y, z):
+        self.x = x
+        self.y = y
+        self.z = z
+
+
+class Cloud(object):
+    def __init__(self, n_points):
+        self.header = Header()
+        self.points = [Point(i, i, i) for i in range(n_points)]
+        self.data = bytes(bytearray(12 * n_points))
+
+
+def measure(ud, n_reads):
+    start = time.time()
+    for _ in range(n_reads):
+        ud.cloud.header.frame_id
+        ud.cloud.points
+        ud['cloud'].data
+    return (time.time() - start) / n_reads
+
+
+def main():
+    n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    n_reads = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    # Logging would dominate the measurement
+    smach.set_log_level(smach.log.ERROR)
+
+    ud = smach.UserData()
+    ud.cloud = Cloud(n_points)
+
+    direct = measure(ud, n_reads)
+    const = measure(smach.Remapper(ud, ['cloud'], []), n_reads)
+    trusted = measure(smach.Remapper(ud, ['cloud'], [], const_inputs=False), n_reads)
+
+    print("points: %d, reads: %d" % (n_points, n_reads))
+    print("userdata:           %8.3f us/read" % (direct * 1e6))
+    print("remapper:           %8.3f us/read" % (const * 1e6))
+    print("remapper (trusted): %8.3f us/read" % (trusted * 1e6))
+
+
+if __name__ == '__main__':
+    main()
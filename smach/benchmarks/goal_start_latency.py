@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Measure the latency between starting a large StateMachine and the
+execution of its first state.
+
+This is what an ActionServerWrapper pays for every goal it receives. The
+state machine is a chain of CBStates of which only the first one runs. The
+cached consistency check is compared against re-validating the whole graph on
+every execution.
+
+Usage: goal_start_latency.py [N_STATES] [N_GOALS]
+"""
+
+import sys
+import time
+
+import smach
+
+
+def build_chain(n_states):
+    """Build a chain of states of which the first one terminates."""
+    started = {'t': None}
+
+    def first(ud):
+        started['t'] = time.time()
+        return 'done'
+
+    sm = smach.StateMachine(['finished'])
+    with sm:
+        smach.StateMachine.add(
+            'S0', smach.CBState(first, outcomes=['next', 'done']),
+            transitions={'next': 'S1', 'done': 'finished'})
+        for i in range(1, n_states):
+            smach.StateMachine.add(
+                'S%d' % i,
+                smach.CBState(lambda ud: 'next', outcomes=['next']),
+                transitions={'next': 'S%d' % ((i + 1) % n_states)})
+    return sm, started
+
+
+def measure(n_states, n_goals, cached):
+    sm, started = build_chain(n_states)
+    latencies = []
+    for _ in range(n_goals):
+        if not cached:
+            # Forget that the graph has been validated before
+            sm._consistent_version = None
+        start = time.time()
+        outcome = sm.execute()
+        assert outcome == 'finished'
+        latencies.append(started['t'] - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2]
+
+
+def main():
+    n_states = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    n_goals = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    # Logging would dominate the measurement
+    smach.set_log_level(smach.log.ERROR)
+
+    uncached = measure(n_states, n_goals, cached=False)
+    cached = measure(n_states, n_goals, cached=True)
+
+    print("states: %d, goals: %d" % (n_states, n_goals))
+    print("re-validated: %8.3f ms median goal start latency" % (uncached * 1000.0))
+    print("cached:       %8.3f ms median goal start latency" % (cached * 1000.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Measure the number of state transitions per second a StateMachine makes.
+
+The state machine under test is a ring of CBStates that each return
+immediately, so the measured rate is dominated by the framework overhead of a
+single transition. The compiled dispatch table is compared against the
+interpreted path.
+
+Usage: transition_rate.py [N_STATES] [N_TRANSITIONS]
+"""
+
+import sys
+import time
+
+import smach
+
+
+def build_ring(n_states, n_transitions, compiled):
+    """Build a ring of states that terminates after n_transitions steps."""
+    counter = {'n': 0}
+
+    def step(ud):
+        counter['n'] += 1
+        if counter['n'] >= n_transitions:
+            return 'done'
+        return 'next'
+
+    sm = smach.StateMachine(['finished'], compiled=compiled)
+    with sm:
+        for i in range(n_states):
+            smach.StateMachine.add(
+                'S%d' % i,
+                smach.CBState(step, outcomes=['next', 'done']),
+                transitions={'next': 'S%d' % ((i + 1) % n_states),
+                             'done': 'finished'})
+    return sm, counter
+
+
+def measure(n_states, n_transitions, compiled):
+    sm, counter = build_ring(n_states, n_transitions, compiled)
+    start = time.time()
+    outcome = sm.execute()
+    elapsed = time.time() - start
+    assert outcome == 'finished'
+    return counter['n'] / elapsed
+
+
+def main():
+    n_states = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    n_transitions = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    # Logging would dominate the measurement
+    smach.set_log_level(smach.log.ERROR)
+
+    interpreted = measure(n_states, n_transitions, compiled=False)
+    compiled = measure(n_states, n_transitions, compiled=True)
+
+    print("states: %d, transitions: %d" % (n_states, n_transitions))
+    print("interpreted: %10.0f transitions/s" % interpreted)
+    print("compiled:    %10.0f transitions/s (%.2fx)" % (compiled, compiled / interpreted))
+
+
+if __name__ == '__main__':
+    main()
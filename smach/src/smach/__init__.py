@@ -24,15 +24,23 @@
 # CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 
+import sys
+
 # Define default logging macros
 
 ### Utilities
 from smach.log import\
         set_loggers,\
+        set_log_level,\
+        get_log_level,\
         loginfo,\
         logwarn,\
         logerr,\
-        logdebug
+        logdebug,\
+        LogSink,\
+        PrintSink,\
+        CallbackSink,\
+        AsyncLogSink
 
 from smach.exceptions import\
         InvalidTransitionError,\
@@ -42,8 +50,10 @@ from smach.exceptions import\
 
 ### Core classes
 from smach.state import State, CBState
-from smach.user_data import UserData, Remapper
+from smach.user_data import UserData, UserDataSnapshot, CompactUserData, UserDataLayout, Remapper
 from smach.container import Container
+from smach.executor import\
+        WorkerPool, get_default_executor, set_default_executor
 
 from smach.util import\
         handle_shutdown, set_shutdown_handler,\
@@ -55,4 +65,11 @@ from smach.state_machine import StateMachine
 from smach.sequence import Sequence
 from smach.concurrence import Concurrence
 from smach.iterator import Iterator
+from smach.buffer_items import BufferItems
+
 
+### asyncio execution (requires Python 3.7)
+if sys.version_info >= (3, 7):
+    from smach.asynchronous import\
+            AsyncState, AsyncStateMachine, AsyncConcurrence, AsyncIterator,\
+            execute_async, is_async_state
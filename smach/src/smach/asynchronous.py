@@ -0,0 +1,343 @@
+"""asyncio execution engine for SMACH.
+
+This module provides coroutine variants of the SMACH containers, which execute
+their children on an asyncio event loop instead of dedicated threads:
+ - L{AsyncState} is a state whose C{execute} method is a coroutine.
+ - L{AsyncStateMachine}, L{AsyncConcurrence} and L{AsyncIterator} are
+ containers whose C{execute} method is a coroutine.
+
+Synchronous states can be added to these containers as well; they are run on a
+thread of an executor, so that they do not block the event loop. Preempting an
+async state cancels the task running it.
+
+A state or container is run from synchronous code with::
+
+    outcome = asyncio.run(smach.execute_async(sm, userdata))
+
+This module requires Python 3.7 or newer.
+"""
+
+import asyncio
+import itertools
+import threading
+import traceback
+
+import smach
+
+__all__ = ['AsyncState', 'AsyncStateMachine', 'AsyncConcurrence', 'AsyncIterator',
+           'execute_async', 'is_async_state']
+
+
+def is_async_state(state):
+    """True if the C{execute} method of the state is a coroutine."""
+    return asyncio.iscoroutinefunction(state.execute)
+
+
+async def execute_async(state, userdata=None, executor=None):
+    """Execute a state from a coroutine.
+
+    An async state runs in its own task, which is cancelled if the state is
+    preempted. If the cancelled state does not catch the cancellation and
+    return an outcome itself, the outcome is 'preempted' (which the state has
+    to register). A synchronous state runs on a thread of the executor.
+
+    If the coroutine calling this is cancelled, the state is cancelled or
+    preempted as well.
+
+    @type state: L{State}
+    @param state: The state to execute.
+
+    @type userdata: L{UserData}
+    @param userdata: The userdata passed to the state.
+
+    @type executor: C{concurrent.futures.Executor}
+    @param executor: The executor that runs synchronous states, or None for
+    the default executor of the event loop.
+    """
+    if userdata is None:
+        userdata = smach.UserData()
+
+    if not is_async_state(state):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(executor, state.execute, userdata)
+        except asyncio.CancelledError:
+            state.request_preempt()
+            raise
+
+    task = asyncio.ensure_future(state.execute(userdata))
+    attach_task = getattr(state, '_attach_task', None)
+    if attach_task is not None:
+        attach_task(task)
+    try:
+        # Wait without propagating cancellation to the task, this way a task
+        # that was cancelled by a preempt can be told apart from a caller
+        # that was cancelled
+        await asyncio.wait([task])
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        if attach_task is not None:
+            attach_task(None)
+
+    if task.cancelled():
+        if 'preempted' not in state.get_registered_outcomes():
+            raise smach.InvalidStateError(
+                "State '%s' was cancelled, but it has no 'preempted' outcome." % state)
+        state.service_preempt()
+        return 'preempted'
+    return task.result()
+
+
+class AsyncState(smach.State):
+    """Base class for states that are executed as a coroutine.
+
+    Subclasses implement C{async def execute(self, ud)}. Async states can only
+    be executed in the containers of this module, or with L{execute_async}.
+
+    Preempting an async state cancels the task that runs C{execute}, so the
+    state is interrupted at the C{await} it is blocked in. It can catch
+    C{asyncio.CancelledError} to clean up and return an outcome, otherwise its
+    outcome is 'preempted'.
+    """
+
+    def __init__(self, outcomes=[], input_keys=[], output_keys=[], io_keys=[]):
+        smach.State.__init__(self, outcomes, input_keys, output_keys, io_keys)
+        self._task = None
+        self._task_loop = None
+        self._task_lock = threading.Lock()
+
+    async def execute(self, ud):
+        """Called when executing a state.
+        In the base class this raises a NotImplementedError.
+
+        @type ud: L{UserData} structure
+        @param ud: Userdata for the scope in which this state is executing
+        """
+        raise NotImplementedError()
+
+    def _attach_task(self, task):
+        # Called from the event loop running the task (Task.get_loop() would
+        # require Python 3.8)
+        with self._task_lock:
+            self._task = task
+            self._task_loop = asyncio.get_running_loop() if task is not None else None
+            # The state may have been preempted before it was started
+            if task is not None and self._preempt_requested:
+                task.cancel()
+
+    def request_preempt(self):
+        """Sets preempt_requested to True and cancels the running task.
+        This can be called from any thread."""
+        smach.State.request_preempt(self)
+        with self._task_lock:
+            if self._task is not None:
+                self._task_loop.call_soon_threadsafe(self._task.cancel)
+
+
+class AsyncStateMachine(smach.StateMachine):
+    """State machine executed as a coroutine.
+
+    This behaves like L{StateMachine}, but the states are awaited with
+    L{execute_async}.
+    """
+
+    def __init__(self, outcomes, input_keys=None, output_keys=None, compiled=True, executor=None):
+        """Constructor.
+
+        @type executor: C{concurrent.futures.Executor}
+        @param executor: The executor that runs synchronous states, or None
+        for the default executor of the event loop.
+        """
+        smach.StateMachine.__init__(self, outcomes, input_keys, output_keys, compiled)
+        self._executor = executor
+
+    async def execute(self, parent_ud=smach.UserData()):
+        """Run the state machine on entry to this state."""
+        with self._state_transitioning_lock:
+            if not self._start_execution(parent_ud):
+                return None
+
+            # Initialize container outcome
+            container_outcome = None
+
+            try:
+                # Step through state machine
+                while container_outcome is None and self._is_running and not smach.is_shutdown():
+                    self._prepare_update()
+                    outcome = await self._execute_current_state_async()
+                    container_outcome = self._transition(outcome)
+            except asyncio.CancelledError:
+                self._is_running = False
+                raise
+
+            self._finish_execution(parent_ud)
+
+        return container_outcome
+
+    async def _execute_current_state_async(self):
+        """Await the current state with the transitioning lock released."""
+        try:
+            self._state_transitioning_lock.release()
+            outcome = await execute_async(self._current_state, self._current_remapper(), self._executor)
+            self._current_outcome = outcome
+        except asyncio.CancelledError:
+            raise
+        except smach.InvalidUserCodeError as ex:
+            smach.logerr("State '%s' failed to execute.", self._current_label)
+            raise ex
+        except Exception:
+            raise smach.InvalidUserCodeError("Could not execute state '%s' of type '%s': " %
+                                             (self._current_label, self._current_state)
+                                             + traceback.format_exc())
+        finally:
+            self._state_transitioning_lock.acquire()
+        return outcome
+
+
+class AsyncConcurrence(smach.Concurrence):
+    """Concurrence executed as a coroutine.
+
+    This behaves like L{Concurrence}, but each child runs in its own task on
+    the event loop. The C{executor} argument of the constructor, if given,
+    must be a C{concurrent.futures.Executor}; it runs the synchronous
+    children.
+    """
+
+    def __init__(self, *args, **kwargs):
+        smach.Concurrence.__init__(self, *args, **kwargs)
+        self._done_event = None
+        self._done_loop = None
+
+    async def execute(self, parent_ud=smach.UserData()):
+        """Run all child states concurrently."""
+        self._done_loop = asyncio.get_running_loop()
+        self._done_event = asyncio.Event()
+
+        self._start_execution(parent_ud)
+
+        tasks = []
+        for label in self._states:
+            task = asyncio.ensure_future(self._run_child(label))
+            self._tasks[label] = task
+            tasks.append(task)
+
+        try:
+            # Wait for a child to request termination
+            await self._done_event.wait()
+
+            # Preempt any running states
+            self._preempt_running_children()
+
+            # Wait for all states to terminate
+            await asyncio.wait(tasks)
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            self._tasks = {}
+            self._done_event = None
+            self._done_loop = None
+
+        return self._finish_execution(parent_ud)
+
+    async def _run_child(self, label):
+        self.call_transition_cbs()
+        try:
+            self._child_outcomes[label] = await execute_async(
+                self._states[label], self._get_remapper(label), self._executor)
+            done = self._child_terminated(label)
+        except Exception as e:
+            smach.logerr("Could not execute child state '%s': %s", label, traceback.format_exc())
+            self._user_code_exception = True
+            self._child_exceptions[label] = e
+            done = True
+        if done:
+            self._done_event.set()
+
+    def request_preempt(self):
+        """Preempt all contained states.
+        This can be called from any thread."""
+        smach.State.request_preempt(self)
+        (loop, event) = (self._done_loop, self._done_event)
+        if event is not None:
+            loop.call_soon_threadsafe(event.set)
+
+
+class AsyncIterator(smach.Iterator):
+    """Iterator executed as a coroutine.
+
+    This behaves like L{Iterator}, but the contained state is awaited with
+    L{execute_async}. Unlike L{Iterator}, preempting this container also
+    preempts the contained state. Items are processed one at a time: the
+    parallel map mode of L{Iterator} is not supported.
+    """
+
+    def __init__(self, *args, executor=None, **kwargs):
+        """Constructor.
+
+        @type executor: C{concurrent.futures.Executor}
+        @param executor: The executor that runs a synchronous contained
+        state, or None for the default executor of the event loop.
+        """
+        smach.Iterator.__init__(self, *args, **kwargs)
+        if self._max_concurrency > 1:
+            raise ValueError("AsyncIterator processes one item at a time, it does not support a max_concurrency of %d." % self._max_concurrency)
+        self._executor = executor
+
+    async def execute(self, parent_ud=smach.UserData()):
+        it = self._start_execution(parent_ud)
+
+        # Iterate over items
+        outcome = self._exhausted_outcome
+        results = []
+        accumulator = self._start_reduction()
+
+        for index in itertools.count():
+            if smach.is_shutdown():
+                break
+            try:
+                item = next(it)
+            except StopIteration:
+                outcome = self._exhausted_outcome
+                break
+            smach.logdebug("Iterator '%s' entering item %d", self._state_label, index)
+            self.userdata[self._items_label] = item
+            self._clear_item_result()
+            # Enter the contained state
+            try:
+                outcome = await execute_async(self._state, self.userdata, self._executor)
+            except asyncio.CancelledError:
+                self._is_running = False
+                raise
+            except smach.InvalidUserCodeError as ex:
+                smach.logerr("Could not execute Iterator state '%s'", self._state_label)
+                raise ex
+            except Exception:
+                raise smach.InvalidUserCodeError("Could not execute iterator state '%s' of type '%s': " % (self._state_label, self._state) + traceback.format_exc())
+
+            if self._result_key is not None or self._reduce_cb is not None:
+                result = self._get_item_result(self.userdata, outcome)
+                if self._result_key is not None:
+                    results.append(result)
+                if self._reduce_cb is not None:
+                    accumulator = self._reduce(accumulator, result)
+
+            final_outcome = self._check_iteration_outcome(outcome)
+            if final_outcome is not None:
+                outcome = final_outcome
+                break
+
+        if self._result_key is not None:
+            self.userdata[self._result_key] = results
+        if self._reduce_cb is not None:
+            self.userdata[self._accumulator_key] = accumulator
+
+        return self._finish_execution(parent_ud, outcome)
+
+    def request_preempt(self):
+        smach.Iterator.request_preempt(self)
+        if self._is_running:
+            self._state.request_preempt()
@@ -0,0 +1,182 @@
+import mmap
+
+import smach
+
+__all__ = ['BufferItems']
+
+
+class BufferItems(object):
+    """Items stored back to back in a buffer, for L{Iterator}.
+
+    The items are handed out as views into the buffer, so iterating over a
+    large dataset does not copy it or hold it in Python objects. The buffer
+    can be any object supporting the buffer protocol, such as C{bytes},
+    C{bytearray}, C{mmap.mmap} or a NumPy array. L{from_file} memory-maps a
+    file read-only.
+
+    With a NumPy C{dtype}, the buffer is viewed as a NumPy array of that type
+    and each item is an element of the array: a row of a structured array,
+    or a sub-array view for sub-array types. Without NumPy, each item is a
+    C{memoryview} of C{item_size} bytes, optionally cast to a C{struct}
+    format. Slicing gives views of several items, so L{Iterator} batches of
+    these items are views as well.
+
+    Pages of memory-mapped files are loaded from disk when they are first
+    read. To keep the contained state from waiting on the disk, the pages of
+    the next C{prefetch} items are read ahead on the default executor while
+    the current items are processed.
+    """
+
+    def __init__(self, source, dtype=None, item_size=None, item_format=None,
+                 offset=0, count=None, prefetch=0):
+        """Constructor.
+
+        @type source: buffer
+        @param source: The buffer holding the items.
+
+        @type dtype: C{numpy.dtype}
+        @param dtype: The NumPy type of the items. NumPy arrays given as the
+        source are used as they are if this is None.
+
+        @type item_size: int
+        @param item_size: The size of an item in bytes, if no dtype is given.
+
+        @type item_format: string
+        @param item_format: A C{struct} format the memoryview of each item is
+        cast to, if no dtype is given (Python 3 only).
+
+        @type offset: int
+        @param offset: The offset of the first item in the buffer, in bytes.
+        For NumPy arrays given without a dtype, this must be a multiple of
+        the size of an item (a row of the array).
+
+        @type count: int
+        @param count: The number of items, or None for as many items as the
+        buffer holds.
+
+        @type prefetch: int
+        @param prefetch: The number of items read ahead during iteration, or 0
+        to disable reading ahead.
+        """
+        self._file = None
+        self._source = source
+        self._prefetch = prefetch
+        self._item_format = None
+
+        self._array = None
+        if dtype is not None or _is_ndarray(source):
+            import numpy
+            if dtype is not None:
+                self._array = numpy.frombuffer(source, dtype=dtype, offset=offset,
+                                               count=-1 if count is None else count)
+            else:
+                row_size = source.itemsize * int(numpy.prod(source.shape[1:]))
+                if offset % row_size:
+                    raise ValueError("BufferItems offset of %d bytes is not a multiple of the %d byte rows of the array." % (
+                        offset, row_size))
+                self._array = source[offset // row_size:] if offset else source
+                if count is not None:
+                    self._array = self._array[:count]
+            self._item_size = self._array.itemsize * int(numpy.prod(self._array.shape[1:]))
+            # Pages are only read ahead for contiguous arrays
+            self._raw = None
+            if self._array.flags.c_contiguous:
+                self._raw = memoryview(self._array.view(numpy.uint8).reshape(-1))
+            self._offset = 0
+            self._count = len(self._array)
+        else:
+            if item_size is None:
+                raise ValueError("BufferItems requires a dtype or an item size.")
+            self._item_size = item_size
+            self._item_format = item_format
+            self._raw = memoryview(source)
+            if self._raw.ndim != 1 or self._raw.format != 'B':
+                self._raw = self._raw.cast('B')
+            self._offset = offset
+            self._count = (len(self._raw) - offset) // item_size if count is None else count
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """Get the items stored in a file, which is memory-mapped read-only.
+        The keyword arguments are those of the constructor.
+
+        @type path: string
+        @param path: The path of the file.
+
+        @rtype: L{BufferItems}
+        """
+        f = open(path, 'rb')
+        try:
+            source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            items = cls(source, **kwargs)
+        except:
+            f.close()
+            raise
+        items._file = f
+        return items
+
+    def close(self):
+        """Close the file the items were memory-mapped from, if any.
+
+        If views of the items are still referenced elsewhere, the memory map
+        stays valid until they are released.
+        """
+        if self._file is not None:
+            self._array = None
+            self._raw = None
+            try:
+                self._source.close()
+            except BufferError:
+                pass
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if self._array is not None:
+            return self._array[index]
+        if isinstance(index, slice):
+            (start, stop, step) = index.indices(self._count)
+            if step != 1:
+                raise ValueError("BufferItems only support contiguous slices.")
+            return self._view(start, max(start, stop))
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("BufferItems index out of range.")
+        return self._view(index, index + 1)
+
+    def _view(self, start, stop):
+        view = self._raw[self._offset + start * self._item_size:self._offset + stop * self._item_size]
+        if self._item_format is not None:
+            view = view.cast(self._item_format)
+        return view
+
+    def __iter__(self):
+        window = self._prefetch if self._raw is not None else 0
+        next_prefetch = 0
+        for index in range(self._count):
+            if window and index >= next_prefetch:
+                # Read the next window ahead while this one is processed
+                next_prefetch = index + window
+                smach.get_default_executor().submit(
+                    _touch_pages, self._raw, self._offset + index * self._item_size,
+                    self._offset + min(self._count, index + 2 * window) * self._item_size)
+            yield self[index]
+
+
+def _is_ndarray(obj):
+    return type(obj).__module__.split('.')[0] == 'numpy' and hasattr(obj, 'dtype')
+
+
+# Read one byte per page to fault the pages of a memory map in
+_PAGE_SIZE = mmap.PAGESIZE
+
+
+def _touch_pages(view, start, stop):
+    try:
+        view[start:stop:_PAGE_SIZE].tobytes()
+    except (NotImplementedError, TypeError, ValueError):
+        view[start:stop].tobytes()
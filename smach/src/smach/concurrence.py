@@ -52,7 +52,9 @@ class Concurrence(smach.container.Container):
                  output_keys=None,
                  outcome_map=None,
                  outcome_cb=None,
-                 child_termination_cb=None
+                 child_termination_cb=None,
+                 executor=None,
+                 preempt_when_decided=True
                  ):
         """Constructor for smach Concurrent Split.
 
@@ -93,6 +95,11 @@ class Concurrence(smach.container.Container):
         If a more complex outcome policy is required, see the user can
         provide an outcome callback. See outcome_cb, below.
 
+        The outcome map is evaluated each time a child terminates. Once the
+        outcome of the container no longer depends on the children that are
+        still running, these children are preempted (see
+        preempt_when_decided, below).
+
         @type child_termination_cb: callable
         @param child_termination_cb: This callback gives the user the ability
         to force the concurrence to preempt running states given the
@@ -131,6 +138,21 @@ class Concurrence(smach.container.Container):
         B{NOTE: This callback should be a function ONLY of the outcomes of
         the child states. It should not access any other resources.} 
 
+        @type preempt_when_decided: bool
+        @param preempt_when_decided: If True (the default), the running
+        children are preempted as soon as the outcome map decides the outcome
+        of the container, i.e. as soon as each entry of the outcome map is
+        either satisfied or violated by the children that have terminated.
+        This is not done if an outcome_cb is given, since that callback is
+        passed the outcomes of all children.
+
+        @type executor: L{WorkerPool}
+        @param executor: The executor that runs the child states. This can be
+        any object with a C{submit(fn, *args)} method returning a future-like
+        object. If None, the process-wide executor returned by
+        L{smach.get_default_executor} is used, which reuses its worker threads
+        across executions.
+
         """
         if input_keys is None:
             input_keys = []
@@ -142,7 +164,7 @@ class Concurrence(smach.container.Container):
 
         # List of concurrent states
         self._states = {}
-        self._threads = {}
+        self._tasks = {}
         self._remappings = {}
 
         if not (default_outcome or outcome_map or outcome_cb):
@@ -179,9 +201,21 @@ class Concurrence(smach.container.Container):
         self._outcome_map = outcome_map
         self._outcome_cb = outcome_cb
         self._child_termination_cb = child_termination_cb
+        self._preempt_when_decided = preempt_when_decided and bool(outcome_map) and not outcome_cb
+        self._executor = executor
         self._child_outcomes = {}
         self._child_exceptions = {}
 
+        # Compile the outcome map into the criteria each child takes part in
+        self._outcome_criteria = {}
+        self._outcome_map_sizes = []
+        for (i, outcomes) in enumerate(self._outcome_map.values()):
+            self._outcome_map_sizes.append(len(outcomes))
+            for (label, outcome) in ((k, outcomes[k]) for k in outcomes):
+                self._outcome_criteria.setdefault(label, []).append((i, outcome))
+        self._unmet_criteria = []
+        self._undecided_maps = 0
+
         # Condition variables for threading synchronization
         self._user_code_exception = False
         self._done_cond = threading.Condition()
@@ -201,17 +235,46 @@ class Concurrence(smach.container.Container):
         # Store state
         self._states[label] = state
         self._remappings[label] = remapping
+        self._mark_structure_changed()
 
         return state
 
     ### State interface
     def execute(self, parent_ud=smach.UserData()):
         """Overridden execute method.
-        This starts all the threads.
+        This runs all the child states on the executor.
         """
         # Clear the ready event
         self._ready_event.clear()
 
+        self._start_execution(parent_ud)
+
+        # Submit the child states, they block until the ready event is set
+        executor = self._executor or smach.get_default_executor()
+        for label in self._states:
+            self._tasks[label] = executor.submit(self._state_runner, label)
+
+        # Wait for done notification
+        self._done_cond.acquire()
+
+        # Notify all threads ready to go
+        self._ready_event.set()
+
+        # Wait for a done notification from a thread
+        self._done_cond.wait()
+        self._done_cond.release()
+
+        # Preempt any running states
+        self._preempt_running_children()
+
+        # Wait for all states to terminate
+        [t.exception() for t in self._tasks.values()]
+        self._tasks = {}
+
+        return self._finish_execution(parent_ud)
+
+    def _start_execution(self, parent_ud):
+        """Reset the child outcomes and enter the container."""
         # Reset child outcomes
         self._child_outcomes = {}
 
@@ -219,44 +282,33 @@ class Concurrence(smach.container.Container):
         self._copy_input_keys(parent_ud, self.userdata)
 
         # Spew some info
-        smach.loginfo("Concurrence starting with userdata: \n\t%s" %
-                      (str(list(self.userdata.keys()))))
+        smach.loginfo("Concurrence starting with userdata: \n\t%s", self.userdata.keys())
 
         # Call start callbacks
         self.call_start_cbs()
 
-        # Create all the threads
-        for (label, state) in ((k, self._states[k]) for k in self._states):
-            # Initialize child outcomes
+        # Initialize child outcomes
+        for label in self._states:
             self._child_outcomes[label] = None
-            self._threads[label] = threading.Thread(
-                name='concurrent_split:' + label,
-                target=self._state_runner,
-                args=(label,))
-
-        # Launch threads
-        for thread in self._threads.values():
-            thread.start()
 
-        # Wait for done notification
-        self._done_cond.acquire()
-
-        # Notify all threads ready to go
-        self._ready_event.set()
+        # Reset the outcome map evaluation, an entry is undecided while it
+        # still has unmet criteria and none of them has been violated
+        self._unmet_criteria = list(self._outcome_map_sizes)
+        self._undecided_maps = sum(1 for n in self._unmet_criteria if n > 0)
 
-        # Wait for a done notification from a thread
-        self._done_cond.wait()
-        self._done_cond.release()
-
-        # Preempt any running states
+    def _preempt_running_children(self):
         smach.logdebug("SMACH Concurrence preempting running states.")
         for label in self._states:
             if self._child_outcomes[label] is None:
                 self._states[label].request_preempt()
 
-        # Wait for all states to terminate
-        [t.join() for t in self._threads.values()]
+    def _finish_execution(self, parent_ud):
+        """Determine the outcome once all children have terminated and leave
+        the container.
 
+        @rtype: string
+        @return: The outcome of the container.
+        """
         # Check for user code exception
         if self._user_code_exception:
             self._user_code_exception = False
@@ -276,20 +328,20 @@ class Concurrence(smach.container.Container):
                     # Reset the flag
                     children_preempts_serviced = False
                     # Complain
-                    smach.logwarn("State '%s' in concurrence did not service preempt." % label)
+                    smach.logwarn("State '%s' in concurrence did not service preempt.", label)
                     # Recall the preempt if it hasn't been serviced
                     state.recall_preempt()
                 elif self._child_outcomes[label] != "preempted":
                     smach.logwarn(
-                        "State '%s' already had outcome '%s' despite concurrent container is in preemption. Setting outcome to 'preempted'" % (
-                        label, self._child_outcomes[label]))
+                        "State '%s' already had outcome '%s' despite concurrent container is in preemption. Setting outcome to 'preempted'",
+                        label, self._child_outcomes[label])
                     self._child_outcomes[label] = "preempted"
             if children_preempts_serviced:
                 smach.loginfo("Concurrence serviced preempt.")
                 self.service_preempt()
 
         # Spew some debyg info
-        smach.loginfo("Concurrent Outcomes: " + str(self._child_outcomes))
+        smach.loginfo("Concurrent Outcomes: %s", self._child_outcomes)
 
         # Initialize the outcome
         outcome = self._default_outcome
@@ -309,16 +361,15 @@ class Concurrence(smach.container.Container):
                     if cb_outcome == str(cb_outcome):
                         outcome = cb_outcome
                     else:
-                        smach.logerr("Outcome callback returned a non-string '%s', using default outcome '%s'" % (
-                        str(cb_outcome), self._default_outcome))
+                        smach.logerr("Outcome callback returned a non-string '%s', using default outcome '%s'",
+                                     cb_outcome, self._default_outcome)
                 else:
-                    smach.logwarn("Outcome callback returned None, using outcome '%s'" % outcome)
+                    smach.logwarn("Outcome callback returned None, using outcome '%s'", outcome)
             except:
                 raise smach.InvalidUserCodeError(
                     ("Could not execute outcome callback '%s': " % self._outcome_cb) + traceback.format_exc())
 
         # Cleanup
-        self._threads = {}
         self._child_outcomes = {}
 
         # Call termination callbacks
@@ -339,7 +390,7 @@ class Concurrence(smach.container.Container):
             self._done_cond.notify_all()
 
     def _state_runner(self, label):
-        """Runs the states in parallel threads."""
+        """Runs a child state on a worker thread of the executor."""
 
         # Wait until all threads are ready to start before beginnging
         self._ready_event.wait()
@@ -348,11 +399,7 @@ class Concurrence(smach.container.Container):
 
         # Execute child state
         try:
-            self._child_outcomes[label] = self._states[label].execute(smach.Remapper(
-                self.userdata,
-                self._states[label].get_registered_input_keys(),
-                self._states[label].get_registered_output_keys(),
-                self._remappings[label]))
+            self._child_outcomes[label] = self._states[label].execute(self._get_remapper(label))
         except Exception as e:
             self._user_code_exception = True
             self._child_exceptions[label] = e
@@ -360,30 +407,67 @@ class Concurrence(smach.container.Container):
                 self._done_cond.notify_all()
             raise smach.InvalidStateError(("Could not execute child state '%s': " % label) + traceback.format_exc())
 
+        # Check if all of the states have completed
+        with self._done_cond:
+            # Notify the container to terminate (and preempt other states if neceesary)
+            if self._child_terminated(label):
+                self._done_cond.notify_all()
+
+    def _child_terminated(self, label):
+        """Process the outcome of a child that terminated.
+        This must be called with the done condition held.
+
+        @rtype: bool
+        @return: True if the container should preempt the other children and
+        terminate.
+        """
         # Make sure the child returned an outcome
         if not self._shutdown_requested and self._child_outcomes[label] is None:
             raise smach.InvalidStateError("Concurrent state '%s' returned no outcome on termination." % label)
         else:
             smach.loginfo(
-                "Concurrent state '%s' returned outcome '%s' on termination." % (label, self._child_outcomes[label]))
+                "Concurrent state '%s' returned outcome '%s' on termination.", label, self._child_outcomes[label])
 
-        # Check if all of the states have completed
-        with self._done_cond:
-            # initialize preemption flag
-            preempt_others = False
-            # Call transition cb's
-            self.call_transition_cbs()
-            # Call child termination cb if it's defined
-            if self._child_termination_cb:
-                try:
-                    preempt_others = self._child_termination_cb(self._child_outcomes)
-                except:
-                    raise smach.InvalidUserCodeError(
-                        "Could not execute child termination callback: " + traceback.format_exc())
+        # initialize preemption flag
+        preempt_others = False
+        # Call transition cb's
+        self.call_transition_cbs()
+        # Call child termination cb if it's defined
+        if self._child_termination_cb:
+            try:
+                preempt_others = self._child_termination_cb(self._child_outcomes)
+            except:
+                raise smach.InvalidUserCodeError(
+                    "Could not execute child termination callback: " + traceback.format_exc())
 
-            # Notify the container to terminate (and preempt other states if neceesary)
-            if preempt_others or all([o is not None for o in self._child_outcomes.values()]):
-                self._done_cond.notify_all()
+        # Update the outcome map evaluation
+        if self._preempt_when_decided and self._evaluate_outcome_criteria(label):
+            smach.logdebug("Outcome of concurrence decided by state '%s'.", label)
+            preempt_others = True
+
+        return bool(preempt_others) or all([o is not None for o in self._child_outcomes.values()])
+
+    def _evaluate_outcome_criteria(self, label):
+        """Account for the outcome of a terminated child in the outcome map.
+        This must be called with the done condition held.
+
+        @rtype: bool
+        @return: True if the outcome map is decided, i.e. no entry of the map
+        depends on a child that is still running.
+        """
+        outcome = self._child_outcomes[label]
+        for (i, expected) in self._outcome_criteria.get(label, ()):
+            if self._unmet_criteria[i] <= 0:
+                # Already satisfied or violated
+                continue
+            if outcome == expected:
+                self._unmet_criteria[i] -= 1
+            else:
+                # Mark as violated
+                self._unmet_criteria[i] = -1
+            if self._unmet_criteria[i] <= 0:
+                self._undecided_maps -= 1
+        return self._undecided_maps == 0
 
     ### Container interface
     def get_children(self):
@@ -44,6 +44,19 @@ class Container(smach.state.State):
         self.userdata = smach.UserData()
         """Userdata to be passed to child states."""
 
+        # Userdata remappings and cached remappers of the children, keyed on
+        # child label
+        self._remappings = {}
+        self._remappers = {}
+        self._chained_userdata = False
+        self._compact_userdata = False
+
+        # Version of the structure of this container, incremented whenever
+        # children, transitions, outcomes or initial states change, and the
+        # version that last passed the consistency check
+        self._structure_version = 0
+        self._consistent_version = None
+
         # Callback lists
         self._start_cbs = []
         self._transition_cbs = []
@@ -105,15 +118,141 @@ class Container(smach.state.State):
         """Check consistency of this container."""
         raise NotImplementedError()
 
+    def _mark_structure_changed(self):
+        """Invalidate everything that was derived from the structure of this
+        container, including the result of the last consistency check."""
+        self._structure_version += 1
+        self._remappers = {}
+
+    def _check_consistency_cached(self):
+        """Check consistency of this container, unless its structure did not
+        change since it last passed the check."""
+        if self._consistent_version != self._structure_version:
+            self.check_consistency()
+            self._consistent_version = self._structure_version
+
+    def register_outcomes(self, new_outcomes):
+        """Add outcomes to the outcome set."""
+        smach.state.State.register_outcomes(self, new_outcomes)
+        self._mark_structure_changed()
+
     ### Automatic Data passing
+    def _get_remapper(self, label):
+        """Get the remapper through which a child accesses this container's
+        userdata.
+
+        Remappers are built once per child when the container is closed and
+        reused for every execution. They are rebuilt if the container's
+        userdata structure has been replaced or the child registered more
+        keys.
+        """
+        remapper = self._remappers.get(label)
+        state = self.get_children()[label]
+        if not self._is_remapper_valid(remapper, state):
+            remapper = smach.Remapper(
+                self.userdata,
+                state.get_registered_input_keys(),
+                state.get_registered_output_keys(),
+                self._remappings.get(label),
+                state.const_inputs)
+            remapper._keys_version = state._keys_version
+            self._remappers[label] = remapper
+        return remapper
+
+    def _is_remapper_valid(self, remapper, state):
+        """Check whether a cached remapper of a child is still up to date."""
+        return (remapper is not None and remapper._ud is self.userdata
+                and remapper._keys_version == state._keys_version)
+
+    def _build_remappers(self):
+        """Build the remappers of all children."""
+        if self._compact_userdata:
+            self._layout_userdata()
+        self._remappers = {}
+        for label in self._remappings:
+            self._get_remapper(label)
+
+    def set_chained_userdata(self, enabled=True, recursive=True):
+        """Enable or disable chained userdata scopes.
+
+        By default, a container copies the values of its input keys from the
+        enclosing scope into its userdata when it is entered. With chained
+        scopes, its userdata reads input keys from the enclosing scope by
+        reference instead, until they are written in this container, so
+        entering the container takes constant time whatever the number and
+        size of the values. Output keys are stored back in the enclosing
+        scope by reference either way, and remappings apply as before.
+
+        Unlike copied keys, input keys that are not written in this container
+        do not appear in snapshots of its userdata, and reading them returns
+        the current value in the enclosing scope.
+
+        @type enabled: bool
+
+        @type recursive: bool
+        @param recursive: Apply the setting to all containers nested in this
+        one as well.
+        """
+        self._chained_userdata = enabled
+        if recursive:
+            for child in self.get_children().values():
+                if isinstance(child, Container):
+                    child.set_chained_userdata(enabled, recursive)
+
+    def set_compact_userdata(self, enabled=True, recursive=True):
+        """Enable or disable compact userdata storage.
+
+        With compact storage, the userdata of this container is a
+        L{CompactUserData} whose layout holds every key this container and
+        its children declare, after remapping. The layout is rebuilt when the
+        container is closed.
+
+        @type enabled: bool
+
+        @type recursive: bool
+        @param recursive: Apply the setting to all containers nested in this
+        one as well.
+        """
+        self._compact_userdata = enabled
+        if enabled:
+            self._layout_userdata()
+        elif isinstance(self.userdata, smach.CompactUserData):
+            ud = smach.UserData()
+            ud.update(self.userdata)
+            self.userdata = ud
+        self._mark_structure_changed()
+        if recursive:
+            for child in self.get_children().values():
+                if isinstance(child, Container):
+                    child.set_compact_userdata(enabled, recursive)
+
+    def _layout_userdata(self):
+        """Replace the userdata with a compact structure laid out for the
+        declared keys."""
+        keys = set(self.get_registered_input_keys()) | set(self.get_registered_output_keys())
+        for (label, child) in self.get_children().items():
+            remapping = self._remappings.get(label) or {}
+            for key in set(child.get_registered_input_keys()) | set(child.get_registered_output_keys()):
+                keys.add(remapping.get(key, key))
+        layout = smach.UserDataLayout(keys)
+        if isinstance(self.userdata, smach.CompactUserData) and self.userdata._layout.keys == layout.keys:
+            return
+        ud = smach.CompactUserData(layout)
+        ud.update(self.userdata)
+        self.userdata = ud
+
     def _copy_input_keys(self, parent_ud, ud):
+        if self._chained_userdata:
+            if parent_ud is not None:
+                ud._chain(parent_ud, self._input_keys)
+            return
         if parent_ud is not None:
             input_keys = self.get_registered_input_keys()
             for ik in input_keys:
                 try:
                     ud[ik] = parent_ud[ik]
                 except KeyError:
-                    smach.logwarn("Attempting to copy input key '%s', but this key does not exist." % ik)
+                    smach.logwarn("Attempting to copy input key '%s', but this key does not exist.", ik)
 
     def _copy_output_keys(self, ud, parent_ud):
         if parent_ud is not None:
@@ -122,7 +261,7 @@ class Container(smach.state.State):
                 try:
                     parent_ud[ok] = ud[ok]
                 except KeyError:
-                    smach.logwarn("Attempting to copy output key '%s', but this key does not exist." % ok)
+                    smach.logwarn("Attempting to copy output key '%s', but this key does not exist.", ok)
 
     ### Callback registreation methods
     def register_start_cb(self, start_cb, cb_args=None):
@@ -192,13 +331,13 @@ class Container(smach.state.State):
         """Calls the registered termination callbacks.
         Callback functions are called with three arguments in addition to any
         user-supplied arguments:
-         - userdata
+         - a read-only snapshot of the userdata
          - a list of terminal states
          - the outcome of this container
         """
         try:
             for (cb,args) in self._termination_cbs:
-                cb(self.userdata, terminal_states, outcome, *args)
+                cb(self.userdata.snapshot(), terminal_states, outcome, *args)
         except:
             smach.logerr("Could not execute termination callback: "+traceback.format_exc())
 
@@ -246,9 +385,12 @@ class Container(smach.state.State):
         Container._construction_stack.pop()
         Container._construction_lock.release()
 
+        # Build the userdata accessors of the children
+        self._build_remappers()
+
         # Check consistency of container, post-construction
         try:
-            self.check_consistency()
+            self._check_consistency_cached()
         except (smach.InvalidStateError, smach.InvalidTransitionError):
             smach.logerr("Container consistency check failed.")
 
@@ -11,7 +11,7 @@ __all__ = ['SmachError',
 class SmachError(Exception):
     """Exception printing to console on instantiation"""
     def __init__(self, message):
-        smach.logerr(self.__class__.__name__ + ": " + message)
+        smach.logerr("%s: %s", self.__class__.__name__, message)
         Exception.__init__(self, message)
 
 
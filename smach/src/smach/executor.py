@@ -0,0 +1,197 @@
+import collections
+import threading
+import time
+import traceback
+
+import smach
+
+__all__ = ['WorkerPool', 'get_default_executor', 'set_default_executor']
+
+
+class Task(object):
+    """Handle to a function submitted to a L{WorkerPool}.
+
+    This provides the subset of the C{concurrent.futures.Future} interface
+    that SMACH containers use.
+    """
+
+    def __init__(self, fn, args, kwargs):
+        self._fn = fn
+        self._args = args
+        self._kwargs = kwargs
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def _run(self):
+        try:
+            self._result = self._fn(*self._args, **self._kwargs)
+        except BaseException as ex:
+            self._exception = ex
+            smach.logerr("Exception in SMACH worker task %s: %s", self._fn, traceback.format_exc())
+        finally:
+            # Drop references to the function and its arguments
+            self._fn = self._args = self._kwargs = None
+            self._done.set()
+
+    def done(self):
+        """True if the task has finished."""
+        return self._done.is_set()
+
+    def exception(self, timeout=None):
+        """Wait for the task to finish and return the exception it raised, or
+        None if it returned normally."""
+        self._done.wait(timeout)
+        return self._exception
+
+    def result(self, timeout=None):
+        """Wait for the task to finish and return its result, re-raising the
+        exception it raised, if any."""
+        self._done.wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class WorkerPool(object):
+    """Pool of reusable worker threads.
+
+    Submitted functions run on an idle worker if there is one. Otherwise a new
+    worker is started, unless the pool already holds C{max_workers} workers,
+    in which case the function is queued until a worker becomes idle. Workers
+    that stay idle for C{idle_timeout} seconds exit, so the pool shrinks back
+    after bursts of concurrency.
+
+    The children of a L{Concurrence} run on such a pool. Since children are
+    generally expected to run at the same time (one child may wait for the
+    output of another), C{max_workers} bounds the total number of threads of
+    all concurrences sharing the pool and should not be lower than the
+    largest number of children that can be active simultaneously, counting
+    the children of nested concurrences.
+    """
+
+    def __init__(self, max_workers=None, idle_timeout=60.0, name='smach_worker'):
+        """Constructor.
+
+        @type max_workers: int
+        @param max_workers: Maximum number of worker threads, or None for no
+        bound.
+
+        @type idle_timeout: float
+        @param idle_timeout: Time in seconds after which an idle worker exits.
+
+        @type name: string
+        @param name: Prefix for the names of the worker threads.
+        """
+        self._max_workers = max_workers
+        self._idle_timeout = idle_timeout
+        self._name = name
+
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._n_workers = 0
+        self._n_idle = 0
+        self._n_started = 0
+        self._shutdown = False
+
+    def submit(self, fn, *args, **kwargs):
+        """Run C{fn(*args, **kwargs)} on a worker thread.
+
+        @rtype: L{Task}
+        @return: A handle to wait for the call to finish.
+        """
+        task = Task(fn, args, kwargs)
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit tasks to a WorkerPool that has been shut down.")
+            self._queue.append(task)
+            if len(self._queue) <= self._n_idle:
+                # An idle worker picks this task up
+                self._cond.notify()
+            elif self._max_workers is None or self._n_workers < self._max_workers:
+                self._start_worker()
+        return task
+
+    def shutdown(self, wait=True):
+        """Stop all workers once the queued tasks have run.
+
+        @type wait: bool
+        @param wait: Block until all workers have exited.
+        """
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+            if wait:
+                while self._n_workers > 0:
+                    self._cond.wait()
+
+    def get_num_workers(self):
+        """Get the number of worker threads."""
+        return self._n_workers
+
+    def _start_worker(self):
+        self._n_workers += 1
+        self._n_started += 1
+        worker = threading.Thread(
+            name='%s_%d' % (self._name, self._n_started),
+            target=self._work)
+        worker.daemon = True
+        worker.start()
+
+    def _work(self):
+        self._cond.acquire()
+        try:
+            while True:
+                if self._queue:
+                    task = self._queue.popleft()
+                    self._cond.release()
+                    try:
+                        task._run()
+                    finally:
+                        self._cond.acquire()
+                    continue
+
+                if self._shutdown:
+                    break
+
+                # Wait for a task
+                idle_since = time.time()
+                self._n_idle += 1
+                self._cond.wait(self._idle_timeout)
+                self._n_idle -= 1
+                if (not self._queue and not self._shutdown
+                        and time.time() - idle_since >= self._idle_timeout):
+                    break
+        finally:
+            self._n_workers -= 1
+            self._cond.notify_all()
+            self._cond.release()
+
+
+# Executor used by containers that were not given one
+_default_executor = None
+_default_executor_lock = threading.Lock()
+
+
+def get_default_executor():
+    """Get the process-wide executor used by containers that run children
+    concurrently. This is a L{WorkerPool} without a bound on the number of
+    workers, unless it was replaced with L{set_default_executor}."""
+    global _default_executor
+    with _default_executor_lock:
+        if _default_executor is None:
+            _default_executor = WorkerPool()
+        return _default_executor
+
+
+def set_default_executor(executor):
+    """Set the process-wide executor used by containers that run children
+    concurrently.
+
+    @param executor: A L{WorkerPool}, or any object with a C{submit(fn, *args)}
+    method that returns a future-like object providing C{exception()}, such as
+    a C{concurrent.futures.ThreadPoolExecutor}.
+    """
+    global _default_executor
+    with _default_executor_lock:
+        _default_executor = executor
@@ -1,6 +1,10 @@
+import copy
+import itertools
+import threading
 import traceback
 
 import smach
+from smach.buffer_items import BufferItems, _is_ndarray
 
 __all__ = ['Iterator']
 
@@ -18,7 +22,17 @@ class Iterator(smach.container.Container):
                  output_keys,
                  it=None,
                  it_label = 'it_data',
-                 exhausted_outcome = 'exhausted'):
+                 exhausted_outcome = 'exhausted',
+                 max_concurrency = 1,
+                 state_factory = None,
+                 executor = None,
+                 result_key = None,
+                 item_result_key = None,
+                 ordered = True,
+                 batch_size = None,
+                 reduce_cb = None,
+                 accumulator_key = None,
+                 initial_value = None):
         """Constructor.
 
         @type outcomes: list of string
@@ -31,11 +45,74 @@ class Iterator(smach.container.Container):
         @param it_label: The label that the item in the current
         iteration will be given when it is put into the container's local
         userdata.
+
+        @type max_concurrency: int
+        @param max_concurrency: The number of items processed at the same
+        time. If this is greater than 1, the iterator maps the contained state
+        over the items in parallel: each item is processed by its own copy of
+        the contained state, in its own userdata scope. The scope reads the
+        input keys of the state from the container's userdata, holds the item,
+        and keeps the state's outputs to itself. The first item whose outcome
+        breaks the iteration preempts the items still being processed.
+
+        @type state_factory: callable
+        @param state_factory: Function returning a new copy of the contained
+        state, used in parallel mode. If None, copies are made with
+        C{copy.deepcopy}, which fails for containers and for states holding
+        locks or connections, such as L{smach_ros.SimpleActionState}; those
+        require a factory. Copies are reused for later items and executions.
+
+        @type executor: L{WorkerPool}
+        @param executor: The executor that runs the items in parallel mode.
+        If None, the executor returned by L{smach.get_default_executor} is
+        used.
+
+        @type result_key: string
+        @param result_key: If set, the results of the items are collected in
+        a list stored under this key in the container's userdata when the
+        iteration terminates.
+
+        @type item_result_key: string
+        @param item_result_key: The userdata key the contained state writes
+        the result of an item to. If None, the result of an item is the
+        outcome of the contained state.
+
+        @type ordered: bool
+        @param ordered: If True, the collected results are in the order of the
+        items, otherwise in the order the items completed.
+
+        @type batch_size: int
+        @param batch_size: If set, the contained state is given a batch of up
+        to this many items per iteration instead of a single item. Batches of
+        lists, tuples, NumPy arrays and L{BufferItems} are slices of the
+        sequence (for NumPy arrays and L{BufferItems}, views); other
+        iterables are consumed lazily into lists. Loop and break
+        outcomes, results and parallel processing apply per batch.
+
+        @type reduce_cb: callable
+        @param reduce_cb: If set, the result of each item is folded into an
+        accumulator as soon as the item completes, by calling this function
+        with the accumulator and the result and keeping its return value. The
+        accumulator is stored under C{accumulator_key} in the container's
+        userdata when the iteration terminates. Unlike C{result_key}, this
+        keeps only the accumulator, however many items there are. In parallel
+        mode with C{ordered}, results are folded in the order of the items,
+        holding results that complete ahead of slower items until their turn.
+
+        @type accumulator_key: string
+        @param accumulator_key: The userdata key the accumulator is stored
+        under. Required if C{reduce_cb} is set.
+
+        @type initial_value: object
+        @param initial_value: The value of the accumulator before the first
+        item. Each execution starts from a copy of it.
         """
         if it is None:
             it = []
         if exhausted_outcome not in outcomes:
             outcomes.append(exhausted_outcome)
+        if reduce_cb is not None and accumulator_key is None:
+            raise smach.InvalidConstructionError("Iterator requires an accumulator key to reduce the results of its items.")
         smach.container.Container.__init__(self, outcomes, input_keys, output_keys)
 
         self._items = it
@@ -50,6 +127,26 @@ class Iterator(smach.container.Container):
         self._final_outcome_map = {}
         self._exhausted_outcome = exhausted_outcome
 
+        # Parallel map options
+        self._max_concurrency = max(1, max_concurrency)
+        self._state_factory = state_factory
+        self._executor = executor
+        self._result_key = result_key
+        self._item_result_key = item_result_key
+        self._ordered = ordered
+        self._batch_size = batch_size
+
+        # Streaming reduction of the results
+        self._reduce_cb = reduce_cb
+        self._accumulator_key = accumulator_key
+        self._initial_value = initial_value
+
+        # Idle copies of the contained state, and the copies processing items
+        # keyed on item index
+        self._state_copies = []
+        self._running_states = {}
+        self._parallel_lock = threading.Lock()
+
     ### Construction Methods
     @staticmethod
     def set_iteritems(it, it_label='it_data'):
@@ -67,6 +164,7 @@ class Iterator(smach.container.Container):
         self = Iterator._currently_opened_container()
         self._items = it
         self._items_label = it_label
+        self._mark_structure_changed()
 
     @staticmethod
     def set_contained_state(
@@ -134,51 +232,283 @@ class Iterator(smach.container.Container):
                     self._break_outcomes.append(outcome)
 
         self._final_outcome_map = final_outcome_map
+        self._state_copies = []
+        self._mark_structure_changed()
+
+        # Make sure copies for parallel mode can be made, and keep the first
+        if self._max_concurrency > 1 and self._state_factory is None:
+            try:
+                self._state_copies.append(copy.deepcopy(state))
+            except Exception:
+                raise smach.InvalidConstructionError(
+                    "Iterator processes items in parallel, but its state '%s' can not be copied. Pass a state_factory to the Iterator instead: " % label
+                    + traceback.format_exc())
 
     ### State interface
     def execute(self, parent_ud):
-        self._is_running = True
+        it = self._start_execution(parent_ud)
 
-        # Copy input keys
-        self._copy_input_keys(parent_ud, self.userdata)
-
-        self.call_start_cbs()
+        if self._max_concurrency > 1:
+            outcome = self._execute_parallel(it)
+            return self._finish_execution(parent_ud, outcome)
 
         # Iterate over items
         outcome = self._exhausted_outcome
+        results = []
+        accumulator = self._start_reduction()
 
-        if hasattr(self._items,'__call__'):
-            it = self._items().__iter__()
-        else:
-            it = self._items.__iter__()
-
-        while not smach.is_shutdown():
+        for index in itertools.count():
+            if smach.is_shutdown():
+                break
             try:
                 item = next(it)
-            except:
+            except StopIteration:
                 outcome = self._exhausted_outcome
                 break
-            smach.loginfo("Iterating %s of %s" % (str(item), str(self._items)))
+            smach.logdebug("Iterator '%s' entering item %d", self._state_label, index)
             self.userdata[self._items_label] = item
+            self._clear_item_result()
             # Enter the contained state
             try:
                 outcome = self._state.execute(self.userdata)
             except smach.InvalidUserCodeError as ex:
-                smach.logerr("Could not execute Iterator state '%s'" % self._state_label)
+                smach.logerr("Could not execute Iterator state '%s'", self._state_label)
                 raise ex
             except:
                 raise smach.InvalidUserCodeError("Could not execute iterator state '%s' of type '%s': " % ( self._state_label, self._state) + traceback.format_exc())
 
-            # Check if we should stop preemptively
+            if self._result_key is not None or self._reduce_cb is not None:
+                result = self._get_item_result(self.userdata, outcome)
+                if self._result_key is not None:
+                    results.append(result)
+                if self._reduce_cb is not None:
+                    accumulator = self._reduce(accumulator, result)
+
+            final_outcome = self._check_iteration_outcome(outcome)
+            if final_outcome is not None:
+                outcome = final_outcome
+                break
+
+        if self._result_key is not None:
+            self.userdata[self._result_key] = results
+        if self._reduce_cb is not None:
+            self.userdata[self._accumulator_key] = accumulator
+
+        return self._finish_execution(parent_ud, outcome)
+
+    def _clear_item_result(self):
+        """Clear the result of the previous item, so an item that does not
+        write a result does not repeat it."""
+        if self._item_result_key is not None and (self._result_key is not None or self._reduce_cb is not None):
+            self.userdata[self._item_result_key] = None
+
+    def _get_item_result(self, ud, outcome):
+        if self._item_result_key is None:
+            return outcome
+        if self._item_result_key in ud:
+            return ud[self._item_result_key]
+        return None
+
+    def _start_reduction(self):
+        """Get the initial accumulator of an execution."""
+        if self._reduce_cb is None:
+            return None
+        return copy.deepcopy(self._initial_value)
+
+    def _reduce(self, accumulator, result):
+        """Fold the result of an item into the accumulator."""
+        try:
+            return self._reduce_cb(accumulator, result)
+        except:
+            raise smach.InvalidUserCodeError("Could not execute reduce callback of iterator state '%s': " % self._state_label + traceback.format_exc())
+
+    def _get_state_copy(self):
+        """Get an idle copy of the contained state."""
+        if self._state_copies:
+            state = self._state_copies.pop()
+            state.recall_preempt()
+            return state
+        if self._state_factory is not None:
+            return self._state_factory()
+        return copy.deepcopy(self._state)
+
+    def _execute_parallel(self, it):
+        """Map the contained state over the items, processing up to
+        C{max_concurrency} items at the same time.
+
+        @return: The outcome of the last item that terminated the iteration,
+        or None.
+        """
+        executor = self._executor or smach.get_default_executor()
+        # Results keyed on item index, and the completed items
+        results = {}
+        completed = []
+        # Accumulator, results waiting to be folded in item order and the
+        # index of the next item to fold
+        accumulator = self._start_reduction()
+        pending = {}
+        next_reduced = 0
+        done_cond = threading.Condition()
+        final_outcome = None
+        failure = None
+        n_items = 0
+        exhausted = False
+        input_keys = frozenset(self._state.get_registered_input_keys())
+
+        def run_item(index, state, ud):
+            try:
+                outcome = state.execute(ud)
+                entry = (index, state, ud, outcome, None)
+            except Exception as ex:
+                smach.logerr("Could not execute iterator state '%s' on item %d: %s",
+                             self._state_label, index, traceback.format_exc())
+                entry = (index, state, ud, None, ex)
+            with done_cond:
+                completed.append(entry)
+                done_cond.notify()
+
+        done_cond.acquire()
+        try:
+            while True:
+                # Start items up to the concurrency bound
+                while (not exhausted and final_outcome is None and failure is None
+                       and len(self._running_states) < self._max_concurrency):
+                    if self.preempt_requested() or smach.is_shutdown():
+                        exhausted = True
+                        break
+                    try:
+                        item = next(it)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    try:
+                        state = self._get_state_copy()
+                    except Exception:
+                        failure = smach.InvalidUserCodeError(
+                            "Could not copy iterator state '%s': %s" % (self._state_label, traceback.format_exc()))
+                        self._preempt_running_states()
+                        break
+                    ud = smach.UserData()
+                    ud._chain(self.userdata, input_keys)
+                    ud[self._items_label] = item
+                    with self._parallel_lock:
+                        self._running_states[n_items] = state
+                    executor.submit(run_item, n_items, state, ud)
+                    n_items += 1
+
+                if not self._running_states and not completed:
+                    break
+                while not completed:
+                    done_cond.wait()
+
+                (index, state, ud, outcome, ex) = completed.pop(0)
+                with self._parallel_lock:
+                    del self._running_states[index]
+                self._state_copies.append(state)
+
+                # Items preempted after the iteration was decided do not count
+                if final_outcome is not None or failure is not None:
+                    continue
+                if ex is not None:
+                    failure = ex
+                    self._preempt_running_states()
+                    continue
+                if self._result_key is not None or self._reduce_cb is not None:
+                    result = self._get_item_result(ud, outcome)
+                    if self._result_key is not None:
+                        results[index] = result
+                    if self._reduce_cb is not None:
+                        pending[index] = result
+                        try:
+                            while pending and (not self._ordered or next_reduced in pending):
+                                key = next_reduced if self._ordered else index
+                                accumulator = self._reduce(accumulator, pending.pop(key))
+                                next_reduced += 1
+                        except smach.InvalidUserCodeError as ex:
+                            failure = ex
+                            self._preempt_running_states()
+                            continue
+                done_cond.release()
+                try:
+                    final_outcome = self._check_iteration_outcome(outcome)
+                finally:
+                    done_cond.acquire()
+                if final_outcome is not None:
+                    self._preempt_running_states()
+        finally:
+            done_cond.release()
+
+        if failure is not None:
+            if isinstance(failure, smach.InvalidUserCodeError):
+                raise failure
+            raise smach.InvalidUserCodeError("Could not execute iterator state '%s' of type '%s': %s" % (
+                self._state_label, self._state, failure))
+
+        if self._result_key is not None:
+            if self._ordered:
+                self.userdata[self._result_key] = [results[i] for i in sorted(results)]
+            else:
+                self.userdata[self._result_key] = list(results.values())
+        if self._reduce_cb is not None:
+            # Fold the results that were waiting on items preempted by a break
+            for index in sorted(pending):
+                accumulator = self._reduce(accumulator, pending[index])
+            self.userdata[self._accumulator_key] = accumulator
+
+        if final_outcome is None:
             if self.preempt_requested():
                 self.service_preempt()
-                outcome = 'preempted'
-                break
-            if outcome in self._break_outcomes\
-                    or (len(self._loop_outcomes) > 0 and outcome not in self._loop_outcomes):
-                break
-            self.call_transition_cbs()
+                return 'preempted'
+            return self._exhausted_outcome
+        return final_outcome
+
+    def _preempt_running_states(self):
+        with self._parallel_lock:
+            for state in self._running_states.values():
+                state.request_preempt()
+
+    def _start_execution(self, parent_ud):
+        """Enter the container.
+
+        @return: An iterator over the items.
+        """
+        self._is_running = True
+
+        # Copy input keys
+        self._copy_input_keys(parent_ud, self.userdata)
+
+        self.call_start_cbs()
+
+        items = self._items
+        if hasattr(items, '__call__'):
+            items = items()
+        if self._batch_size is None:
+            return iter(items)
+        return _iter_batches(items, self._batch_size)
+
+    def _check_iteration_outcome(self, outcome):
+        """Check whether an outcome of the contained state ends the iteration.
 
+        @rtype: string
+        @return: The outcome the iteration terminates with, or None if it
+        continues.
+        """
+        # Check if we should stop preemptively
+        if self.preempt_requested():
+            self.service_preempt()
+            return 'preempted'
+        if outcome in self._break_outcomes\
+                or (len(self._loop_outcomes) > 0 and outcome not in self._loop_outcomes):
+            return outcome
+        self.call_transition_cbs()
+        return None
+
+    def _finish_execution(self, parent_ud, outcome):
+        """Leave the container.
+
+        @rtype: string
+        @return: The outcome of the container.
+        """
         # Remap the outcome if necessary
         if outcome in self._final_outcome_map:
             outcome = self._final_outcome_map[outcome]
@@ -195,6 +525,8 @@ class Iterator(smach.container.Container):
     def request_preempt(self):
         smach.loginfo("Preempt requested on iterator")
         smach.State.request_preempt(self)
+        # Items being processed in parallel are preempted as well
+        self._preempt_running_states()
 
     ### Container interface
     def get_children(self):
@@ -202,7 +534,7 @@ class Iterator(smach.container.Container):
 
     def __getitem__(self,key):
         if key != self._state_label:
-            smach.logerr("Attempting to get state '%s' from Iterator container. The only available state is '%s'." % (key, self._state_label))
+            smach.logerr("Attempting to get state '%s' from Iterator container. The only available state is '%s'.", key, self._state_label)
             raise KeyError()
         return self._state
 
@@ -212,11 +544,11 @@ class Iterator(smach.container.Container):
     def set_initial_state(self, initial_states, userdata):
         # Check initial state
         if len(initial_states) > 1:
-            smach.logwarn("Attempting to set initial state to include more than one state, but Iterator container can only have one initial state." % (self._state_label))
+            smach.logwarn("Attempting to set initial state to include more than one state, but Iterator container can only have one initial state.")
 
         if len(initial_states) > 0:
             if initial_states[0] != self._state_label:
-                smach.logwarn("Attempting to set state '%s' as initial state in Iterator container. The only available state is '%s'." % (initial_states[0], self._state_label))
+                smach.logwarn("Attempting to set state '%s' as initial state in Iterator container. The only available state is '%s'.", initial_states[0], self._state_label)
                 raise KeyError()
 
         # Set local userdata
@@ -246,3 +578,18 @@ class Iterator(smach.container.Container):
 
     def check_consistency(self):
         pass
+
+
+def _iter_batches(items, batch_size):
+    """Iterate over batches of items."""
+    if isinstance(items, (list, tuple, BufferItems)) or _is_ndarray(items):
+        # Slice sequences, so NumPy arrays give views rather than copies
+        for start in range(0, len(items), batch_size):
+            yield items[start:start + batch_size]
+        return
+    it = iter(items)
+    while True:
+        batch = list(itertools.islice(it, batch_size))
+        if not batch:
+            return
+        yield batch
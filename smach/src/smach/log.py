@@ -1,27 +1,237 @@
-import smach
+import atexit
+import collections
+import threading
+import traceback
 
-__all__ = ['set_loggers', 'loginfo', 'logwarn', 'logerr', 'logdebug']
+__all__ = ['set_loggers', 'set_log_level', 'get_log_level',
+           'loginfo', 'logwarn', 'logerr', 'logdebug',
+           'LogSink', 'PrintSink', 'CallbackSink', 'AsyncLogSink',
+           'DEBUG', 'INFO', 'WARN', 'ERROR']
 
+# Log levels (these match the levels of the python logging module)
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
 
-def loginfo(msg):
-    print("[  INFO ] : " + str(msg))
 
+def format_message(msg, args):
+    """Apply %-style arguments to a log message, if there are any."""
+    if args:
+        return str(msg) % args
+    return str(msg)
 
-def logwarn(msg):
-    print("[  WARN ] : " + str(msg))
 
+class LogSink(object):
+    """Destination of SMACH log messages.
 
-def logdebug(msg):
-    print("[ DEBUG ] : " + str(msg))
+    A sink receives the level, the message and the (not yet applied) %-style
+    arguments of every message that passes the active log level. Messages are
+    only formatted by the sink, so a sink that drops a message never pays for
+    its formatting.
+    """
 
+    def log(self, level, msg, args):
+        """Emit a message.
 
-def logerr(msg):
-    print("[ ERROR ] : " + str(msg))
+        @type level: int
+        @param level: One of L{DEBUG}, L{INFO}, L{WARN} or L{ERROR}.
 
+        @type msg: str
+        @param msg: The message, possibly containing %-style placeholders.
 
-def set_loggers(info, warn, debug, error):
-    """Override the SMACH logging functions."""
-    smach.loginfo = info
-    smach.logwarn = warn
-    smach.logdebug = debug
-    smach.logerr = error
+        @type args: tuple
+        @param args: Arguments for the placeholders in C{msg}.
+        """
+        raise NotImplementedError()
+
+    def flush(self):
+        """Block until all messages handed to this sink have been emitted."""
+        pass
+
+
+class PrintSink(LogSink):
+    """Sink printing messages to stdout. This is the default sink."""
+
+    _PREFIXES = {
+        DEBUG: "[ DEBUG ] : ",
+        INFO: "[  INFO ] : ",
+        WARN: "[  WARN ] : ",
+        ERROR: "[ ERROR ] : "}
+
+    def log(self, level, msg, args):
+        print(self._PREFIXES[level] + format_message(msg, args))
+
+
+class CallbackSink(LogSink):
+    """Sink forwarding formatted messages to one callable per level.
+
+    This is the sink that L{set_loggers} installs when it is given four
+    logging functions.
+    """
+
+    def __init__(self, info, warn, debug, error):
+        self._callbacks = {
+            DEBUG: debug,
+            INFO: info,
+            WARN: warn,
+            ERROR: error}
+
+    def log(self, level, msg, args):
+        self._callbacks[level](format_message(msg, args))
+
+
+class AsyncLogSink(LogSink):
+    """Sink handing messages to another sink on a background thread.
+
+    Logging calls only append the unformatted message to a queue, so neither
+    formatting nor writing the message blocks the thread that executes the
+    state machine. Arguments are formatted on the background thread, which
+    means they should not be mutated after they have been logged.
+
+    If the queue holds C{max_pending} messages, new messages are dropped
+    until the background thread catches up. The number of dropped messages is
+    reported with the next message that makes it through.
+
+    The queue of the sink installed with L{set_loggers} is flushed on
+    interpreter shutdown. Sinks that are replaced should be closed.
+    """
+
+    def __init__(self, sink=None, max_pending=10000):
+        """Constructor.
+
+        @type sink: L{LogSink}
+        @param sink: The sink that emits the messages. Defaults to a
+        L{PrintSink}.
+
+        @type max_pending: int
+        @param max_pending: Maximum number of queued messages.
+        """
+        if sink is None:
+            sink = PrintSink()
+        self._sink = sink
+        self._max_pending = max_pending
+        self._queue = collections.deque()
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._keep_running = True
+
+        self._thread = threading.Thread(name='smach_log_sink', target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def log(self, level, msg, args):
+        if len(self._queue) >= self._max_pending:
+            with self._dropped_lock:
+                self._dropped += 1
+            return
+        self._queue.append((level, msg, args))
+        self._wakeup.set()
+
+    def flush(self, timeout=None):
+        """Block until all queued messages have been emitted.
+
+        @type timeout: float
+        @param timeout: Maximum time to wait in seconds, or None to wait
+        indefinitely.
+        """
+        if not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.append((None, done, None))
+        self._wakeup.set()
+        done.wait(timeout)
+
+    def close(self):
+        """Emit all queued messages and stop the background thread."""
+        self.flush()
+        self._keep_running = False
+        self._wakeup.set()
+        self._thread.join()
+
+    def _run(self):
+        while self._keep_running:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while self._queue:
+                (level, msg, args) = self._queue.popleft()
+                if level is None:
+                    # Flush marker
+                    msg.set()
+                    continue
+                try:
+                    if self._dropped:
+                        with self._dropped_lock:
+                            dropped, self._dropped = self._dropped, 0
+                        self._sink.log(WARN, "SMACH log queue overflowed, dropped %d messages.", (dropped,))
+                    self._sink.log(level, msg, args)
+                except Exception:
+                    traceback.print_exc()
+            self._sink.flush()
+
+
+# Active log level and sink
+_level = DEBUG
+_sink = PrintSink()
+
+
+def loginfo(msg, *args):
+    if _level <= INFO:
+        _sink.log(INFO, msg, args)
+
+
+def logwarn(msg, *args):
+    if _level <= WARN:
+        _sink.log(WARN, msg, args)
+
+
+def logdebug(msg, *args):
+    if _level <= DEBUG:
+        _sink.log(DEBUG, msg, args)
+
+
+def logerr(msg, *args):
+    if _level <= ERROR:
+        _sink.log(ERROR, msg, args)
+
+
+def set_loggers(info, warn=None, debug=None, error=None):
+    """Override the SMACH logging functions.
+
+    This either takes a single L{LogSink}, or four logging functions (info,
+    warn, debug and error) which each receive a formatted message string.
+    """
+    global _sink
+    if isinstance(info, LogSink):
+        _sink = info
+    else:
+        _sink = CallbackSink(info, warn, debug, error)
+
+
+def _flush_at_exit():
+    # Do not lose the tail of the log of an asynchronous sink on interpreter
+    # shutdown
+    if isinstance(_sink, AsyncLogSink):
+        _sink.flush(1.0)
+
+
+atexit.register(_flush_at_exit)
+
+
+def set_log_level(level):
+    """Set the minimum level of SMACH log messages.
+
+    Messages below this level are dropped before they are formatted or handed
+    to the sink.
+
+    @type level: int
+    @param level: One of L{DEBUG}, L{INFO}, L{WARN} or L{ERROR}.
+    """
+    global _level
+    _level = level
+
+
+def get_log_level():
+    """Get the minimum level of SMACH log messages."""
+    return _level
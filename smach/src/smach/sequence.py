@@ -15,7 +15,8 @@ class Sequence(smach.state_machine.StateMachine):
                  outcomes,
                  connector_outcome,
                  input_keys=None,
-                 output_keys=None):
+                 output_keys=None,
+                 compiled=True):
         """Constructor.
 
         @type outcomes: list of string
@@ -24,12 +25,16 @@ class Sequence(smach.state_machine.StateMachine):
         @type connector_outcome: string
         @param connector_outcome: The outcome used to connect states in the
         sequence.
+
+        @type compiled: bool
+        @param compiled: Execute from a compiled dispatch table, see
+        L{smach.StateMachine}.
         """
         if input_keys is None:
             input_keys = []
         if output_keys is None:
             output_keys = []
-        smach.state_machine.StateMachine.__init__(self, outcomes, input_keys, output_keys)
+        smach.state_machine.StateMachine.__init__(self, outcomes, input_keys, output_keys, compiled)
 
         self._last_added_seq_label = None
         self._connector_outcome = connector_outcome
@@ -13,6 +13,11 @@ class State(object):
     called) and are checked during construction.
     """
 
+    # Whether the values of input keys that are not output keys are passed to
+    # this state as read-only views. Trusted states that do not modify their
+    # inputs can set this to False to skip building the views.
+    const_inputs = True
+
     def __init__(self, outcomes=[], input_keys=[], output_keys=[], io_keys=[]):
         """State constructor
         @type outcomes: list of str
@@ -36,6 +41,9 @@ class State(object):
         # Store userdata interface description
         self._input_keys = set(input_keys + io_keys)
         self._output_keys = set(output_keys + io_keys)
+        # Incremented whenever keys are registered, so containers know when
+        # to rebuild the accessors of this state
+        self._keys_version = 0
 
         # Declare preempt flag
         self._preempt_requested = False
@@ -73,6 +81,7 @@ class State(object):
         """
         self._input_keys = self._input_keys.union(keys)
         self._output_keys = self._output_keys.union(keys)
+        self._keys_version += 1
 
     def register_input_keys(self, keys):
         """Add keys to the set of keys from which this state may read.
@@ -81,6 +90,7 @@ class State(object):
         active.
         """
         self._input_keys = self._input_keys.union(keys)
+        self._keys_version += 1
 
     def get_registered_input_keys(self):
         """Get a tuple of registered input keys."""
@@ -93,6 +103,7 @@ class State(object):
         active.
         """
         self._output_keys = self._output_keys.union(keys)
+        self._keys_version += 1
 
     def get_registered_output_keys(self):
         """Get a tuple of registered output keys."""
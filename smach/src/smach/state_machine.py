@@ -6,6 +6,40 @@ import smach
 __all__ = ['StateMachine']
 
 
+class _DispatchTable(object):
+    """Immutable, integer-indexed view of a closed state machine graph.
+
+    Every state is addressed by its position in C{labels}. C{targets[i]} maps
+    each outcome bound on state C{i} onto a precomputed 3-tuple
+    (next_index, terminal_outcome, is_container_outcome). The next index is -1
+    if the transition does not lead to a state of this container, in which
+    case terminal_outcome is the container outcome the transition resolves
+    to, exactly as the interpreted path in L{StateMachine._update_once} would
+    resolve it.
+    """
+    __slots__ = ('labels', 'index', 'states', 'transitions', 'remappers', 'targets')
+
+    def __init__(self, states, transitions, remappers, container_outcomes):
+        container_outcomes = frozenset(container_outcomes)
+        self.labels = tuple(states)
+        self.index = dict((label, i) for (i, label) in enumerate(self.labels))
+        self.states = tuple(states[label] for label in self.labels)
+        self.transitions = tuple(transitions[label] for label in self.labels)
+        self.remappers = tuple(remappers[label] for label in self.labels)
+
+        targets = []
+        for label_transitions in self.transitions:
+            table = {}
+            for (outcome, target) in label_transitions.items():
+                terminal_outcome = target if target in container_outcomes else outcome
+                table[outcome] = (
+                    self.index.get(target, -1),
+                    terminal_outcome,
+                    terminal_outcome in container_outcomes)
+            targets.append(table)
+        self.targets = tuple(targets)
+
+
 ### State Machine class
 class StateMachine(smach.container.Container):
     """StateMachine
@@ -27,13 +61,24 @@ class StateMachine(smach.container.Container):
      - OUTCOME -> STATE_LABEL
      - OUTCOME -> None (or unspecified)
      - OUTCOME -> SM_OUTCOME
+
+    By default the state machine is compiled into an integer-indexed dispatch
+    table when it is closed (or on its first execution). Transitions are then
+    resolved with a single lookup per step instead of re-validating the
+    outcome against the string-keyed state and transition dictionaries. The
+    table is discarded whenever the structure of the state machine changes.
     """
 
-    def __init__(self, outcomes, input_keys=None, output_keys=None):
+    def __init__(self, outcomes, input_keys=None, output_keys=None, compiled=True):
         """Constructor for smach StateMachine Container.
 
         @type outcomes: list of strings
         @param outcomes: The potential outcomes of this state machine.
+
+        @type compiled: bool
+        @param compiled: Execute from a compiled dispatch table. If this is
+        False, every transition is resolved against the state and transition
+        dictionaries directly.
         """
 
         if input_keys is None:
@@ -52,6 +97,7 @@ class StateMachine(smach.container.Container):
 
         self._initial_state_label = None
 
+        self._current_index = None
         self._current_label = None
         self._current_state = None
         self._current_transitions = None
@@ -68,6 +114,10 @@ class StateMachine(smach.container.Container):
         self._transitions = {}
         self._remappings = {}
 
+        # Compiled dispatch table, built on close() or on the first execution
+        self._compiled = compiled
+        self._dispatch = None
+
         # Construction vars
         self._last_added_label = None
         self._connector_outcomes = []
@@ -95,7 +145,7 @@ class StateMachine(smach.container.Container):
         # Get currently opened container
         self = StateMachine._currently_opened_container()
 
-        smach.logdebug('Adding state (%s, %s, %s)' % (label, str(state), str(transitions)))
+        smach.logdebug('Adding state (%s, %s, %s)', label, state, transitions)
 
         # Set initial state if it is still unset
         if self._initial_state_label is None:
@@ -124,7 +174,7 @@ class StateMachine(smach.container.Container):
                 'Attempting to add state with label "' + label + '" to state machine, but this label is already being used.')
 
         # Debug info
-        smach.logdebug("Adding state '" + str(label) + "' to the state machine.")
+        smach.logdebug("Adding state '%s' to the state machine.", label)
 
         # Create implicit terminal transitions, and combine them with the explicit transitions
         registered_outcomes = state.get_registered_outcomes()
@@ -132,13 +182,13 @@ class StateMachine(smach.container.Container):
         # Get a list of the unbound transitions
         missing_transitions = {o: None for o in registered_outcomes if o not in transitions}
         transitions.update(missing_transitions)
-        smach.logdebug("State '%s' is missing transitions: %s" % (label, str(missing_transitions)))
+        smach.logdebug("State '%s' is missing transitions: %s", label, missing_transitions)
 
         # Add state and transitions to the dictionary
         self._states[label] = state
         self._transitions[label] = transitions
         self._remappings[label] = remapping
-        smach.logdebug("TRANSITIONS FOR %s: %s" % (label, str(self._transitions[label])))
+        smach.logdebug("TRANSITIONS FOR %s: %s", label, self._transitions[label])
 
         # Add transition to this state if connected outcome is defined
         if len(self._connector_outcomes) > 0 and self._last_added_label is not None:
@@ -148,6 +198,8 @@ class StateMachine(smach.container.Container):
             self._connector_outcomes = []
             self._last_added_label = None
 
+        self._mark_structure_changed()
+
         return state
 
     @staticmethod
@@ -193,77 +245,92 @@ class StateMachine(smach.container.Container):
         return add_ret
 
     ### Internals
+    def _mark_structure_changed(self):
+        smach.container.Container._mark_structure_changed(self)
+        # The compiled dispatch table is stale
+        self._dispatch = None
+
+    def _compile(self):
+        """Build the integer-indexed dispatch table for the current graph."""
+        self._dispatch = _DispatchTable(
+            self._states,
+            self._transitions,
+            dict((label, self._get_remapper(label)) for label in self._states),
+            self.get_registered_outcomes())
+
     def _set_current_state(self, state_label):
         if state_label is not None:
+            if self._dispatch is not None:
+                self._set_current_index(self._dispatch.index[state_label])
+                return
             # Store the current label and states 
+            self._current_index = None
             self._current_label = state_label
             self._current_state = self._states[state_label]
             self._current_transitions = self._transitions[state_label]
             self._current_outcome = None
         else:
             # Store the current label and states 
+            self._current_index = None
             self._current_label = None
             self._current_state = None
             self._current_transitions = None
             self._current_outcome = None
 
-    def _update_once(self):
-        """Method that updates the state machine once.
-        This checks if the current state is ready to transition, if so, it
-        requests the outcome of the current state, and then extracts the next state
-        label from the current state's transition dictionary, and then transitions
-        to the next state.
-        """
-        outcome = None
-        transition_target = None
-        last_state_label = self._current_label
-
-        # Make sure the state exists
-        if self._current_label not in self._states:
-            raise smach.InvalidStateError("State '%s' does not exist. Available states are: %s" %
-                                          (self._current_label, list(self._states.keys())))
+    def _set_current_index(self, index):
+        dispatch = self._dispatch
+        self._current_index = index
+        self._current_label = dispatch.labels[index]
+        self._current_state = dispatch.states[index]
+        self._current_transitions = dispatch.transitions[index]
+        self._current_outcome = None
 
-        # Check if a preempt was requested before or while the last state was running
-        if self.preempt_requested():
-            smach.logwarn("Preempt requested on state machine before executing the next state.")
-            # We were preempted
-            if self._preempted_state is not None:
-                # We were preempted while the last state was running
-                if self._preempted_state.preempt_requested():
-                    smach.logwarn(
-                        "Last state '%s' did not service preempt. Preempting next state '%s' before executing..." % (
-                        self._preempted_label, self._current_label))
-                    # The flag was not reset, so we need to keep preempting 
-                    # (this will reset the current preempt)
-                    self._preempt_current_state()
-                else:
-                    # The flag was reset, so the container can reset
-                    smach.logwarn(
-                        "Preemption flag on preempted state '%s' was reset. Container can reset and continue..." % (
-                            self._preempted_label))
-                    smach.logwarn(
-                        "This could be errornous because state machine should preempt and we still continue. Most likely we will just preempt execution")
-                    self._preempt_requested = False
-                    self._preempted_state = None
-            else:
-                # We were preempted after the last state was running
-                # So we should preempt this state before we execute it
+    def _preempt_before_execute(self):
+        """Propagate a preempt that was requested before or while the last
+        state was running to the state that is about to be executed."""
+        smach.logwarn("Preempt requested on state machine before executing the next state.")
+        # We were preempted
+        if self._preempted_state is not None:
+            # We were preempted while the last state was running
+            if self._preempted_state.preempt_requested():
                 smach.logwarn(
-                    "State Machine preempted after the last state was running. Preempting state '%s' before executing..." % self._current_label)
+                    "Last state '%s' did not service preempt. Preempting next state '%s' before executing...",
+                    self._preempted_label, self._current_label)
+                # The flag was not reset, so we need to keep preempting 
+                # (this will reset the current preempt)
                 self._preempt_current_state()
-
-        # Execute the state
+            else:
+                # The flag was reset, so the container can reset
+                smach.logwarn(
+                    "Preemption flag on preempted state '%s' was reset. Container can reset and continue...",
+                    self._preempted_label)
+                smach.logwarn(
+                    "This could be errornous because state machine should preempt and we still continue. Most likely we will just preempt execution")
+                self._preempt_requested = False
+                self._preempted_state = None
+        else:
+            # We were preempted after the last state was running
+            # So we should preempt this state before we execute it
+            smach.logwarn(
+                "State Machine preempted after the last state was running. Preempting state '%s' before executing...",
+                self._current_label)
+            self._preempt_current_state()
+
+    def _current_remapper(self):
+        if self._current_index is not None:
+            remapper = self._dispatch.remappers[self._current_index]
+            if self._is_remapper_valid(remapper, self._current_state):
+                return remapper
+        return self._get_remapper(self._current_label)
+
+    def _execute_current_state(self):
+        """Execute the current state with the transitioning lock released."""
         try:
             self._state_transitioning_lock.release()
-            outcome = self._current_state.execute(
-                smach.Remapper(
-                    self.userdata,
-                    self._current_state.get_registered_input_keys(),
-                    self._current_state.get_registered_output_keys(),
-                    self._remappings[self._current_label]))
+            outcome = self._current_state.execute(self._current_remapper())
             self._current_outcome = outcome
         except smach.InvalidUserCodeError as ex:
-            smach.logerr("State '%s' failed to execute." % self._current_label)
+            smach.logerr("State '%s' failed to execute.", self._current_label)
             raise ex
         except:
             raise smach.InvalidUserCodeError("Could not execute state '%s' of type '%s': " %
@@ -271,7 +338,11 @@ class StateMachine(smach.container.Container):
                                              + traceback.format_exc())
         finally:
             self._state_transitioning_lock.acquire()
+        return outcome
 
+    def _check_outcome(self, outcome):
+        """Raise an L{InvalidTransitionError} if the outcome of the current
+        state cannot be dispatched."""
         # Check if outcome was a potential outcome for this type of state
         if outcome not in self._current_state.get_registered_outcomes():
             raise smach.InvalidTransitionError(
@@ -288,48 +359,102 @@ class StateMachine(smach.container.Container):
                 "Outcome '%s' of state '%s' is not bound to any transition target. Bound transitions include: %s" %
                 (str(outcome), str(self._current_label), str(self._current_transitions)))
 
-        # Set the transition target
-        transition_target = self._current_transitions[outcome]
+    def _update_once(self):
+        """Method that updates the state machine once.
+        This checks if the current state is ready to transition, if so, it
+        requests the outcome of the current state, and then extracts the next state
+        label from the current state's transition dictionary, and then transitions
+        to the next state.
+        """
+        self._prepare_update()
+
+        # Execute the state
+        outcome = self._execute_current_state()
+
+        return self._transition(outcome)
+
+    def _prepare_update(self):
+        """Check the current state and propagate pending preempts to it before
+        it is executed."""
+        # Make sure the state exists
+        if self._current_index is None and self._current_label not in self._states:
+            raise smach.InvalidStateError("State '%s' does not exist. Available states are: %s" %
+                                          (self._current_label, list(self._states.keys())))
+
+        # Check if a preempt was requested before or while the last state was running
+        if self.preempt_requested():
+            self._preempt_before_execute()
+
+    def _transition(self, outcome):
+        """Move to the state the outcome of the current state leads to.
+
+        @rtype: string
+        @return: The container outcome if this transition terminates the state
+        machine, None otherwise.
+        """
+        last_state_label = self._current_label
 
-        # Check if the transition target is a state in this state machine, or an outcome of this state machine
-        if not self._shutdown_requested and transition_target in self._states:
-            # Set the new state 
-            self._set_current_state(transition_target)
+        # With a compiled dispatch table, a single lookup validates the
+        # outcome and resolves its target. Outcomes that miss the table take
+        # the interpreted path, which raises the appropriate error.
+        target = None
+        if self._current_index is not None:
+            target = self._dispatch.targets[self._current_index].get(outcome)
+
+        if target is not None:
+            (next_index, transition_target, is_container_outcome) = target
+            is_state_transition = not self._shutdown_requested and next_index >= 0
+            if is_state_transition:
+                # Set the new state
+                self._set_current_index(next_index)
+                transition_target = self._current_label
+        else:
+            self._check_outcome(outcome)
+
+            # Set the transition target
+            transition_target = self._current_transitions[outcome]
+
+            # Check if the transition target is a state in this state machine, or an outcome of this state machine
+            is_state_transition = not self._shutdown_requested and transition_target in self._states
+            if is_state_transition:
+                # Set the new state 
+                self._set_current_state(transition_target)
+            else:
+                if transition_target not in self.get_registered_outcomes():
+                    # This is a container outcome that will fall through
+                    transition_target = outcome
+                is_container_outcome = transition_target in self.get_registered_outcomes()
 
+        if is_state_transition:
             # Spew some info
-            smach.loginfo("State machine transitioning '%s':'%s'-->'%s'" %
-                          (last_state_label, outcome, transition_target))
+            smach.loginfo("State machine transitioning '%s':'%s'-->'%s'",
+                          last_state_label, outcome, transition_target)
 
             # Call transition callbacks
             self.call_transition_cbs()
-        else:
-            # This is a terminal state
-
-            if self._preempt_requested and self._preempted_state is not None:
-                if not self._current_state.preempt_requested():
-                    self.service_preempt()
+            return None
 
-            if transition_target not in self.get_registered_outcomes():
-                # This is a container outcome that will fall through
-                transition_target = outcome
+        # This is a terminal state
+        if self._preempt_requested and self._preempted_state is not None:
+            if not self._current_state.preempt_requested():
+                self.service_preempt()
 
-            if transition_target in self.get_registered_outcomes() or self._shutdown_requested:
-                # The transition target is an outcome of the state machine
-                self._set_current_state(None)
+        if is_container_outcome or self._shutdown_requested:
+            # The transition target is an outcome of the state machine
+            self._set_current_state(None)
 
-                # Spew some info
-                smach.loginfo("State machine terminating '%s':'%s':'%s'" %
-                              (last_state_label, outcome, transition_target))
+            # Spew some info
+            smach.loginfo("State machine terminating '%s':'%s':'%s'",
+                          last_state_label, outcome, transition_target)
 
-                # Call termination callbacks
-                self.call_termination_cbs([last_state_label], transition_target)
+            # Call termination callbacks
+            self.call_termination_cbs([last_state_label], transition_target)
 
-                return transition_target
-            else:
-                raise smach.InvalidTransitionError(
-                    "Outcome '%s' of state '%s' with transition target '%s' is neither a registered state nor a registered container outcome." %
-                    (outcome, self._current_label, transition_target))
-        return None
+            return transition_target
+        else:
+            raise smach.InvalidTransitionError(
+                "Outcome '%s' of state '%s' with transition target '%s' is neither a registered state nor a registered container outcome." %
+                (outcome, self._current_label, transition_target))
 
     ### State Interface
     def execute(self, parent_ud=smach.UserData()):
@@ -341,57 +466,83 @@ class StateMachine(smach.container.Container):
 
         # This will prevent preempts from getting propagated to non-existent children
         with self._state_transitioning_lock:
-            # Check state consistency
-            try:
-                self.check_consistency()
-            except (smach.InvalidStateError, smach.InvalidTransitionError):
-                smach.logerr("Container consistency check failed.")
+            if not self._start_execution(parent_ud):
                 return None
 
-            # Set running flag
-            self._is_running = True
+            # Initialize container outcome
+            container_outcome = None
+
+            # Step through state machine
+            while container_outcome is None and self._is_running and not smach.is_shutdown():
+                # Update the state machine
+                container_outcome = self._update_once()
+
+            self._finish_execution(parent_ud)
 
-            # Initialize preempt state
-            self._preempted_label = None
-            self._preempted_state = None
+        return container_outcome
 
-            # Set initial state 
-            self._set_current_state(self._initial_state_label)
+    def _start_execution(self, parent_ud):
+        """Prepare the state machine to run from its initial state.
+        This must be called with the transitioning lock held.
 
-            # Copy input keys
-            self._copy_input_keys(parent_ud, self.userdata)
+        @rtype: bool
+        @return: False if the state machine is inconsistent and cannot run.
+        """
+        # Check state consistency (this is cached until the structure changes)
+        try:
+            self._check_consistency_cached()
+        except (smach.InvalidStateError, smach.InvalidTransitionError):
+            smach.logerr("Container consistency check failed.")
+            return False
 
-            # Spew some info
-            smach.loginfo("State machine starting in initial state '%s' with userdata: \n\t%s" %
-                          (self._current_label, list(self.userdata.keys())))
+        # Compile the dispatch table if the graph changed since it was built
+        if self._compiled and self._dispatch is None:
+            self._compile()
 
-            if self._preempt_requested:
-                smach.logwarn(
-                    "Preempt on State machine requested before even executing initial state. This could be a bug. Did last execution not service preemption?")
+        # Set running flag
+        self._is_running = True
 
-            # Call start callbacks
-            self.call_start_cbs()
+        # Initialize preempt state
+        self._preempted_label = None
+        self._preempted_state = None
 
-            # Initialize container outcome
-            container_outcome = None
+        # Set initial state 
+        self._set_current_state(self._initial_state_label)
 
-            # Step through state machine
-            while container_outcome is None and self._is_running and not smach.is_shutdown():
-                # Update the state machine
-                container_outcome = self._update_once()
+        # Copy input keys
+        self._copy_input_keys(parent_ud, self.userdata)
 
-            # Copy output keys
-            self._copy_output_keys(self.userdata, parent_ud)
+        # Spew some info
+        smach.loginfo("State machine starting in initial state '%s' with userdata: \n\t%s",
+                      self._current_label, self.userdata.keys())
 
-            # We're no longer running
-            self._is_running = False
+        if self._preempt_requested:
+            smach.logwarn(
+                "Preempt on State machine requested before even executing initial state. This could be a bug. Did last execution not service preemption?")
 
-            if self._preempt_requested:
-                smach.logwarn(
-                    "State machine about to return outcome even preemption requested and not served. Will service preemption")
-                self.service_preempt()
+        # Call start callbacks
+        self.call_start_cbs()
+        return True
 
-        return container_outcome
+    def _finish_execution(self, parent_ud):
+        """Clean up after the state machine terminated.
+        This must be called with the transitioning lock held."""
+        # Copy output keys
+        self._copy_output_keys(self.userdata, parent_ud)
+
+        # We're no longer running
+        self._is_running = False
+
+        if self._preempt_requested:
+            smach.logwarn(
+                "State machine about to return outcome even preemption requested and not served. Will service preemption")
+            self.service_preempt()
+
+    def close(self):
+        """Close the state machine and compile its dispatch table."""
+        smach.container.Container.close(self)
+        if self._compiled:
+            self._compile()
 
     ## Preemption management
     def request_preempt(self):
@@ -447,8 +598,10 @@ class StateMachine(smach.container.Container):
                           " have one initial state. Taking the first one.")
 
         # Set the initial state label
-        if len(initial_states) > 0:
+        if len(initial_states) > 0 and initial_states[0] != self._initial_state_label:
             self._initial_state_label = initial_states[0]
+            # The new initial state needs to be validated
+            self._consistent_version = None
         # Set local userdata
         self.userdata.update(userdata)
 
@@ -1,31 +1,235 @@
-import threading
 import copy
+import sys
+import threading
 
 import smach
 
-__all__ = ['UserData', 'Remapper']
+__all__ = ['UserData', 'UserDataSnapshot', 'CompactUserData', 'UserDataLayout', 'Remapper']
+
+# Marker for keys that are not found up a chain of scopes
+_NOT_INHERITED = object()
 
 
 class UserData(object):
-    """SMACH user data structure."""
+    """SMACH user data structure.
+
+    The data is copy-on-write: every write publishes a new immutable version
+    of the structure, as a L{UserDataSnapshot}. Readers only dereference the
+    current snapshot, so they never take a lock and never see a write half
+    applied, and L{snapshot} hands out a consistent view of the data in
+    constant time. Writes are serialized and copy the key dictionaries, which
+    makes them linear in the number of keys.
+
+    Every write also stamps the written keys with the new version, so the
+    keys that changed since a given version can be retrieved without
+    comparing values (see L{get_changes}).
+    """
 
     def __init__(self):
-        self._data = {}
-        self._locks = {}
+        self._snapshot = UserDataSnapshot(self._new_map(), self._new_map(), 0)
+        self._write_lock = threading.Lock()
+        # Enclosing scope of a chained structure (see L{_chain}), and the
+        # resolved storage of the inherited keys
+        self._parent = None
+        self._inherited = frozenset()
+        self._entry_version = 0
+        self._resolved_chains = {}
+        # Incremented whenever the keys this structure reads through its
+        # enclosing scope change
+        self._chain_epoch = 0
+        # Read-only views of the values of keys, dropped when the key is
+        # written
+        self._const_views = {}
         self.__initialized = True
 
+    def _chain(self, parent, keys):
+        """Resolve reads of some keys through an enclosing scope.
+
+        Until a chained key is written in this structure, reading it reads the
+        current value of the key in C{parent} by reference. This replaces
+        copying the keys from C{parent} when a container is entered: values
+        written before this call no longer shadow the parent's values, as if
+        the parent's values had been copied in.
+
+        @type parent: L{UserData} or L{Remapper}
+        @param parent: The enclosing scope.
+
+        @type keys: set of str
+        @param keys: The keys resolved through C{parent}.
+
+        The enclosing scope may itself be chained, so a key can be inherited
+        through several levels of remappers and scopes. Rather than walking
+        these levels on every read, the structure the key is ultimately
+        stored in is resolved on the first read and cached, until the chain
+        changes: when a structure along it is chained again, or writes a key
+        it inherits. Each structure counts these changes in its own epoch,
+        and the cached resolution is checked against the epochs of the
+        structures along the chain.
+        """
+        with self._write_lock:
+            self._parent = parent
+            self._inherited = keys
+            self._entry_version = self._snapshot._version
+            self._resolved_chains = {}
+            self._chain_epoch += 1
+
+    def _resolve_chain(self, key):
+        """Follow an inherited key through the enclosing scopes.
+
+        @rtype: tuple
+        @return: The structure storing the key, the key in that structure,
+        whether a remapper on the way makes it read-only, and the structures
+        along the chain with their epochs. None if the key is not inherited
+        or not stored anywhere up the chain.
+        """
+        ud = self
+        const = False
+        epochs = []
+        while True:
+            epochs.append((ud, ud._chain_epoch))
+            parent = ud._parent
+            if (parent is None or key not in ud._inherited
+                    or ud._snapshot._versions.get(key, 0) > ud._entry_version):
+                break
+            while isinstance(parent, Remapper):
+                if key not in parent._input:
+                    return None
+                const = const or key in parent._const
+                key = parent._resolved[key]
+                parent = parent._ud
+            if not isinstance(parent, UserData):
+                return None
+            ud = parent
+        if ud is self or key not in ud._snapshot._data:
+            return None
+        return (ud, key, const, tuple(epochs))
+
+    def _read_inherited(self, key, const=False):
+        """Read an inherited key from the structure it is stored in, or
+        return C{_NOT_INHERITED}. If C{const} is set, or a remapper on the
+        way makes the key read-only, the value is read through its
+        read-only view."""
+        entry = self._resolved_chains.get(key)
+        if entry is None or not all(ud._chain_epoch == epoch for (ud, epoch) in entry[0]):
+            resolved = self._resolve_chain(key)
+            if resolved is None:
+                return _NOT_INHERITED
+            # Epochs along the chain, storage, key in the storage and
+            # read-only
+            entry = [resolved[3], resolved[0], resolved[1], resolved[2]]
+            self._resolved_chains[key] = entry
+        try:
+            value = entry[1]._snapshot._data[entry[2]]
+        except KeyError:
+            # The storage was replaced
+            return _NOT_INHERITED
+        if not (const or entry[3]):
+            return value
+        return entry[1]._get_const_view(entry[2], value)
+
+    def _read_const(self, key):
+        """Read a key through its read-only view (see L{get_const}).
+
+        The view is cached in the structure that stores the key, until the
+        key is written, so repeated reads reuse it and the views of the fields
+        read through it.
+        """
+        if self._parent is not None and key in self._inherited:
+            view = self._read_inherited(key, True)
+            if view is not _NOT_INHERITED:
+                return view
+        return self._get_const_view(key, self._snapshot[key])
+
+    def _get_const_view(self, key, value):
+        """Get the cached read-only view of the value of a key."""
+        cached = self._const_views.get(key)
+        if cached is not None and cached[0] is value:
+            return cached[1]
+        view = get_const(value)
+        if view is not value:
+            with self._write_lock:
+                # Do not keep a value the key no longer holds
+                if self._snapshot._data.get(key, _NOT_INHERITED) is value:
+                    self._const_views[key] = (value, view)
+        return view
+
+    @property
+    def _data(self):
+        return self._snapshot._data
+
+    @_data.setter
+    def _data(self, data):
+        """Replace all keys."""
+        with self._write_lock:
+            if self._parent is not None:
+                self._chain_epoch += 1
+            version = self._snapshot._version + 1
+            self._snapshot = UserDataSnapshot(
+                self._new_map(data), self._new_map((k, version) for k in data), version)
+            self._const_views = {}
+
+    def _new_map(self, items=()):
+        """Create the mapping a snapshot stores keys in."""
+        return dict(items)
+
     def update(self, other_userdata):
         """Combine this userdata struct with another.
         This overwrites duplicate keys with values from C{other_userdata}.
         """
-        # Merge data
-        self._data.update(other_userdata._data)
+        self._write(other_userdata._data)
+
+    def _set(self, key, value):
+        self._write({key: value})
+
+    def _write(self, items):
+        """Publish a new version with the given keys written."""
+        with self._write_lock:
+            snapshot = self._snapshot
+            version = snapshot._version + 1
+            data = snapshot._data.copy()
+            data.update(items)
+            versions = snapshot._versions.copy()
+            for key in items:
+                versions[key] = version
+            if self._parent is not None and not self._inherited.isdisjoint(items):
+                # Keys written here are no longer read from the enclosing scope
+                self._chain_epoch += 1
+            if self._const_views:
+                for key in items:
+                    self._const_views.pop(key, None)
+            self._snapshot = UserDataSnapshot(data, versions, version)
+
+    def snapshot(self):
+        """Get a read-only view of the current version of this structure.
+        The view is not affected by later writes. It only holds the keys
+        stored in this structure, not those read through an enclosing scope.
+
+        @rtype: L{UserDataSnapshot}
+        """
+        return self._snapshot
+
+    def get_version(self):
+        """Get the version of this structure, which increases on every write."""
+        return self._snapshot._version
+
+    def get_changes(self, since=0):
+        """Get the keys that were written after a given version.
+
+        @type since: int
+        @param since: A version previously returned by this method or by
+        L{get_version}. For 0, all keys are returned.
+
+        @rtype: tuple
+        @return: The current version and a dict holding the keys written after
+        version C{since}, with their values.
+        """
+        return self._snapshot.get_changes(since)
 
     def extract(self, keys, remapping):
         ud = UserData()
         reverse_remapping = {remapping[k]: k for k in remapping}
         if len(reverse_remapping) != len(remapping):
-            smach.logerr("SMACH userdata remapping is not one-to-one: " + str(remapping))
+            smach.logerr("SMACH userdata remapping is not one-to-one: %s", remapping)
         for k in keys:
             rmk = k
             if k in reverse_remapping:
@@ -41,56 +245,220 @@ class UserData(object):
             self[rmk] = copy.copy(ud[k])
 
     def __getitem__(self, key):
-        return self.__getattr__(key)
+        if self._parent is not None and key in self._inherited:
+            value = self._read_inherited(key)
+            if value is not _NOT_INHERITED:
+                return value
+        # Errors report the key under the name used in this scope
+        return self._snapshot[key]
 
     def __setitem__(self, key, item):
-        self._data[key] = item
+        self._set(key, item)
 
     def keys(self):
-        return list(self._data.keys())
+        snapshot = self._snapshot
+        keys = snapshot.keys()
+        if self._parent is not None:
+            keys += [k for k in self._inherited if k not in snapshot._data and k in self._parent]
+        return keys
 
     def __contains__(self, key):
-        return key in self._data
+        if key in self._snapshot._data:
+            return True
+        return self._parent is not None and key in self._inherited and key in self._parent
 
     def __getattr__(self, name):
-        """Override getattr to be thread safe."""
+        """Override getattr to read from the current version."""
         if name[0] == '_':
             return object.__getattr__(self, name)
-        if name not in self._locks.keys():
-            self._locks[name] = threading.Lock()
+        return self[name]
+
+    def __setattr__(self, name, value):
+        """Override setattr to write a new version."""
+        # If we're still in __init__ don't do anything special
+        if name[0] == '_' or '_UserData__initialized' not in self.__dict__:
+            return object.__setattr__(self, name, value)
+        self._set(name, value)
 
+
+class UserDataSnapshot(object):
+    """Immutable version of a L{UserData} structure.
+
+    Snapshots provide the read interface of L{UserData}. They are passed to
+    termination callbacks, and introspection reads userdata through them.
+    """
+
+    __slots__ = ['_data', '_versions', '_version']
+
+    def __init__(self, data, versions, version):
+        object.__setattr__(self, '_data', data)
+        object.__setattr__(self, '_versions', versions)
+        object.__setattr__(self, '_version', version)
+
+    def snapshot(self):
+        return self
+
+    def get_version(self):
+        """Get the version of the structure this is a snapshot of."""
+        return self._version
+
+    def get_changes(self, since=0):
+        """See L{UserData.get_changes}."""
+        if since <= 0:
+            return (self._version, dict(self._data))
+        versions = self._versions
+        return (self._version,
+                dict((k, v) for (k, v) in self._data.items() if versions[k] > since))
+
+    def __getitem__(self, key):
         try:
-            with self._locks[name]:
-                temp = self._data[name]
-        except:
+            return self._data[key]
+        except KeyError:
             smach.logerr(
-                "Userdata key '%s' not available. Available keys are: %s" % (name, str(list(self._data.keys()))))
+                "Userdata key '%s' not available. Available keys are: %s", key, list(self._data.keys()))
             raise KeyError()
 
-        return temp
+    def keys(self):
+        return list(self._data.keys())
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getattr__(self, name):
+        if name[0] == '_':
+            raise AttributeError(name)
+        return self[name]
 
     def __setattr__(self, name, value):
-        """Override setattr to be thread safe."""
-        # If we're still in __init__ don't do anything special
-        if name[0] == '_' or '_UserData__initialized' not in self.__dict__:
-            return object.__setattr__(self, name, value)
+        smach.logerr("Attempting to set '%s' but userdata snapshots are read-only.", name)
+        raise TypeError()
+
+    def __setitem__(self, key, value):
+        self.__setattr__(key, value)
 
-        if not name in self._locks.keys():
-            self._locks[name] = threading.Lock()
 
-        self._locks[name].acquire()
-        self._data[name] = value
-        self._locks[name].release()
+class UserDataLayout(object):
+    """Assignment of userdata keys to integer slots."""
+
+    def __init__(self, keys):
+        self.keys = tuple(sorted(set(keys)))
+        self.index = dict((key, slot) for (slot, key) in enumerate(self.keys))
+
+
+# Value of slots whose key is not set
+_UNSET = object()
+
+
+class SlotDict(object):
+    """Mapping that stores the keys of a L{UserDataLayout} in a list indexed
+    by slot, and any other keys in a dict."""
+
+    __slots__ = ['_layout', '_values', '_extra']
+
+    def __init__(self, layout, values=None, extra=None):
+        self._layout = layout
+        self._values = values if values is not None else [_UNSET] * len(layout.keys)
+        self._extra = extra if extra is not None else {}
+
+    def copy(self):
+        return SlotDict(self._layout, list(self._values), dict(self._extra))
+
+    def update(self, items):
+        if hasattr(items, 'keys'):
+            items = [(k, items[k]) for k in items.keys()]
+        for (key, value) in items:
+            self[key] = value
+
+    def __getitem__(self, key):
+        slot = self._layout.index.get(key)
+        if slot is None:
+            return self._extra[key]
+        value = self._values[slot]
+        if value is _UNSET:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        slot = self._layout.index.get(key)
+        if slot is None:
+            self._extra[key] = value
+        else:
+            self._values[slot] = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        slot = self._layout.index.get(key)
+        if slot is None:
+            return key in self._extra
+        return self._values[slot] is not _UNSET
+
+    def __iter__(self):
+        for (key, value) in zip(self._layout.keys, self._values):
+            if value is not _UNSET:
+                yield key
+        for key in self._extra:
+            yield key
+
+    def __len__(self):
+        return len(self._values) - self._values.count(_UNSET) + len(self._extra)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+
+class CompactUserData(UserData):
+    """User data structure with a fixed layout of keys.
+
+    The keys of the layout are given integer slots, and their values and
+    versions are stored in lists rather than dicts, which takes less memory
+    and lets a L{Remapper} read declared keys by slot. Keys outside the
+    layout are stored in a dict. Containers use this structure when
+    L{Container.set_compact_userdata} is enabled, with the keys their
+    children and they themselves declare as the layout.
+    """
+
+    def __init__(self, layout):
+        """Constructor.
+
+        @type layout: L{UserDataLayout}
+        """
+        self._layout = layout
+        UserData.__init__(self)
+
+    def _new_map(self, items=()):
+        data = SlotDict(self._layout)
+        data.update(items)
+        return data
 
 
 # Const wrapper
 def get_const(obj):
-    """Get a const reference to an object if it has "user-defined" attributes."""
+    """Get a read-only view of an object.
+
+    Objects with "user-defined" attributes are wrapped in a L{Const} proxy.
+    NumPy arrays and memoryviews are returned as native views that cannot be
+    written to, without copying the data. Other objects are returned as is.
+    """
+    numpy = sys.modules.get('numpy')
+    if numpy is not None and isinstance(obj, numpy.ndarray):
+        if not obj.flags.writeable:
+            return obj
+        view = obj.view()
+        view.flags.writeable = False
+        return view
     if hasattr(obj, '__dict__'):
-        smach.logdebug("Making const '%s'" % str(obj))
         return Const(obj)
-    else:
-        return obj
+    if isinstance(obj, memoryview) and not obj.readonly and hasattr(obj, 'toreadonly'):
+        return obj.toreadonly()
+    return obj
 
 
 class Const(object):
@@ -98,55 +466,113 @@ class Const(object):
     
     This wrapper class is used when user data keys are specified as input keys,
     but not as output keys.
+
+    The views of the attributes and items read through the wrapper are cached
+    for as long as the wrapped object holds the same values, so repeated
+    reads of nested fields do not build new wrappers.
     """
 
+    __slots__ = ['_obj', '_views']
+
     def __init__(self, obj):
-        smach.logdebug("Making const '%s'" % str(obj))
-        self._obj = obj
-        self.__initialized = True
+        object.__setattr__(self, '_obj', obj)
+        object.__setattr__(self, '_views', {})
+
+    def _get_view(self, key, value):
+        """Get the cached view of a value, or create one."""
+        try:
+            cached = self._views.get(key)
+        except TypeError:
+            # Unhashable item key
+            return get_const(value)
+        if cached is not None and cached[0] is value:
+            return cached[1]
+        view = get_const(value)
+        if view is not value:
+            self._views[key] = (value, view)
+        return view
 
     def __getattr__(self, name):
-        smach.logdebug("Getting '%s' from const wrapper." % name)
-        attr = getattr(self._obj, name)
-        return get_const(attr)
+        return self._get_view(name, getattr(self._obj, name))
 
     def __getitem__(self, name):
-        smach.logdebug("Getting '%s' from const wrapper." % name)
-        attr = self._obj[name]
-        return get_const(attr)
+        # Items are cached under a tuple, so they never clash with attributes
+        return self._get_view((name,), self._obj[name])
 
     def __setattr__(self, name, value):
-        if '_const__initialized' not in self.__dict__:
-            return object.__setattr__(self, name, value)
-        smach.logerr("Attempting to set '%s' but this member is read-only." % name)
+        smach.logerr("Attempting to set '%s' but this member is read-only.", name)
         raise TypeError()
 
     def __delattr__(self, name):
-        smach.logerr("Attempting to delete '%s' but this member is read-only." % name)
+        smach.logerr("Attempting to delete '%s' but this member is read-only.", name)
         raise TypeError()
 
 
 class Remapper(object):
-    """Key-remapping proxy to a SMACH userdata structure."""
+    """Key-remapping proxy to a SMACH userdata structure.
+
+    The declared input and output keys are stored as frozensets and the
+    remapping of every declared key is resolved once on construction, so a
+    remapper can be built once per child state and reused for every
+    execution.
+    """
+
+    def __init__(self, ud, input_keys=None, output_keys=None, remapping=None, const_inputs=True):
+        """Constructor.
 
-    def __init__(self, ud, input_keys=None, output_keys=None, remapping=None):
+        @type const_inputs: bool
+        @param const_inputs: If True, values of input keys that are not also
+        output keys are returned as read-only views (see L{get_const}).
+        """
         if input_keys is None:
             input_keys = []
         if output_keys is None:
             output_keys = []
-        if remapping is None:
+        if not remapping:
             remapping = {}
         self._ud = ud
-        self._input = input_keys
-        self._output = output_keys
+        self._input = frozenset(input_keys)
+        self._output = frozenset(output_keys)
         self._map = remapping
+        # Resolved key in the underlying userdata for every declared key
+        self._resolved = dict((k, remapping.get(k, k)) for k in self._input | self._output)
+        # Keys read through read-only views
+        self._const = (self._input - self._output) if const_inputs else frozenset()
+        # Slots of the declared keys in a compact userdata structure
+        if isinstance(ud, CompactUserData):
+            index = ud._layout.index
+            self._slots = dict((k, index[r]) for (k, r) in self._resolved.items() if r in index)
+            self._get = self._get_slot
         self.__initialized = True
 
+    def _get(self, key):
+        return self._ud[self._resolved[key]]
+
+    def _get_slot(self, key):
+        ud = self._ud
+        slot = self._slots.get(key)
+        if slot is None or ud._parent is not None:
+            return ud[self._resolved[key]]
+        value = ud._snapshot._data._values[slot]
+        if value is _UNSET:
+            # Report the missing key
+            return ud[self._resolved[key]]
+        return value
+
+    def _read(self, key):
+        if key not in self._const:
+            return self._get(key)
+        if isinstance(self._ud, UserData):
+            # The view is cached along with the value
+            return self._ud._read_const(self._resolved[key])
+        return get_const(self._get(key))
+
     def _remap(self, key):
         """Return either the key or it's remapped value."""
-        if key in self._map:
-            return self._map[key]
-        return key
+        try:
+            return self._resolved[key]
+        except KeyError:
+            return self._map.get(key, key)
 
     def update(self, other_userdata):
         self._ud.update(other_userdata)
@@ -155,25 +581,23 @@ class Remapper(object):
         if key not in self._input:
             raise smach.InvalidUserCodeError(
                 "Reading from SMACH userdata key '%s' but the only keys that were declared as input to this state were: %s. This key needs to be declaread as input to this state. " % (
-                key, self._input))
-        if key not in self._output:
-            return get_const(self._ud.__getitem__(self._remap(key)))
-        return self._ud.__getitem__(self._remap(key))
+                key, list(self._input)))
+        return self._read(key)
 
     def __setitem__(self, key, item):
         if key not in self._output:
             smach.logerr(
-                "Writing to SMACH userdata key '%s' but the only keys that were declared as output from this state were: %s." % (
-                key, self._output))
+                "Writing to SMACH userdata key '%s' but the only keys that were declared as output from this state were: %s.",
+                key, list(self._output))
             return
-        self._ud.__setitem__(self._remap(key), item)
+        self._ud.__setitem__(self._resolved[key], item)
 
     def keys(self):
         return [self._remap(key) for key in self._ud.keys() if key in self._input]
 
     def __contains__(self, key):
         if key in self._input:
-            return self._remap(key) in self._ud
+            return self._resolved[key] in self._ud
         else:
             return False
 
@@ -183,17 +607,15 @@ class Remapper(object):
         if name not in self._input:
             raise smach.InvalidUserCodeError(
                 "Reading from SMACH userdata key '%s' but the only keys that were declared as input to this state were: %s. This key needs to be declaread as input to this state. " % (
-                name, self._input))
-        if name not in self._output:
-            return get_const(getattr(self._ud, self._remap(name)))
-        return getattr(self._ud, self._remap(name))
+                name, list(self._input)))
+        return self._read(name)
 
     def __setattr__(self, name, value):
         if name[0] == '_' or '_Remapper__initialized' not in self.__dict__:
             return object.__setattr__(self, name, value)
         if name not in self._output:
             smach.logerr(
-                "Writing to SMACH userdata key '%s' but the only keys that were declared as output from this state were: %s." % (
-                name, self._output))
+                "Writing to SMACH userdata key '%s' but the only keys that were declared as output from this state were: %s.",
+                name, list(self._output))
             return None
-        setattr(self._ud, self._remap(name), value)
+        setattr(self._ud, self._resolved[name], value)
@@ -32,33 +32,32 @@ import smach
 
 __all__ = ['set_preempt_handler',
            'start',
+           'RosLogSink',
            'ActionServerWrapper',
            'IntrospectionClient',
            'IntrospectionServer',
            'SimpleActionState',
+           'MultiGoalActionState',
            'ServiceState',
            'MonitorState',
            'ConditionState']
 
+### Core classes
+from smach_ros.util import set_preempt_handler, start, RosLogSink
+
 # Setup smach-ros interface
-smach.set_loggers(
-        rospy.loginfo,
-        rospy.logwarn,
-        rospy.logdebug,
-        rospy.logerr)
+smach.set_loggers(RosLogSink())
 
 smach.set_shutdown_check(rospy.is_shutdown)
 smach.set_shutdown_handler(rospy.on_shutdown)
 
-### Core classes
-from smach_ros.util import set_preempt_handler, start
-
 ### Top-level Containers / Wrappers
 from smach_ros.action_server_wrapper import ActionServerWrapper
 from smach_ros.introspection import IntrospectionClient, IntrospectionServer
 
 ### State Classes
 from smach_ros.simple_action_state import SimpleActionState
+from smach_ros.multi_goal_action_state import MultiGoalActionState
 from smach_ros.service_state import ServiceState
 from smach_ros.monitor_state import MonitorState
 from smach_ros.condition_state import ConditionState
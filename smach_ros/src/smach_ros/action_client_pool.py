@@ -0,0 +1,169 @@
+import rospy
+
+import threading
+
+from actionlib.action_client import ActionClient
+
+__all__ = ['SharedActionClient', 'acquire_action_client', 'release_action_client']
+
+
+class SharedActionClient(object):
+    """Action client shared by all states of a process using one action server.
+
+    This wraps a single C{actionlib.ActionClient}, so the states share its
+    publishers and subscribers. Every goal is tracked through its own goal
+    handle, and the callbacks of a goal are only called for that goal, so
+    any number of states, and any number of goals, can use the client at the
+    same time.
+
+    A single thread per client waits for the action server to come up,
+    whatever the number of states waiting on it.
+
+    Shared clients are obtained with L{acquire_action_client} and given back
+    with L{release_action_client}.
+    """
+
+    def __init__(self, action_name, action_spec):
+        self.action_name = action_name
+        self.action_spec = action_spec
+        self._client = ActionClient(action_name, action_spec)
+        self._refcount = 0
+
+        # Set once the action server is connected
+        self._connected = threading.Event()
+        self._wait_thread = None
+        self._lock = threading.Lock()
+
+    def send_goal(self, goal, transition_cb=None, feedback_cb=None):
+        """Send a goal to the action server.
+
+        @type transition_cb: callable
+        @param transition_cb: Called with the goal handle whenever the
+        communication state of the goal changes.
+
+        @type feedback_cb: callable
+        @param feedback_cb: Called with the goal handle and the feedback
+        message whenever feedback is received for the goal.
+
+        @rtype: C{actionlib.ClientGoalHandle}
+        @return: The handle of the goal. The goal is only tracked as long as
+        the handle is referenced.
+        """
+        return self._client.send_goal(goal, transition_cb, feedback_cb)
+
+    def is_connected(self):
+        """Check whether the action server has been connected."""
+        return self._connected.is_set()
+
+    def start_waiting(self):
+        """Start waiting for the action server in the background, unless it
+        is connected or already being waited for."""
+        with self._lock:
+            if self._connected.is_set() or (self._wait_thread is not None and self._wait_thread.is_alive()):
+                return
+            self._wait_thread = threading.Thread(name=self.action_name + '/wait_for_server',
+                                                 target=self._wait_for_server)
+            self._wait_thread.daemon = True
+            self._wait_thread.start()
+
+    def _wait_for_server(self):
+        while not rospy.is_shutdown() and self._refcount > 0:
+            try:
+                if self._client.wait_for_server(rospy.Duration(1.0)):
+                    self._connected.set()
+                    return
+            except:
+                if not rospy.core._in_shutdown:  # This is a hack, wait_for_server should not throw an exception just because shutdown was called
+                    rospy.logerr("Failed to wait for action server '%s'" % (self.action_name))
+
+    def wait_for_server(self, timeout=None, abort_cb=None):
+        """Wait for the action server to be connected.
+
+        @type timeout: C{rospy.Duration}
+        @param timeout: The time to wait at most, or None to wait until the
+        server is connected.
+
+        @type abort_cb: callable
+        @param abort_cb: Polled while waiting; waiting stops as soon as it
+        returns True.
+
+        @rtype: bool
+        @return: True if the action server is connected.
+        """
+        self.start_waiting()
+        deadline = None
+        if timeout is not None:
+            deadline = rospy.get_rostime() + timeout
+        while not self._connected.is_set():
+            if rospy.is_shutdown() or (abort_cb is not None and abort_cb()):
+                return False
+            if deadline is not None and rospy.get_rostime() >= deadline:
+                return False
+            self._connected.wait(0.1)
+        return True
+
+    def check_server(self, timeout):
+        """Check that the connected action server is still available. If it
+        is not, the client goes back to waiting for it.
+
+        @type timeout: C{rospy.Duration}
+
+        @rtype: bool
+        """
+        if self._client.wait_for_server(timeout):
+            return True
+        self._connected.clear()
+        self.start_waiting()
+        return False
+
+    def _shutdown(self):
+        """Stop the topics of the client."""
+        for name in ('pub_goal', 'pub_cancel', 'status_sub', 'result_sub', 'feedback_sub'):
+            topic = getattr(self._client, name, None)
+            if topic is not None:
+                topic.unregister()
+
+
+# Shared clients keyed on resolved action name and action type
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def acquire_action_client(action_name, action_spec):
+    """Get the shared client of an action server, creating it on first use.
+    Every call must be matched by a call to L{release_action_client}.
+
+    @type action_name: string
+    @param action_name: The name of the action. Relative names are resolved
+    in the namespace of the node.
+
+    @type action_spec: actionlib action msg
+    @param action_spec: The type of the action.
+
+    @rtype: L{SharedActionClient}
+    """
+    key = (rospy.resolve_name(action_name), action_spec)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = SharedActionClient(key[0], action_spec)
+            _clients[key] = client
+        client._refcount += 1
+    client.start_waiting()
+    return client
+
+
+def release_action_client(client):
+    """Give back a client obtained with L{acquire_action_client}. The client
+    is shut down once it is no longer used.
+
+    @type client: L{SharedActionClient}
+    """
+    with _clients_lock:
+        client._refcount -= 1
+        if client._refcount > 0:
+            return
+        key = (client.action_name, client.action_spec)
+        if _clients.get(key) is client:
+            del _clients[key]
+    client._shutdown()
@@ -116,6 +116,10 @@ class ActionServerWrapper(object):
         self._expand_goal_slots = expand_goal_slots
         self._pack_result_slots = pack_result_slots
 
+        # Remapper through which the wrapped container accesses the userdata,
+        # built on the first goal and reused for every goal after that
+        self._container_remapper = None
+
         # Store goal, result, and feedback types
         self.userdata[self._goal_key] = copy.copy(action_spec().action_goal.goal)
         self.userdata[self._result_key] = copy.copy(action_spec().action_result.result)
@@ -194,6 +198,23 @@ class ActionServerWrapper(object):
             # TODO figure out what the hell is going on here.
             self._action_server.publish_feedback(userdata[self._feedback_key])
 
+    def _get_container_remapper(self):
+        """Get the remapper through which the wrapped container accesses this
+        wrapper's userdata."""
+        remapper = self._container_remapper
+        container = self.wrapped_container
+        if (remapper is None or remapper._ud is not self.userdata
+                or remapper._keys_version != container._keys_version):
+            remapper = smach.Remapper(
+                self.userdata,
+                container.get_registered_input_keys(),
+                container.get_registered_output_keys(),
+                {})
+            # Rebuilt whenever the wrapped container registers more keys
+            remapper._keys_version = container._keys_version
+            self._container_remapper = remapper
+        return remapper
+
     ### Action server callbacks
     def execute_cb(self, goal):
         """Action server goal callback
@@ -223,12 +244,7 @@ class ActionServerWrapper(object):
 
         # Run the state machine (this blocks)
         try:
-            container_outcome = self.wrapped_container.execute(
-                smach.Remapper(
-                    self.userdata,
-                    self.wrapped_container.get_registered_input_keys(),
-                    self.wrapped_container.get_registered_output_keys(),
-                    {}))
+            container_outcome = self.wrapped_container.execute(self._get_container_remapper())
 
         except smach.InvalidUserCodeError as ex:
             rospy.logerr("Exception thrown while executing wrapped container.")
@@ -0,0 +1,312 @@
+"""Codecs for the userdata carried by SMACH introspection messages.
+
+The userdata of a container is sent in the C{local_data} field of the status
+and initial state messages, and the C{local_data_codec} field names the codec
+that encoded it. A codec name is the name of a registered L{Codec}, optionally
+followed by the names of the compressions applied to the encoded data, e.g.
+C{'genpy+zlib'}. The empty name denotes the legacy encoding (pickle protocol
+2), so messages from servers and clients that predate codecs still decode.
+
+The pickle based codecs must only be accepted from trusted peers. The C{json}
+codec does not execute code on decoding, so it can be accepted from anyone.
+"""
+
+import base64
+import json
+import pickle
+import struct
+import zlib
+
+import six
+
+import genpy
+import roslib.message
+
+__all__ = ['Codec', 'register_codec', 'get_codec', 'get_codec_names',
+           'register_compression', 'encode_local_data', 'decode_local_data',
+           'LEGACY_CODEC']
+
+# Name of the legacy codec
+LEGACY_CODEC = ''
+
+
+def compatible_decode(dump):
+    """Convert encoded bytes to the type of a ROS string field."""
+    if six.PY2:
+        return dump
+    return dump.decode('latin1')
+
+
+def compatible_encode(load):
+    """Convert a ROS string field back to encoded bytes."""
+    if six.PY2:
+        return load
+    return load.encode('latin1')
+
+
+class Codec(object):
+    """Encoding of a userdata dictionary to bytes."""
+
+    # Name of the codec in the local_data_codec field
+    name = None
+
+    def encode(self, data):
+        """Encode a userdata dictionary.
+
+        @type data: dict
+        @rtype: bytes
+        """
+        raise NotImplementedError()
+
+    def decode(self, payload):
+        """Decode a userdata dictionary.
+
+        @type payload: bytes
+        @rtype: dict
+        """
+        raise NotImplementedError()
+
+
+class PickleCodec(Codec):
+    """Pickle with a fixed protocol. Protocol 2 is the legacy encoding."""
+
+    def __init__(self, name, protocol):
+        self.name = name
+        self._protocol = protocol
+
+    def encode(self, data):
+        return pickle.dumps(data, self._protocol)
+
+    def decode(self, payload):
+        return pickle.loads(payload)
+
+
+class OutOfBandPickleCodec(Codec):
+    """Pickle protocol 5, with large buffers (e.g. of numpy arrays) stored
+    after the pickle stream instead of being copied into it.
+
+    The payload is the number of buffers, the length of the pickle stream and
+    of each buffer, followed by the stream and the buffers.
+    """
+
+    name = 'pickle5'
+
+    def encode(self, data):
+        buffers = []
+        stream = pickle.dumps(data, 5, buffer_callback=buffers.append)
+        raws = [b.raw() for b in buffers]
+        lengths = [len(stream)] + [r.nbytes for r in raws]
+        header = struct.pack('<I%dQ' % len(lengths), len(raws), *lengths)
+        return b''.join([header, stream] + [r.tobytes() for r in raws])
+
+    def decode(self, payload):
+        view = memoryview(payload)
+        (n_buffers,) = struct.unpack_from('<I', view, 0)
+        lengths = struct.unpack_from('<%dQ' % (n_buffers + 1), view, 4)
+        offset = 4 + 8 * (n_buffers + 1)
+        stream = view[offset:offset + lengths[0]]
+        offset += lengths[0]
+        buffers = []
+        for length in lengths[1:]:
+            buffers.append(view[offset:offset + length])
+            offset += length
+        return pickle.loads(stream, buffers=buffers)
+
+
+class GenpyCodec(Codec):
+    """ROS message values are serialized with their own (genpy) serializer,
+    which is faster and more compact than pickling them. Other values are
+    pickled."""
+
+    name = 'genpy'
+
+    def __init__(self, protocol=2):
+        self._protocol = protocol
+
+    def encode(self, data):
+        encoded = {}
+        for (key, value) in data.items():
+            if isinstance(value, genpy.Message):
+                buff = six.BytesIO()
+                value.serialize(buff)
+                encoded[key] = ('m', value._type, buff.getvalue())
+            else:
+                encoded[key] = ('p', value)
+        return pickle.dumps(encoded, self._protocol)
+
+    def decode(self, payload):
+        data = {}
+        for (key, value) in pickle.loads(payload).items():
+            if value[0] == 'm':
+                data[key] = _get_message_class(value[1])().deserialize(value[2])
+            else:
+                data[key] = value[1]
+        return data
+
+
+class JsonCodec(Codec):
+    """JSON encoding, which is safe to decode from untrusted peers.
+
+    Values must be JSON types or ROS messages. ROS messages are stored as
+    their serialized bytes, and are only ever deserialized into the message
+    class they name. Values that JSON would decode differently, such as
+    tuples and dicts with keys that are not strings, are rejected with a
+    TypeError rather than altered.
+    """
+
+    name = 'json'
+
+    def encode(self, data):
+        self._check_value(data)
+        return json.dumps(data, default=self._encode_message).encode('utf-8')
+
+    @classmethod
+    def _check_value(cls, value):
+        """Raise a TypeError if a value would not survive a JSON round trip."""
+        if isinstance(value, dict):
+            for (key, item) in value.items():
+                if not isinstance(key, six.string_types):
+                    raise TypeError("Userdata dict key %r cannot be encoded as JSON, it would be decoded as a string." % (key,))
+                cls._check_value(item)
+        elif isinstance(value, list):
+            for item in value:
+                cls._check_value(item)
+        elif isinstance(value, tuple):
+            raise TypeError("Userdata tuples cannot be encoded as JSON, they would be decoded as lists.")
+
+    def decode(self, payload):
+        return json.loads(payload.decode('utf-8'), object_hook=self._decode_message)
+
+    @staticmethod
+    def _encode_message(value):
+        if isinstance(value, genpy.Message):
+            buff = six.BytesIO()
+            value.serialize(buff)
+            return {'_ros_type': value._type,
+                    '_ros_data': base64.b64encode(buff.getvalue()).decode('ascii')}
+        raise TypeError("Userdata value of type '%s' cannot be encoded as JSON." % type(value).__name__)
+
+    @staticmethod
+    def _decode_message(obj):
+        if '_ros_type' in obj and '_ros_data' in obj:
+            return _get_message_class(obj['_ros_type'])().deserialize(base64.b64decode(obj['_ros_data']))
+        return obj
+
+
+# Message classes by type name
+_message_classes = {}
+
+
+def _get_message_class(msg_type):
+    try:
+        return _message_classes[msg_type]
+    except KeyError:
+        msg_class = roslib.message.get_message_class(msg_type)
+        if msg_class is None:
+            raise ValueError("Unknown ROS message type '%s' in userdata." % msg_type)
+        _message_classes[msg_type] = msg_class
+        return msg_class
+
+
+# Registered codecs and compressions
+_codecs = {}
+_compressions = {}
+
+
+def register_codec(codec):
+    """Register a codec under its name.
+
+    @type codec: L{Codec}
+    """
+    if '+' in codec.name:
+        raise ValueError("Codec names must not contain '+'.")
+    _codecs[codec.name] = codec
+
+
+def get_codec(name):
+    """Get a registered codec by name."""
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise ValueError("Unknown userdata codec '%s'." % name)
+
+
+def get_codec_names():
+    """Get the names of all registered codecs."""
+    return list(_codecs.keys())
+
+
+def register_compression(name, compress, decompress):
+    """Register a compression that can be applied on top of a codec.
+
+    @type name: string
+    @param name: Name of the compression in codec names.
+
+    @type compress: callable
+    @param compress: Function compressing bytes.
+
+    @type decompress: callable
+    @param decompress: Function decompressing bytes.
+    """
+    _compressions[name] = (compress, decompress)
+
+
+def encode_local_data(data, codec=LEGACY_CODEC, compression=None, compression_threshold=65536):
+    """Encode a userdata dictionary for the local_data field of a message.
+
+    @type codec: string
+    @param codec: Name of the codec.
+
+    @type compression: string
+    @param compression: Name of the compression to apply if the encoded data
+    exceeds C{compression_threshold} bytes, or None.
+
+    @rtype: tuple
+    @return: The codec name for the local_data_codec field, and the value of
+    the local_data field.
+    """
+    payload = get_codec(codec).encode(data)
+    if compression is not None and len(payload) > compression_threshold:
+        payload = _compressions[compression][0](payload)
+        codec = codec + '+' + compression
+    return (codec, compatible_decode(payload))
+
+
+def decode_local_data(codec, local_data, allowed_codecs=None):
+    """Decode the local_data field of a message.
+
+    @type codec: string
+    @param codec: The local_data_codec field of the message.
+
+    @type allowed_codecs: list of string
+    @param allowed_codecs: Names of the codecs to accept, or None to accept
+    all registered codecs.
+
+    @rtype: dict
+    """
+    names = codec.split('+')
+    if allowed_codecs is not None and names[0] not in allowed_codecs:
+        raise ValueError("Userdata codec '%s' is not allowed." % names[0])
+    payload = compatible_encode(local_data)
+    for compression in reversed(names[1:]):
+        try:
+            decompress = _compressions[compression][1]
+        except KeyError:
+            raise ValueError("Unknown userdata compression '%s'." % compression)
+        payload = decompress(payload)
+    return get_codec(names[0]).decode(payload)
+
+
+register_codec(PickleCodec(LEGACY_CODEC, 2))
+register_codec(PickleCodec('pickle2', 2))
+register_codec(GenpyCodec())
+register_codec(JsonCodec())
+if pickle.HIGHEST_PROTOCOL >= 5:
+    register_codec(OutOfBandPickleCodec())
+
+register_compression('zlib', lambda b: zlib.compress(b, 1), zlib.decompress)
+try:
+    import lz4.frame
+    register_compression('lz4', lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
@@ -1,9 +1,12 @@
 import rospy
 
+import threading
 import traceback
 
 import smach
 
+from smach_ros.scheduler import get_scheduler
+
 __all__ = ['ConditionState']
 
 
@@ -38,6 +41,13 @@ class ConditionState(smach.State):
         self._timeout = timeout
         self._max_checks = max_checks
 
+        # Set when the next check is due or a preempt is requested
+        self._wakeup = threading.Event()
+
+    def request_preempt(self):
+        smach.State.request_preempt(self)
+        self._wakeup.set()
+
     def execute(self, ud):
         start_time = rospy.Time.now()
         n_checks = 0
@@ -61,7 +71,19 @@ class ConditionState(smach.State):
                 raise smach.InvalidUserCodeError("Error thrown while executing condition callback %s: " % str(
                     self._cond_cb) + traceback.format_exc())
             n_checks += 1
-            rospy.sleep(self._poll_rate)
+            # Sleep until the next check, or until preempted
+            self._wakeup.clear()
+            if self.preempt_requested():
+                continue
+            scheduler = get_scheduler()
+            timer = scheduler.call_later(self._poll_rate, self._wakeup.set)
+            try:
+                while not self._wakeup.is_set():
+                    if rospy.is_shutdown():
+                        raise rospy.ROSInterruptException("ROS shutdown request")
+                    self._wakeup.wait(scheduler.MAX_WAIT)
+            finally:
+                timer.cancel()
 
         if self.preempt_requested():
             self.service_preempt()
@@ -3,17 +3,26 @@ import roslib; roslib.load_manifest('smach_ros')
 import rospy
 from std_msgs.msg import Header
 
-import pickle
-import six
+import collections
 import threading
 
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2
+    from time import time as monotonic
+
 import rostopic
 import smach
 
 from smach_msgs.msg import SmachContainerStatus, SmachContainerInitialStatusCmd, SmachContainerStructure
 
+from smach_ros.codec import LEGACY_CODEC, compatible_decode, compatible_encode, \
+    decode_local_data, encode_local_data
+from smach_ros.scheduler import get_scheduler
+
 
-__all__ = ['IntrospectionClient', 'IntrospectionServer']
+__all__ = ['IntrospectionClient', 'IntrospectionServer', 'LocalDataDecoder']
 
 # Topic names
 STATUS_TOPIC = '/smach/container_status'
@@ -21,16 +30,55 @@ INIT_TOPIC = '/smach/container_init'
 STRUCTURE_TOPIC = '/smach/container_structure'
 
 
-def compatible_decode(dump):
-    if six.PY2:
-        return dump
-    return dump.decode('latin1')
+class LocalDataDecoder(object):
+    """Rebuilds the userdata of containers from their status messages.
+
+    By default, every status message carries all userdata keys. Servers
+    started with C{send_deltas} only send the keys that changed since the
+    previous message of the same container, and periodically all keys (a
+    keyframe). If such a message was missed, the userdata of that container
+    is incomplete until the next keyframe arrives.
+    """
+
+    def __init__(self, allowed_codecs=None):
+        """Constructor.
+
+        @type allowed_codecs: list of string
+        @param allowed_codecs: Names of the userdata codecs to accept, or None
+        to accept all registered codecs.
+        """
+        self._allowed_codecs = allowed_codecs
+
+        # Map from container path to the decoded version and data
+        self._versions = {}
+        self._data = {}
+
+    def update(self, msg):
+        """Apply a status message.
 
+        @type msg: C{smach_msgs.msg.SmachContainerStatus}
 
-def compatible_encode(load):
-    if six.PY2:
-        return load
-    return load.encode('latin1')
+        @rtype: dict
+        @return: The complete userdata of the container, or None if it is
+        incomplete.
+        """
+        path = msg.path
+        delta = decode_local_data(msg.local_data_codec, msg.local_data, self._allowed_codecs)
+        if msg.base_version == 0:
+            self._data[path] = delta
+        elif self._versions.get(path) == msg.base_version:
+            self._data[path].update(delta)
+        else:
+            # Missed a message, wait for the next keyframe
+            self._versions.pop(path, None)
+            self._data.pop(path, None)
+            return None
+        self._versions[path] = msg.data_version
+        return self._data[path]
+
+    def get(self, path):
+        """Get the userdata of a container, or None if it is incomplete."""
+        return self._data.get(path)
 
 
 class IntrospectionClient(object):
@@ -47,7 +95,8 @@ class IntrospectionClient(object):
             path,
             initial_states,
             initial_userdata = smach.UserData(),
-            timeout = None):
+            timeout = None,
+            codec = 'json'):
         """Set the initial state of a smach server.
 
         @type server: string
@@ -68,23 +117,41 @@ class IntrospectionClient(object):
         @param timeout: Timeout for this call. If this is set to None, it will not
         block, and the initial state may not be set before the target state machine
         goes active.
+
+        @type codec: string
+        @param codec: The codec the userdata is encoded with. The default
+        codec, 'json', is safe for the server to decode, but only supports
+        JSON types and ROS messages; other userdata falls back to the legacy
+        pickle codec, which servers may refuse.
         """
 
+        try:
+            (codec, local_data) = encode_local_data(initial_userdata._data, codec)
+        except (TypeError, ValueError):
+            if codec != 'json':
+                raise
+            rospy.logwarn("Userdata cannot be encoded as JSON, sending it pickled instead.")
+            (codec, local_data) = encode_local_data(initial_userdata._data, LEGACY_CODEC)
+
         # Construct initial state command
         initial_status_msg = SmachContainerInitialStatusCmd(
                 path = path,
                 initial_states = initial_states,
-                local_data = compatible_decode(pickle.dumps(initial_userdata._data,2)))
+                local_data = local_data,
+                local_data_codec = codec)
 
         # A status message to receive confirmation that the state was set properly
         msg_response = SmachContainerStatus()
+        decoder = LocalDataDecoder()
 
         # Define a local callback to just stuff a local message
         def local_cb(msg, msg_response):
             rospy.logdebug("Received status response: "+str(msg))
+            if msg.path != path:
+                return
+            decoder.update(msg)
             msg_response.path = msg.path
             msg_response.initial_states = msg.initial_states
-            msg_response.local_data = msg.local_data
 
         # Create a subscriber to verify the request went through
         state_sub = rospy.Subscriber(server+STATUS_TOPIC, SmachContainerStatus,
@@ -108,10 +175,9 @@ class IntrospectionClient(object):
                 if msg_response.path == path:
                     # Check if the heartbeat came back to match
                     state_match = all([s in msg_response.initial_states for s in initial_states])
-                    local_data = smach.UserData()
-                    local_data._data = pickle.loads(compatible_encode(msg_response.local_data))
+                    local_data = decoder.get(path) or {}
                     ud_match = all([\
-                            (key in local_data and local_data._data[key] == initial_userdata._data[key])\
+                            (key in local_data and local_data[key] == initial_userdata._data[key])\
                             for key in initial_userdata._data])
 
                     rospy.logdebug("STATE MATCH: "+str(state_match)+", UD_MATCH: "+str(ud_match))
@@ -122,18 +188,160 @@ class IntrospectionClient(object):
             return False
 
 
+class StatusPublisher(object):
+    """Background publisher for the transition status messages of the
+    containers of an L{IntrospectionServer}.
+
+    Transition callbacks only append an event to a queue, so introspection
+    does not delay the thread executing the state machine. The publisher
+    thread publishes at most C{max_rate} rounds of messages per second. If
+    several transitions of a container arrive within one round, only the
+    latest status of that container is published.
+    """
+
+    def __init__(self, max_rate=50.0, name='smach_introspection'):
+        """Constructor.
+
+        @type max_rate: float
+        @param max_rate: Maximum rate in Hz at which a container publishes
+        transition status messages.
+        """
+        self._period = 1.0 / max_rate
+        self._queue = collections.deque()
+        self._wakeup = threading.Event()
+        self._keep_running = True
+        self._thread = threading.Thread(name=name + ':status_publisher', target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def post(self, proxy, info):
+        """Queue a status message of a container.
+
+        @type proxy: L{ContainerProxy}
+        @param info: The arguments the info string is formatted from.
+        """
+        self._queue.append((proxy, info, monotonic()))
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+    def stop(self):
+        """Publish the queued messages and stop the publisher thread."""
+        self._keep_running = False
+        self._wakeup.set()
+        self._thread.join()
+
+    def _run(self):
+        # Latest event of each container, in order of arrival
+        pending = collections.OrderedDict()
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while self._queue:
+                (proxy, info, stamp) = self._queue.popleft()
+                pending.pop(proxy, None)
+                pending[proxy] = (info, stamp)
+            for (proxy, (info, stamp)) in pending.items():
+                try:
+                    proxy._publish_status(_format_info(info), monotonic_time=stamp)
+                except:
+                    if not rospy.is_shutdown():
+                        rospy.logerr("Publishing SMACH introspection status of '%s' failed." % proxy._path)
+            pending.clear()
+            if not self._keep_running:
+                break
+            # Events arriving in the meantime are coalesced
+            rospy.rostime.wallsleep(self._period)
+
+
+def _format_info(info):
+    (args, kwargs) = info
+    return str(args) + ', ' + str(kwargs)
+
+
+class _StructureReplayListener(rospy.SubscribeListener):
+    """Sends the cached structure of a container to new subscribers."""
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+
+    def peer_subscribe(self, topic_name, topic_publish, peer_publish):
+        (structure_msg, _) = self._proxy._get_structure_msg()
+        peer_publish(structure_msg)
+
+
 class ContainerProxy():
     """Smach Container Introspection proxy.
 
     This class is used as a container for introspection and debugging.
     """
-    def __init__(self, server_name, container, path, update_rate=rospy.Duration(2.0)):
+    def __init__(self, server_name, container, path, update_rate=rospy.Duration(2.0), **kwargs):
         """Constructor for tree-wide data structure.
+
+        @type update_rate: C{rospy.Duration}
+        @param update_rate: Period of the status heartbeats, if the proxy
+        publishes them itself (see L{start}).
+
+        The following parameters can only be passed by keyword.
+
+        @type codec: string
+        @param codec: The codec the userdata in status messages is encoded
+        with.
+
+        @type compression: string
+        @param compression: The compression applied to the encoded userdata if
+        it is larger than C{compression_threshold} bytes, or None.
+
+        @type allowed_init_codecs: list of string
+        @param allowed_init_codecs: Names of the codecs accepted for the
+        userdata of initial state commands, or None to accept all codecs.
+
+        @type status_publisher: L{StatusPublisher}
+        @param status_publisher: The publisher for transition status messages.
+        If None, they are published from the transition callback.
+
+        @type send_deltas: bool
+        @param send_deltas: If True, status messages only hold the userdata
+        keys that changed since the previous message, and all keys every
+        C{keyframe_rate}. If False, every status message holds all keys.
+
+        @type keyframe_rate: C{rospy.Duration}
+        @param keyframe_rate: Period of the status messages holding all
+        userdata keys if C{send_deltas} is set.
         """
+        keyframe_rate = kwargs.pop('keyframe_rate', rospy.Duration(10.0))
+        status_publisher = kwargs.pop('status_publisher', None)
+        codec = kwargs.pop('codec', LEGACY_CODEC)
+        compression = kwargs.pop('compression', None)
+        compression_threshold = kwargs.pop('compression_threshold', 65536)
+        allowed_init_codecs = kwargs.pop('allowed_init_codecs', None)
+        send_deltas = kwargs.pop('send_deltas', False)
+        if kwargs:
+            raise TypeError("ContainerProxy got unexpected keyword arguments: %s" % ', '.join(sorted(kwargs)))
+
         self._path = path
-        self._container = container
         self._update_rate = update_rate
+        self._heartbeat_timer = None
+        self._container = container
+        self._keyframe_rate = keyframe_rate
+        self._send_deltas = send_deltas
+        self._status_publisher = status_publisher
         self._status_pub_lock = threading.Lock()
+        self._codec = codec
+        self._compression = compression
+        self._compression_threshold = compression_threshold
+        self._allowed_init_codecs = allowed_init_codecs
+
+        # The cached structure message, the structure version of the container
+        # it was built for and a hash of its content
+        self._structure_lock = threading.Lock()
+        self._structure_msg = None
+        self._structure_version = None
+        self._structure_hash = None
+
+        # The userdata and its version at the last status message
+        self._published_ud = None
+        self._published_version = 0
+        self._next_keyframe = None
 
         # Advertise init service
         self._init_cmd = rospy.Subscriber(
@@ -142,9 +350,12 @@ class ContainerProxy():
                 self._init_cmd_cb)
 
         # Advertise structure publisher
+        # The proxies of a server share this topic, so rather than latching
+        # it, each proxy sends its structure to new subscribers
         self._structure_pub = rospy.Publisher(
                 name=server_name + STRUCTURE_TOPIC,
                 data_class=SmachContainerStructure,
+                subscriber_listener=_StructureReplayListener(self),
                 queue_size=1)
 
         # Advertise status publisher
@@ -156,112 +367,168 @@ class ContainerProxy():
         # Set transition callback
         container.register_transition_cb(self._transition_cb)
 
-        # Create thread to constantly publish
-        self._status_pub_thread = threading.Thread(name=server_name+':status_publisher',target=self._status_pub_loop)
-
-        self._structure_pub_thread = threading.Thread(name=server_name+':structure_publisher',target=self._structure_pub_loop)
-
         self._keep_running = False
 
-    def start(self):
+    def start(self, heartbeat=True):
+        """Start publishing transitions, and publish the structure.
+
+        @type heartbeat: bool
+        @param heartbeat: If True, the proxy publishes its status heartbeat
+        every C{update_rate}. L{IntrospectionServer} drives the heartbeats of
+        its proxies itself.
+        """
         self._keep_running = True
-        self._status_pub_thread.start()
-        self._structure_pub_thread.start()
+        self._publish_structure()
+        if heartbeat:
+            self._heartbeat_timer = get_scheduler().call_every(self._update_rate, self._heartbeat_cb)
 
     def stop(self):
+        """Stop publishing and unregister from the ROS topics."""
         self._keep_running = False
-
-    def _status_pub_loop(self):
-        """Loop to publish the status and structure heartbeats."""
-        while not rospy.is_shutdown() and self._keep_running:
-            #TODO
-            self._publish_status('HEARTBEAT')
-            try:
-                end_time = rospy.Time.now() + self._update_rate
-                while not rospy.is_shutdown() and rospy.Time.now() < end_time:
-                    rospy.sleep(0.1)
-            except:
-                pass
-
-    def _structure_pub_loop(self):
-        """Loop to publish the status and structure heartbeats."""
-        while not rospy.is_shutdown() and self._keep_running:
-            self._publish_structure('HEARTBEAT')
-            try:
-                end_time = rospy.Time.now() + self._update_rate
-                while not rospy.is_shutdown() and rospy.Time.now() < end_time:
-                    rospy.sleep(0.1)
-            except:
-                pass
-
-    def _publish_structure(self, info_str=''):
-        path = self._path
-        children = list(self._container.get_children().keys())
-
-        internal_outcomes = []
-        outcomes_from = []
-        outcomes_to = []
-        for (outcome, from_label, to_label) in self._container.get_internal_edges():
-            internal_outcomes.append(str(outcome))
-            outcomes_from.append(str(from_label))
-            outcomes_to.append(str(to_label))
-        container_outcomes = self._container.get_registered_outcomes()
-
-        # Construct structure message
-        structure_msg = SmachContainerStructure(
-                Header(stamp = rospy.Time.now()),
-                path,
-                children,
-                internal_outcomes,
-                outcomes_from,
-                outcomes_to,
-                container_outcomes)
+        get_scheduler().cancel(self._heartbeat_timer)
+        self._heartbeat_timer = None
+        self._init_cmd.unregister()
+        self._structure_pub.unregister()
+        self._status_pub.unregister()
+
+    def _heartbeat_cb(self):
+        # Keep serializing the status off the scheduler thread
+        smach.get_default_executor().submit(self._publish_heartbeat)
+
+    def _publish_heartbeat(self):
+        """Publish the status heartbeat, and the structure if it changed."""
+        self._publish_status('HEARTBEAT')
+        self._publish_structure()
+
+    def _get_structure_msg(self):
+        """Get the structure message of the container.
+
+        The message is rebuilt only if the structure version of the container
+        changed since it was last built.
+
+        @rtype: tuple
+        @return: The message, and whether its content changed since the
+        previous call.
+        """
+        with self._structure_lock:
+            version = getattr(self._container, '_structure_version', None)
+            if version is not None and version == self._structure_version:
+                return (self._structure_msg, False)
+
+            children = list(self._container.get_children().keys())
+
+            internal_outcomes = []
+            outcomes_from = []
+            outcomes_to = []
+            for (outcome, from_label, to_label) in self._container.get_internal_edges():
+                internal_outcomes.append(str(outcome))
+                outcomes_from.append(str(from_label))
+                outcomes_to.append(str(to_label))
+            container_outcomes = list(self._container.get_registered_outcomes())
+
+            structure_hash = hash((tuple(children),
+                                   tuple(internal_outcomes),
+                                   tuple(outcomes_from),
+                                   tuple(outcomes_to),
+                                   tuple(container_outcomes)))
+            self._structure_version = version
+            if structure_hash == self._structure_hash:
+                return (self._structure_msg, False)
+
+            # Construct structure message
+            self._structure_hash = structure_hash
+            self._structure_msg = SmachContainerStructure(
+                    Header(stamp = rospy.Time.now()),
+                    self._path,
+                    children,
+                    internal_outcomes,
+                    outcomes_from,
+                    outcomes_to,
+                    container_outcomes)
+            return (self._structure_msg, True)
+
+    def _publish_structure(self, force=False):
+        """Publish the structure of the container if it changed since it was
+        last published, or if C{force} is set."""
         try:
-            self._structure_pub.publish(structure_msg)
+            (structure_msg, changed) = self._get_structure_msg()
+            if changed or force:
+                self._structure_pub.publish(structure_msg)
         except:
             if not rospy.is_shutdown():
                 rospy.logerr("Publishing SMACH introspection structure message failed.")
 
-    def _publish_status(self, info_str=''):
+    def _publish_status(self, info_str='', keyframe=False, monotonic_time=None):
         """Publish current state of this container."""
+        if monotonic_time is None:
+            monotonic_time = monotonic()
         # Construct messages
         with self._status_pub_lock:
             path = self._path
+            now = rospy.Time.now()
+            ud = self._container.userdata
+
+            # Send all keys periodically, or if the userdata was replaced
+            if (not self._send_deltas or ud is not self._published_ud
+                    or self._next_keyframe is None or now >= self._next_keyframe):
+                keyframe = True
+            base_version = 0 if keyframe else self._published_version
+            # Encode from a snapshot, so concurrent writes cannot tear it
+            (data_version, data) = ud.snapshot().get_changes(base_version)
+            (codec, local_data) = encode_local_data(
+                data, self._codec, self._compression, self._compression_threshold)
 
-            #print str(structure_msg)
             # Construct status message
-            #print self._container.get_active_states()
             state_msg = SmachContainerStatus(
-                    Header(stamp = rospy.Time.now()),
-                    path,
-                    self._container.get_initial_states(),
-                    self._container.get_active_states(),
-                    compatible_decode(pickle.dumps(self._container.userdata._data, 2)),
-                    info_str)
+                    header=Header(stamp = now),
+                    path=path,
+                    initial_states=self._container.get_initial_states(),
+                    active_states=self._container.get_active_states(),
+                    local_data=local_data,
+                    local_data_codec=codec,
+                    data_version=data_version,
+                    base_version=base_version,
+                    monotonic_time=monotonic_time,
+                    info=info_str)
             # Publish message
             self._status_pub.publish(state_msg)
 
+            self._published_ud = ud
+            self._published_version = data_version
+            if keyframe:
+                self._next_keyframe = now + self._keyframe_rate
+
     ### Transition reporting
     def _transition_cb(self, *args, **kwargs):
         """Transition callback, passed to all internal nodes in the tree.
-        This callback locks an internal mutex, preventing any hooked transitions
-        from occurring while we're walking the tree.
+        This hands the status to the status publisher, or publishes it right
+        away if there is none.
         """
-        info_str = (str(args) + ', ' + str(kwargs))
-        rospy.logdebug("Transitioning: "+info_str)
+        if not self._keep_running:
+            return
+        if self._status_publisher is not None:
+            self._status_publisher.post(self, (args, kwargs))
+            return
+        info_str = _format_info((args, kwargs))
+        rospy.logdebug("Transitioning: %s", info_str)
         self._publish_status(info_str)
 
     def _init_cmd_cb(self, msg):
         """Initialize a tree's state and userdata."""
         initial_states = msg.initial_states
-        local_data = msg.local_data
 
         # Check if this init message is directed at this path
         rospy.logdebug('Received init message for path: '+msg.path+' to '+str(initial_states))
         if msg.path == self._path:
             if all(s in self._container.get_children() for s in initial_states):
+                try:
+                    local_data = decode_local_data(
+                        msg.local_data_codec, msg.local_data, self._allowed_init_codecs)
+                except Exception as ex:
+                    rospy.logerr("Rejecting initial state command for container '%s': %s" % (self._path, ex))
+                    return
                 ud = smach.UserData()
-                ud._data = pickle.loads(compatible_encode(msg.local_data))
+                ud._data = local_data
                 rospy.logdebug("Setting initial state in smach path: '"+self._path+"' to '"+str(initial_states)+"' with userdata: "+str(ud._data))
 
                 # Set the initial state
@@ -269,16 +536,61 @@ class ContainerProxy():
                         initial_states,
                         ud)
                 # Publish initial state
-                self._publish_status("REMOTE_INIT")
+                self._publish_status("REMOTE_INIT", keyframe=True)
             else:
                 rospy.logerr("Attempting to set initial state in container '"+self._path+"' to '"+str(initial_states)+"', but this container only has states: "+str(self._container.get_children()))
 
 
 class IntrospectionServer():
-    """Server for providing introspection and control for smach."""
-    def __init__(self, server_name, state, path):
+    """Server for providing introspection and control for smach.
+
+    The heartbeats of all containers are driven by a single timer on the
+    shared L{Scheduler<smach_ros.scheduler.Scheduler>}. Every update period is
+    split into up to C{MAX_HEARTBEAT_SLOTS} slots, and the proxies publish
+    their heartbeats in the slot they are assigned to, so the load is spread
+    over the period rather than arriving in one burst.
+    """
+
+    MAX_HEARTBEAT_SLOTS = 10
+
+    def __init__(self, server_name, state, path, update_rate=rospy.Duration(2.0), max_rate=50.0,
+                 codec=LEGACY_CODEC, compression=None, compression_threshold=65536,
+                 allowed_init_codecs=None, send_deltas=False):
         """Traverse the smach tree starting at root, and construct introspection
-        proxies for getting and setting debug state."""
+        proxies for getting and setting debug state.
+
+        @type codec: string
+        @param codec: The codec the userdata in status messages is encoded
+        with (see L{smach_ros.codec}). The default legacy codec encodes
+        C{local_data} as before codecs were added. The message definitions
+        changed however, so clients such as smach_viewer must be built
+        against the same version of smach_msgs as the server.
+
+        @type compression: string
+        @param compression: The compression ('zlib', or 'lz4' if available)
+        applied to encoded userdata larger than C{compression_threshold}
+        bytes, or None.
+
+        @type allowed_init_codecs: list of string
+        @param allowed_init_codecs: Names of the codecs accepted for the
+        userdata of initial state commands, or None to accept all codecs.
+        Accepting only 'json' keeps the server from unpickling data sent by
+        other nodes.
+
+        @type send_deltas: bool
+        @param send_deltas: If True, status messages only hold the userdata
+        keys that changed since the previous message of the container, with
+        all keys sent periodically. Clients must rebuild the userdata with a
+        L{LocalDataDecoder}; clients that do not, such as smach_viewer, only
+        see the changed keys. If False, every status message holds all keys.
+
+        @type update_rate: C{rospy.Duration}
+        @param update_rate: Period of the status heartbeats of each container.
+
+        @type max_rate: float
+        @param max_rate: Maximum rate in Hz of the transition status messages
+        of each container. Faster transitions are coalesced.
+        """
 
         # A list of introspection proxies
         self._proxies = []
@@ -287,19 +599,65 @@ class IntrospectionServer():
         self._server_name = server_name
         self._state = state
         self._path = path
+        self._update_rate = update_rate
+        self._max_rate = max_rate
+        self._status_publisher = None
+        self._proxy_options = dict(
+            codec=codec,
+            compression=compression,
+            compression_threshold=compression_threshold,
+            allowed_init_codecs=allowed_init_codecs,
+            send_deltas=send_deltas)
+
+        # Heartbeat timer, and the slot and pending task of the heartbeats
+        self._heartbeat_timer = None
+        self._heartbeat_slot = 0
+        self._heartbeat_task = None
 
     def start(self):
+        self._status_publisher = StatusPublisher(self._max_rate, self._server_name)
+
         # Construct proxies
         self.construct(self._server_name, self._state, self._path)
 
+        n_slots = max(1, min(len(self._proxies), self.MAX_HEARTBEAT_SLOTS))
+        self._heartbeat_slot = 0
+        self._heartbeat_timer = get_scheduler().call_every(
+            self._update_rate.to_sec() / n_slots, self._heartbeat_cb, n_slots)
+
     def stop(self):
+        """Stop the heartbeats and all proxies."""
+        get_scheduler().cancel(self._heartbeat_timer)
+        self._heartbeat_timer = None
+        if self._status_publisher is not None:
+            self._status_publisher.stop()
+            self._status_publisher = None
         for proxy in self._proxies:
             proxy.stop()
 
+    def _heartbeat_cb(self, n_slots):
+        # Skip a slot rather than queueing heartbeats if publishing falls behind
+        if self._heartbeat_task is not None and not self._heartbeat_task.done():
+            return
+        proxies = self._proxies[self._heartbeat_slot::n_slots]
+        self._heartbeat_slot = (self._heartbeat_slot + 1) % n_slots
+        # Serializing the status can take a while, so keep it off the
+        # scheduler thread
+        self._heartbeat_task = smach.get_default_executor().submit(self._publish_heartbeats, proxies)
+
+    def _publish_heartbeats(self, proxies):
+        for proxy in proxies:
+            try:
+                proxy._publish_heartbeat()
+            except:
+                if not rospy.is_shutdown():
+                    rospy.logerr("Publishing SMACH introspection heartbeat of '%s' failed." % proxy._path)
+
     def construct(self, server_name, state, path):
         """Recursively construct proxies to containers."""
         # Construct a new proxy
-        proxy = ContainerProxy(server_name, state, path)
+        proxy = ContainerProxy(server_name, state, path, status_publisher=self._status_publisher,
+                               **self._proxy_options)
 
         if path == '/':
             path = ''
@@ -313,8 +671,8 @@ class IntrospectionServer():
         # Publish initial state
         proxy._publish_status("Initial state")
 
-        # Start publisher threads
-        proxy.start()
+        # Start publishing, the heartbeats are driven by the server
+        proxy.start(heartbeat=False)
 
         # Store the proxy
         self._proxies.append(proxy)
@@ -0,0 +1,59 @@
+import threading
+
+__all__ = ['ActionMetadata', 'ServiceMetadata', 'get_action_metadata', 'get_service_metadata']
+
+
+class ActionMetadata(object):
+    """Type information of an action, extracted once per action type."""
+
+    def __init__(self, action_spec):
+        action = action_spec()
+        self.goal_class = type(action.action_goal.goal)
+        self.result_class = type(action.action_result.result)
+        self.feedback_class = type(action.action_feedback.feedback)
+        self.goal_slots = frozenset(self.goal_class.__slots__)
+        self.result_slots = frozenset(self.result_class.__slots__)
+
+
+class ServiceMetadata(object):
+    """Type information of a service, extracted once per service type."""
+
+    def __init__(self, service_spec):
+        self.request_class = service_spec._request_class
+        self.response_class = service_spec._response_class
+        self.request_slots = frozenset(self.request_class.__slots__)
+        self.response_slots = frozenset(self.response_class.__slots__)
+
+
+# Metadata keyed on action or service type
+_metadata = {}
+_metadata_lock = threading.Lock()
+
+
+def _get_metadata(spec, metadata_class):
+    metadata = _metadata.get(spec)
+    if metadata is None:
+        with _metadata_lock:
+            metadata = _metadata.get(spec)
+            if metadata is None:
+                metadata = metadata_class(spec)
+                _metadata[spec] = metadata
+    return metadata
+
+
+def get_action_metadata(action_spec):
+    """Get the type information of an action.
+
+    @type action_spec: actionlib action msg
+    @rtype: L{ActionMetadata}
+    """
+    return _get_metadata(action_spec, ActionMetadata)
+
+
+def get_service_metadata(service_spec):
+    """Get the type information of a service.
+
+    @type service_spec: service type
+    @rtype: L{ServiceMetadata}
+    """
+    return _get_metadata(service_spec, ServiceMetadata)
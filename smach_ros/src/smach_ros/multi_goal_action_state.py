@@ -0,0 +1,314 @@
+import rospy
+
+import threading
+
+from actionlib.action_client import CommState
+from actionlib_msgs.msg import GoalStatus
+
+import smach
+
+from smach_ros.action_client_pool import acquire_action_client, release_action_client
+from smach_ros.scheduler import get_scheduler
+
+__all__ = ['MultiGoalActionState']
+
+
+class _Goal(object):
+    """Tracking information of a goal sent by a L{MultiGoalActionState}."""
+
+    __slots__ = ['handle', 'done', 'status', 'result', 'execution_timer', 'cancelation_timer']
+
+    def __init__(self):
+        self.handle = None
+        self.done = False
+        self.status = GoalStatus.PENDING
+        self.result = None
+        self.execution_timer = None
+        self.cancelation_timer = None
+
+
+class MultiGoalActionState(smach.State):
+    """Action client state sending several goals to one action server at once.
+
+    The goals are read as a list from the userdata, and are all sent at the
+    same time through the shared action client of the server. Each goal is
+    tracked through its own goal handle, with its own execution and
+    cancelation timeouts.
+
+    The outcome of the state depends on how many goals succeed. With the
+    C{'all'} policy, the state succeeds if every goal succeeds. With the
+    C{'any'} policy or a number C{k}, it succeeds as soon as one, or k, of the
+    goals succeed, and the goals still running are cancelled. As soon as the
+    policy can no longer be met, the goals still running are cancelled and
+    the state aborts.
+
+    The results and the final statuses of the goals are stored in the
+    userdata as lists in the order of the goals. Goals that have no result,
+    such as goals given up on after the cancelation timeout, have a result of
+    None.
+    """
+
+    def __init__(self,
+                 # Action info
+                 action_name,
+                 action_spec,
+                 # Goals and results
+                 goals_key='goals',
+                 results_key='results',
+                 statuses_key=None,
+                 policy='all',
+                 # Timeouts
+                 exec_timeout=None,
+                 cancel_timeout=rospy.Duration(15.0),
+                 server_wait_timeout=rospy.Duration(60.0),
+                 # Connection
+                 lazy_connect=False,
+                 ):
+        """Constructor for MultiGoalActionState action client wrapper.
+
+        @type action_name: string
+        @param action_name: The name of the action as it will be broadcast over ros.
+
+        @type action_spec: actionlib action msg
+        @param action_spec: The type of action to which this client will connect.
+
+        @type goals_key: string
+        @param goals_key: The userdata key holding the list of goals.
+
+        @type results_key: string
+        @param results_key: The userdata key the list of results is stored
+        under, or None.
+
+        @type statuses_key: string
+        @param statuses_key: The userdata key the list of final goal statuses
+        (C{actionlib.GoalStatus}) is stored under, or None.
+
+        @type policy: string or int
+        @param policy: C{'all'}, C{'any'} or the number of goals that must
+        succeed for the state to succeed, which must be at least 1.
+
+        @type exec_timeout: C{rospy.Duration}
+        @param exec_timeout: The timeout after which a goal is cancelled, or
+        None for no timeout.
+
+        @type cancel_timeout: C{rospy.Duration}
+        @param cancel_timeout: The timeout after which a cancelled goal that
+        did not terminate is given up on.
+
+        @type server_wait_timeout: C{rospy.Duration}
+        @param server_wait_timeout: This is the timeout used for aborting while
+        waiting for an action server to become active.
+
+        @type lazy_connect: bool
+        @param lazy_connect: If True, the action client is not created or
+        connected when the state is constructed, but when it is first
+        executed or L{warm} is called.
+        """
+        smach.State.__init__(self, outcomes=['succeeded', 'aborted', 'preempted'])
+
+        if policy not in ('all', 'any') and not (
+                isinstance(policy, int) and not isinstance(policy, bool) and policy >= 1):
+            raise smach.InvalidStateError(
+                "Goal policy given to MultiGoalActionState must be 'all', 'any' or a number of goals, not %s" % (policy,))
+
+        # Set action properties
+        self._action_name = action_name
+        self._action_spec = action_spec
+        self._policy = policy
+
+        # Set timeouts
+        self._exec_timeout = exec_timeout
+        self._cancel_timeout = cancel_timeout
+        self._server_wait_timeout = server_wait_timeout
+
+        # Set userdata keys
+        self._goals_key = goals_key
+        self.register_input_keys([goals_key])
+        self._results_key = results_key
+        if results_key is not None:
+            self.register_output_keys([results_key])
+        self._statuses_key = statuses_key
+        if statuses_key is not None:
+            self.register_output_keys([statuses_key])
+
+        # Goals of the current execution, and a token identifying the
+        # execution in callbacks
+        self._goals = []
+        self._goal_token = 0
+        self._cond = threading.Condition()
+
+        self._action_client = None
+        self._client_lock = threading.Lock()
+        if not lazy_connect:
+            self.warm()
+
+    def warm(self):
+        """Get the shared action client, if this state does not have it yet,
+        and start waiting for the action server in the background. This does
+        not block."""
+        with self._client_lock:
+            if self._action_client is None:
+                self._action_client = acquire_action_client(self._action_name, self._action_spec)
+
+    def close(self):
+        """Give back the shared action client. The state gets it again if it
+        is executed or warmed afterwards."""
+        with self._client_lock:
+            if self._action_client is not None:
+                release_action_client(self._action_client)
+                self._action_client = None
+
+    ### smach State API
+    def request_preempt(self):
+        rospy.loginfo("Preempt requested on action '%s'" % (self._action_name))
+        smach.State.request_preempt(self)
+        with self._cond:
+            self._cond.notify_all()
+
+    def execute(self, ud):
+        """Send the goals and wait until the policy is met or can no longer be
+        met, and the goals still running are cancelled."""
+        # Make sure we're connected to the action server
+        self.warm()
+        if not self._action_client.is_connected():
+            rospy.logwarn("Still waiting for action server '%s' to start... is it running?" % self._action_name)
+        if not self._action_client.wait_for_server(self._server_wait_timeout, self.preempt_requested):
+            if self.preempt_requested():
+                rospy.loginfo("Preempting %s before sending goals." % self._action_name)
+                self.service_preempt()
+                return 'preempted'
+            rospy.logfatal("Action server for " + self._action_name + " is not running.")
+            return 'aborted'
+
+        # Check for preemption before executing
+        if self.preempt_requested():
+            rospy.loginfo("Preempting %s before sending goals." % self._action_name)
+            self.service_preempt()
+            return 'preempted'
+
+        goals = list(ud[self._goals_key])
+        if self._policy == 'all':
+            required = len(goals)
+        elif self._policy == 'any':
+            required = min(1, len(goals))
+        else:
+            required = self._policy
+        if required > len(goals):
+            rospy.logerr("Action state for %s requires %d goals to succeed, but only %d goals were given." % (
+                self._action_name, required, len(goals)))
+            return 'aborted'
+
+        # Dispatch the goals via non-blocking calls to the action client. The
+        # condition is not held while sending, since the callbacks of goals
+        # of other states sharing the client may be called in the meantime.
+        with self._cond:
+            self._goal_token += 1
+            goal_token = self._goal_token
+            self._goals = [_Goal() for _ in goals]
+        for (index, goal) in enumerate(goals):
+            if self.preempt_requested():
+                break
+            handle = self._action_client.send_goal(
+                goal,
+                lambda gh, index=index: self._goal_transition_cb(goal_token, index, gh))
+            with self._cond:
+                self._goals[index].handle = handle
+                if self._exec_timeout and not self._goals[index].done:
+                    self._goals[index].execution_timer = get_scheduler().call_later(
+                        self._exec_timeout, self._execution_timeout_cb, goal_token, index)
+
+        # Wait until the outcome is decided
+        with self._cond:
+            while not self.preempt_requested():
+                n_succeeded = sum(1 for g in self._goals if g.done and g.status == GoalStatus.SUCCEEDED)
+                n_failed = sum(1 for g in self._goals if g.done and g.status != GoalStatus.SUCCEEDED)
+                if n_succeeded >= required or n_failed > len(goals) - required:
+                    break
+                self._cond.wait()
+
+        # Cancel the goals still running, and wait for them to terminate
+        self._cancel_goals(goal_token)
+        with self._cond:
+            while not all(g.done or g.handle is None for g in self._goals):
+                self._cond.wait()
+            for g in self._goals:
+                self._cancel_timers(g)
+            results = [g.result for g in self._goals]
+            statuses = [g.status for g in self._goals]
+
+        if self._results_key is not None:
+            ud[self._results_key] = results
+        if self._statuses_key is not None:
+            ud[self._statuses_key] = statuses
+
+        if self.preempt_requested():
+            self.service_preempt()
+            return 'preempted'
+        if sum(1 for status in statuses if status == GoalStatus.SUCCEEDED) >= required:
+            return 'succeeded'
+        return 'aborted'
+
+    def _cancel_goals(self, goal_token, indices=None):
+        """Cancel the goals of an execution that are still running.
+        This must not be called while holding the condition, since cancelling
+        locks the goal, which the action client holds while calling back."""
+        handles = []
+        with self._cond:
+            if goal_token != self._goal_token:
+                return
+            if indices is None:
+                indices = range(len(self._goals))
+            for index in indices:
+                g = self._goals[index]
+                if g.done or g.handle is None or g.cancelation_timer is not None:
+                    continue
+                g.cancelation_timer = get_scheduler().call_later(
+                    self._cancel_timeout, self._cancelation_timeout_cb, goal_token, index)
+                handles.append(g.handle)
+        for handle in handles:
+            handle.cancel()
+
+    def _cancel_timers(self, g):
+        get_scheduler().cancel(g.execution_timer)
+        get_scheduler().cancel(g.cancelation_timer)
+        g.execution_timer = None
+        g.cancelation_timer = None
+
+    def _execution_timeout_cb(self, goal_token, index):
+        """Internal method for cancelling a timed out goal after a timeout."""
+        with self._cond:
+            if goal_token != self._goal_token or self._goals[index].done:
+                return
+        rospy.logwarn("Action %s timed out after %d seconds. Cancelling goal %d." % (
+            self._action_name, self._exec_timeout.to_sec(), index))
+        self._cancel_goals(goal_token, [index])
+
+    def _cancelation_timeout_cb(self, goal_token, index):
+        with self._cond:
+            if goal_token != self._goal_token or self._goals[index].done:
+                return
+            g = self._goals[index]
+            rospy.logerr("Goal %d of action %s could not be canceled for more than %d seconds. Giving up on it!" % (
+                index, self._action_name, self._cancel_timeout.to_sec()))
+            g.done = True
+            g.status = GoalStatus.LOST
+            self._cond.notify_all()
+
+    ### Action client callbacks
+    def _goal_transition_cb(self, goal_token, index, goal_handle):
+        """Goal Transition Callback
+        This records the status and result of a goal when it terminates.
+        """
+        comm_state = goal_handle.get_comm_state()
+        if comm_state == CommState.ACTIVE:
+            rospy.logdebug("Goal %d of action %s has gone active." % (index, self._action_name))
+        elif comm_state == CommState.DONE:
+            with self._cond:
+                if goal_token != self._goal_token or self._goals[index].done:
+                    return
+                g = self._goals[index]
+                g.done = True
+                g.status = goal_handle.get_goal_status()
+                g.result = goal_handle.get_result()
+                self._cancel_timers(g)
+                self._cond.notify_all()
@@ -0,0 +1,231 @@
+import rospy
+
+import heapq
+import itertools
+import threading
+import traceback
+
+__all__ = ['Scheduler', 'TimerHandle', 'get_scheduler']
+
+
+class TimerHandle(object):
+    """Handle to a callback scheduled with a L{Scheduler}."""
+
+    __slots__ = ['_scheduler', '_deadline', '_period', '_cb', '_args', '_cancelled', '_in_heap']
+
+    def __init__(self, scheduler, deadline, period, cb, args):
+        self._scheduler = scheduler
+        self._deadline = deadline
+        self._period = period
+        self._cb = cb
+        self._args = args
+        self._cancelled = False
+        # Whether the handle is in the heap of the scheduler
+        self._in_heap = False
+
+    def cancel(self):
+        """Cancel the callback. This can be called from any thread, including
+        from the callback itself."""
+        scheduler = self._scheduler
+        with scheduler._cond:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            if self._in_heap:
+                # Cancelled timers stay in the heap until they are due or purged
+                scheduler._n_cancelled += 1
+
+    def cancelled(self):
+        return self._cancelled
+
+
+class Scheduler(object):
+    """Single thread firing timed callbacks.
+
+    Deadlines are kept in a heap ordered by ROS time, and the thread sleeps
+    until the earliest one is due, so pending timers cost no wakeups. When
+    simulated time is used, the thread waits on the rospy clock condition and
+    deadlines follow the /clock topic.
+
+    Callbacks run on the scheduler thread, one after the other. They must not
+    block; longer work should be handed to an executor.
+
+    The thread stops on ROS shutdown. Pending one-shot callbacks are then
+    called right away, so nothing keeps waiting on them, and periodic
+    callbacks stop. One-shot callbacks scheduled after shutdown are called
+    right away as well, on a thread of their own.
+    """
+
+    # Upper bound on a single wait, so the thread notices ROS shutdown
+    MAX_WAIT = 1.0
+
+    def __init__(self, name='smach_scheduler'):
+        self._name = name
+        self._heap = []
+        self._seq = itertools.count()
+        self._n_cancelled = 0
+        self._cond = None
+        self._thread = None
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def call_at(self, time, cb, *args):
+        """Call C{cb(*args)} at a given time.
+
+        @type time: C{rospy.Time} or float
+        @param time: The ROS time at which to call the callback.
+
+        @rtype: L{TimerHandle}
+        """
+        return self._schedule(_to_sec(time), None, cb, args)
+
+    def call_later(self, delay, cb, *args):
+        """Call C{cb(*args)} after a delay.
+
+        @type delay: C{rospy.Duration} or float
+        @param delay: The delay in (ROS time) seconds.
+
+        @rtype: L{TimerHandle}
+        """
+        return self._schedule(rospy.get_time() + _to_sec(delay), None, cb, args)
+
+    def call_every(self, period, cb, *args):
+        """Call C{cb(*args)} periodically, starting one period from now.
+
+        @type period: C{rospy.Duration} or float
+        @param period: The period in (ROS time) seconds.
+
+        @rtype: L{TimerHandle}
+        """
+        period = _to_sec(period)
+        if period <= 0.0:
+            raise ValueError("The period of a timer must be positive.")
+        return self._schedule(rospy.get_time() + period, period, cb, args)
+
+    def cancel(self, handle):
+        """Cancel a scheduled callback.
+
+        @type handle: L{TimerHandle}
+        """
+        if handle is not None:
+            handle.cancel()
+
+    def _schedule(self, deadline, period, cb, args):
+        handle = TimerHandle(self, deadline, period, cb, args)
+        cond = self._start()
+        with cond:
+            if not self._stopped:
+                self._push(handle)
+                if self._heap[0][2] is handle:
+                    # The new deadline is the earliest one
+                    cond.notify_all()
+                return handle
+        # The scheduler thread is gone, so it would never fire the timer
+        if period is None:
+            thread = threading.Thread(name=self._name, target=self._fire, args=([handle],))
+            thread.daemon = True
+            thread.start()
+        else:
+            handle.cancel()
+        return handle
+
+    def _push(self, handle):
+        handle._in_heap = True
+        heapq.heappush(self._heap, (handle._deadline, next(self._seq), handle))
+
+    def _pop(self):
+        handle = heapq.heappop(self._heap)[2]
+        handle._in_heap = False
+        return handle
+
+    def _start(self):
+        """Start the scheduler thread on first use."""
+        with self._lock:
+            if self._thread is None:
+                if rospy.rostime.is_wallclock():
+                    self._cond = threading.Condition()
+                else:
+                    # This condition is notified on every clock message
+                    self._cond = rospy.rostime.get_rostime_cond()
+                self._thread = threading.Thread(name=self._name, target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            return self._cond
+
+    def _run(self):
+        cond = self._cond
+        cond.acquire()
+        try:
+            while not rospy.is_shutdown():
+                # Drop cancelled timers from the heap once they pile up
+                if self._n_cancelled > 64 and self._n_cancelled > len(self._heap) // 2:
+                    for e in self._heap:
+                        if e[2]._cancelled:
+                            e[2]._in_heap = False
+                    self._heap = [e for e in self._heap if not e[2]._cancelled]
+                    heapq.heapify(self._heap)
+                    self._n_cancelled = 0
+
+                if not self._heap:
+                    cond.wait(self.MAX_WAIT)
+                    continue
+
+                (deadline, _, handle) = self._heap[0]
+                if handle._cancelled:
+                    self._pop()
+                    self._n_cancelled -= 1
+                    continue
+
+                now = rospy.get_time()
+                if deadline > now:
+                    cond.wait(min(deadline - now, self.MAX_WAIT))
+                    continue
+
+                self._pop()
+                if handle._period is not None:
+                    # Re-arm without accumulating drift, skipping missed periods
+                    handle._deadline += handle._period
+                    if handle._deadline <= now:
+                        handle._deadline = now + handle._period
+                    self._push(handle)
+
+                cond.release()
+                try:
+                    self._fire([handle])
+                finally:
+                    cond.acquire()
+
+            # Fire the pending one-shot timers rather than dropping them
+            self._stopped = True
+            pending = [e[2] for e in sorted(self._heap)
+                       if not e[2]._cancelled and e[2]._period is None]
+            for e in self._heap:
+                e[2]._in_heap = False
+            self._heap = []
+            self._n_cancelled = 0
+        finally:
+            cond.release()
+        self._fire(pending)
+
+    def _fire(self, handles):
+        for handle in handles:
+            try:
+                handle._cb(*handle._args)
+            except Exception:
+                rospy.logerr("Exception in SMACH scheduler callback %s: %s", handle._cb, traceback.format_exc())
+
+
+def _to_sec(t):
+    if hasattr(t, 'to_sec'):
+        return t.to_sec()
+    return float(t)
+
+
+# Process-wide scheduler
+_scheduler = Scheduler()
+
+
+def get_scheduler():
+    """Get the process-wide L{Scheduler} used by SMACH ROS states and
+    introspection."""
+    return _scheduler
@@ -1,14 +1,21 @@
 import rospy
 
+import threading
 import traceback
 
 import smach
 
+from smach_ros.msg_metadata import get_service_metadata
+
 __all__ = ['ServiceState']
 
 
 class ServiceState(smach.State):
-    """State for calling a service."""
+    """State for calling a service.
+
+    The state connects to the service when it is first executed, or in the
+    background once L{warm} is called.
+    """
 
     def __init__(self,
                  # Service info
@@ -59,10 +66,13 @@ class ServiceState(smach.State):
         self._service_spec = service_spec
 
         self._proxy = None
+        self._connect_thread = None
+        self._connect_lock = threading.Lock()
 
         # Store request policy
+        metadata = get_service_metadata(service_spec)
         if request is None:
-            self._request = service_spec._request_class()
+            self._request = metadata.request_class()
         else:
             self._request = request
 
@@ -86,6 +96,10 @@ class ServiceState(smach.State):
         if request_key is not None:
             self.register_input_keys([request_key])
 
+        if not all(s in metadata.request_slots for s in request_slots):
+            raise smach.InvalidStateError(
+                "Request slots specified are not valid slots. Available slots: %s; specified slots: %s" % (
+                    sorted(metadata.request_slots), request_slots))
         self._request_slots = request_slots
         self.register_input_keys(request_slots)
 
@@ -119,9 +133,49 @@ class ServiceState(smach.State):
         if response_key is not None:
             self.register_output_keys([response_key])
 
+        if not all(s in metadata.response_slots for s in response_slots):
+            raise smach.InvalidStateError(
+                "Response slots specified are not valid slots. Available slots: %s; specified slots: %s" % (
+                    sorted(metadata.response_slots), response_slots))
         self._response_slots = response_slots
         self.register_output_keys(response_slots)
 
+    def warm(self):
+        """Start connecting to the service in the background, unless this
+        state is connected or already connecting. This does not block."""
+        with self._connect_lock:
+            if self._proxy is not None or (self._connect_thread is not None and self._connect_thread.is_alive()):
+                return
+            self._connect_thread = threading.Thread(name=self._service_name + '/wait_for_service',
+                                                    target=self._wait_for_service)
+            self._connect_thread.daemon = True
+            self._connect_thread.start()
+
+    def _wait_for_service(self):
+        while self._proxy is None and not rospy.is_shutdown():
+            try:
+                self._connect()
+            except:
+                if not rospy.core._in_shutdown:
+                    rospy.logerr("Failed to wait for service '%s'" % self._service_name)
+                return
+
+    def _connect(self):
+        """Wait up to a second for the service and connect to it.
+
+        @rtype: bool
+        @return: True if the state is connected to the service.
+        """
+        try:
+            rospy.wait_for_service(self._service_name, 1.0)
+        except rospy.ROSException:
+            return self._proxy is not None
+        with self._connect_lock:
+            if self._proxy is None:
+                self._proxy = rospy.ServiceProxy(self._service_name, self._service_spec)
+                rospy.logdebug("Connected to service '%s'" % self._service_name)
+        return True
+
     def execute(self, ud):
         """Execute service"""
         # Check for preemption before executing
@@ -140,11 +194,7 @@ class ServiceState(smach.State):
                 if rospy.is_shutdown():
                     rospy.loginfo("Shutting down while waiting for service '%s'." % self._service_name)
                     return 'aborted'
-                try:
-                    rospy.wait_for_service(self._service_name, 1.0)
-                    self._proxy = rospy.ServiceProxy(self._service_name, self._service_spec)
-                    rospy.logdebug("Connected to service '%s'" % self._service_name)
-                except rospy.ROSException as ex:
+                if not self._connect():
                     rospy.logwarn("Still waiting for service '%s'..." % self._service_name)
         except:
             rospy.logwarn("Terminated while waiting for service '%s'." % self._service_name)
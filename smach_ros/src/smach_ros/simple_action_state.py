@@ -2,12 +2,17 @@ import rospy
 
 import threading
 import traceback
-import copy
+import six
 
-from actionlib.simple_action_client import SimpleActionClient, GoalStatus
+from actionlib.action_client import CommState
+from actionlib_msgs.msg import GoalStatus
 
 import smach
 
+from smach_ros.action_client_pool import acquire_action_client, release_action_client
+from smach_ros.msg_metadata import get_action_metadata
+from smach_ros.scheduler import get_scheduler
+
 __all__ = ['SimpleActionState']
 
 
@@ -15,6 +20,11 @@ class SimpleActionState(smach.State):
     """Simple action client state.
     
     Use this class to represent an actionlib as a state in a state machine.
+
+    All states of a process that use the same action server share a single
+    action client, see L{SharedActionClient}. Call L{close} to give it back
+    when the state is no longer used. With C{lazy_connect}, the client is
+    only obtained when the state is first executed or L{warm}ed.
     """
 
     # Meta-states for this action
@@ -49,6 +59,8 @@ class SimpleActionState(smach.State):
                  exec_timeout=None,
                  cancel_timeout=rospy.Duration(15.0),
                  server_wait_timeout=rospy.Duration(60.0),
+                 # Connection
+                 lazy_connect=False,
                  ):
         """Constructor for SimpleActionState action client wrapper.
         
@@ -112,6 +124,11 @@ class SimpleActionState(smach.State):
         @type server_wait_timeout: C{rospy.Duration}
         @param server_wait_timeout: This is the timeout used for aborting while
         waiting for an action server to become active.
+
+        @type lazy_connect: bool
+        @param lazy_connect: If True, the action client is not created or
+        connected when the state is constructed, but when it is first
+        executed or L{warm} is called.
         """
 
         if goal_slots is None:
@@ -150,17 +167,18 @@ class SimpleActionState(smach.State):
         # Set goal generation policy
         if goal and hasattr(goal, '__call__'):
             raise smach.InvalidStateError("Goal object given to SimpleActionState that IS a function object")
-        sl = action_spec().action_goal.goal.__slots__
+        metadata = get_action_metadata(action_spec)
+        sl = metadata.goal_slots
         if not all([s in sl for s in goal_slots]):
             raise smach.InvalidStateError(
-                "Goal slots specified are not valid slots. Available slots: %s; specified slots: %s" % (sl, goal_slots))
+                "Goal slots specified are not valid slots. Available slots: %s; specified slots: %s" % (sorted(sl), goal_slots))
         if goal_cb and not hasattr(goal_cb, '__call__'):
             raise smach.InvalidStateError(
                 "Goal callback object given to SimpleActionState that IS NOT a function object")
 
         # Static goal
         if goal is None:
-            self._goal = copy.copy(action_spec().action_goal.goal)
+            self._goal = metadata.goal_class()
         else:
             self._goal = goal
 
@@ -191,7 +209,7 @@ class SimpleActionState(smach.State):
         if result_cb and not hasattr(result_cb, '__call__'):
             raise smach.InvalidStateError(
                 "Result callback object given to SimpleActionState that IS NOT a function object")
-        if not all([s in action_spec().action_result.result.__slots__ for s in result_slots]):
+        if not all([s in metadata.result_slots for s in result_slots]):
             raise smach.InvalidStateError("Result slots specified are not valid slots.")
 
         # Result callback
@@ -232,89 +250,93 @@ class SimpleActionState(smach.State):
         self._duration = rospy.Duration(0.0)
         self._status = SimpleActionState.WAITING_FOR_SERVER
 
-        # Construct action client, and wait for it to come active
-        self._action_client = SimpleActionClient(action_name, action_spec)
-        self._action_wait_thread = threading.Thread(name=self._action_name + '/wait_for_server',
-                                                    target=self._wait_for_server)
-        self._action_wait_thread.start()
+        # Get the shared action client, which waits for the server to come
+        # active in the background
+        self._action_client = None
+        self._client_lock = threading.Lock()
+        if not lazy_connect:
+            self.warm()
 
-        self._execution_timer_thread = None
-        self._cancelation_timer_thread = None
+        # Handle of the current goal, and timers for its execution and
+        # cancelation timeouts
+        self._goal_handle = None
+        self._goal_token = 0
+        self._execution_timer = None
+        self._cancelation_timer = None
 
         # Condition variables for threading synchronization
         self._done_cond = threading.Condition()
 
+    def warm(self):
+        """Get the shared action client, if this state does not have it yet,
+        and start waiting for the action server in the background. This does
+        not block."""
+        with self._client_lock:
+            if self._action_client is None:
+                self._action_client = acquire_action_client(self._action_name, self._action_spec)
+
+    def close(self):
+        """Give back the shared action client. The state gets it again if it
+        is executed or warmed afterwards."""
+        with self._client_lock:
+            if self._action_client is not None:
+                release_action_client(self._action_client)
+                self._action_client = None
+                self._status = SimpleActionState.WAITING_FOR_SERVER
+
     def _wait_for_server(self):
-        """Internal method for waiting for the action server
-        This is run in a separate thread and allows construction of this state
-        to not block the construction of other states.
-        """
-        timeout_time = rospy.get_rostime() + self._server_wait_timeout
-        while self._status == SimpleActionState.WAITING_FOR_SERVER and not rospy.is_shutdown() and not rospy.get_rostime() >= timeout_time:
-            try:
-                if self._action_client.wait_for_server(rospy.Duration(1.0)):  # self._server_wait_timeout):
-                    self._status = SimpleActionState.INACTIVE
-                if self.preempt_requested():
-                    return
-            except:
-                if not rospy.core._in_shutdown:  # This is a hack, wait_for_server should not throw an exception just because shutdown was called
-                    rospy.logerr("Failed to wait for action server '%s'" % (self._action_name))
+        """Internal method for waiting for the action server, until the
+        server wait timeout or preemption."""
+        if self._action_client.wait_for_server(self._server_wait_timeout, self.preempt_requested):
+            self._status = SimpleActionState.INACTIVE
 
-    def _execution_timer(self):
+    def _goal_str(self):
+        if isinstance(self._goal, six.text_type):
+            return self._goal.encode('utf8')
+        return self._goal
+
+    def _execution_timeout_cb(self, goal_token):
         """Internal method for cancelling a timed out goal after a timeout."""
-        while self._status == SimpleActionState.ACTIVE and not rospy.is_shutdown():
-            try:
-                rospy.sleep(0.1)
-            except:
-                if not rospy.is_shutdown():
-                    rospy.logerr("Failed to sleep while running '%s'" % self._action_name)
-            if rospy.Time.now() - self._activate_time > self._exec_timeout:
-                goal = None
-                if isinstance(self._goal, unicode):
-                    goal = self._goal.encode('utf8')
-                else:
-                    goal = self._goal
-                rospy.logwarn("Action %s timed out after %d seconds. Cancelling goal: \n%s" % (
-                self._action_name, self._exec_timeout.to_sec(), goal))
-                # Cancel the goal
-                self.cancel_goal()
-                break
+        if self._status != SimpleActionState.ACTIVE or goal_token != self._goal_token:
+            return
+        rospy.logwarn("Action %s timed out after %d seconds. Cancelling goal: \n%s" % (
+            self._action_name, self._exec_timeout.to_sec(), self._goal_str()))
+        # Cancel the goal
+        self.cancel_goal()
+
+    def _cancel_timers(self):
+        get_scheduler().cancel(self._execution_timer)
+        get_scheduler().cancel(self._cancelation_timer)
+        self._execution_timer = None
+        self._cancelation_timer = None
 
     ### smach State API
     def request_preempt(self):
         rospy.loginfo("Preempt requested on action '%s'" % (self._action_name))
         smach.State.request_preempt(self)
         if self._status == SimpleActionState.ACTIVE:
-            goal = None
-            if isinstance(self._goal, unicode):
-                goal = self._goal.encode('utf8')
-            else:
-                goal = self._goal
-            rospy.loginfo("Preempt on action '%s' cancelling goal: \n%s" % (self._action_name, goal))
+            rospy.loginfo("Preempt on action '%s' cancelling goal: \n%s" % (self._action_name, self._goal_str()))
             # Cancel the goal
             self.cancel_goal()
 
     def cancel_goal(self):
-        self._action_client.cancel_goal()
+        goal_handle = self._goal_handle
+        if goal_handle is not None:
+            goal_handle.cancel()
         self._cancel_time = rospy.Time.now()
-        self._cancelation_timer_thread = threading.Thread(name=self._action_name + '/cancel_watchdog',
-                                                          target=self._cancelation_timer)
-        self._cancelation_timer_thread.start()
-
-    def _cancelation_timer(self):
-        while self._status == SimpleActionState.ACTIVE and not rospy.is_shutdown():
-            try:
-                rospy.sleep(0.1)
-            except:
-                if not rospy.is_shutdown():
-                    rospy.logerr("Failed to sleep while running '%s'" % self._action_name)
-            if rospy.Time.now() - self._cancel_time > self._cancel_timeout:
-                rospy.logerr("Action %s could not be canceled for more than %d seconds. Force state transition!" % (
-                self._action_name, self._cancel_timeout.to_sec()))
-                self._status = SimpleActionState.INACTIVE
-                self._done_cond.acquire()
-                self._done_cond.notify()
-                self._done_cond.release()
+        if self._cancelation_timer is None:
+            self._cancelation_timer = get_scheduler().call_later(
+                self._cancel_timeout, self._cancelation_timeout_cb, self._goal_token)
+
+    def _cancelation_timeout_cb(self, goal_token):
+        if self._status != SimpleActionState.ACTIVE or goal_token != self._goal_token:
+            return
+        rospy.logerr("Action %s could not be canceled for more than %d seconds. Force state transition!" % (
+            self._action_name, self._cancel_timeout.to_sec()))
+        self._status = SimpleActionState.INACTIVE
+        self._done_cond.acquire()
+        self._done_cond.notify()
+        self._done_cond.release()
 
     def execute(self, ud):
         """Called when executing a state.
@@ -323,23 +345,20 @@ class SimpleActionState(smach.State):
         """
 
         # Make sure we're connected to the action server
+        self.warm()
         if self._status is SimpleActionState.WAITING_FOR_SERVER:
-            rospy.logwarn("Still waiting for action server '%s' to start... is it running?" % self._action_name)
-            if self._action_wait_thread.is_alive():
-                # Block on joining the server wait thread (This can be preempted)
-                self._action_wait_thread.join()
-            else:
-                # Wait for the server in this thread (This can also be preempted)
-                self._wait_for_server()
+            if not self._action_client.is_connected():
+                rospy.logwarn("Still waiting for action server '%s' to start... is it running?" % self._action_name)
+            # Wait for the server (This can be preempted)
+            self._wait_for_server()
 
-            if not self.preempt_requested():
-                # In case of preemption we probably didn't connect
+            if self._status is SimpleActionState.INACTIVE:
                 rospy.loginfo("Connected to action server '%s'." % self._action_name)
 
         # Check if server is still available
         if self._status is SimpleActionState.INACTIVE:
             try:
-                if not self._action_client.wait_for_server(rospy.Duration(1.0)):
+                if not self._action_client.check_server(rospy.Duration(1.0)):
                     rospy.logerr("Failed to wait for action server '%s'" % (self._action_name))
                     return 'aborted'
             except:
@@ -392,22 +411,38 @@ class SimpleActionState(smach.State):
                 "Attempting to activate action " + self._action_name + " with no goal or goal callback set. Did you construct the SimpleActionState properly?")
             return 'aborted'
 
-        # Dispatch goal via non-blocking call to action client
+        # Dispatch goal via non-blocking call to action client. The done
+        # condition is not held while sending, since the callbacks of goals of
+        # other states sharing the client may be called in the meantime.
         self._activate_time = rospy.Time.now()
+        self._goal_token += 1
+        goal_token = self._goal_token
+        self._goal_handle = None
         self._status = SimpleActionState.ACTIVE
+        goal_handle = self._action_client.send_goal(
+            self._goal,
+            lambda gh: self._goal_transition_cb(goal_token, gh),
+            lambda gh, feedback: self._goal_feedback_cb(feedback))
+
+        self._goal_handle = goal_handle
+        if self.preempt_requested() and self._status == SimpleActionState.ACTIVE:
+            # Preempted while the goal was being sent. This must not be done
+            # while holding the done condition, since cancelling locks the
+            # goal, which the action client holds while calling back.
+            self.cancel_goal()
 
         # Wait on done condition
         self._done_cond.acquire()
-        self._action_client.send_goal(self._goal, self._goal_done_cb, self._goal_active_cb, self._goal_feedback_cb)
 
-        # Preempt timeout watch thread
+        # Preempt timeout
         if self._exec_timeout:
-            self._execution_timer_thread = threading.Thread(name=self._action_name + '/preempt_watchdog',
-                                                            target=self._execution_timer)
-            self._execution_timer_thread.start()
+            self._execution_timer = get_scheduler().call_later(
+                self._exec_timeout, self._execution_timeout_cb, self._goal_token)
 
         # Wait for action to finish
-        self._done_cond.wait()
+        while self._status == SimpleActionState.ACTIVE:
+            self._done_cond.wait()
+        self._cancel_timers()
 
         # Call user result callback if defined
         result_cb_outcome = None
@@ -470,6 +505,21 @@ class SimpleActionState(smach.State):
         return outcome
 
     ### Action client callbacks
+    def _goal_transition_cb(self, goal_token, goal_handle):
+        """Goal Transition Callback
+        This dispatches the communication state changes of a goal to the
+        active and done callbacks.
+        """
+        comm_state = goal_handle.get_comm_state()
+        if comm_state == CommState.ACTIVE:
+            self._goal_active_cb()
+        elif comm_state == CommState.DONE:
+            with self._done_cond:
+                # Ignore goals that were given up on by the cancelation timeout
+                if goal_token != self._goal_token or self._status != SimpleActionState.ACTIVE:
+                    return
+                self._goal_done_cb(goal_handle.get_goal_status(), goal_handle.get_result())
+
     def _goal_active_cb(self):
         """Goal Active Callback
         This callback starts the timer that watches for the timeout specified for this action.
@@ -498,7 +548,7 @@ class SimpleActionState(smach.State):
         self._duration = rospy.Time.now() - self._activate_time
         rospy.logdebug("Action " + self._action_name + " terminated after "
                        + str(self._duration.to_sec()) + " seconds with result "
-                       + get_result_str(self._action_client.get_state()) + ".")
+                       + get_result_str(result_state) + ".")
 
         # Store goal state
         self._goal_status = result_state
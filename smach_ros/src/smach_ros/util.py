@@ -1,8 +1,30 @@
 import rospy
 
+import threading
 from multiprocessing.pool import ThreadPool
 
-__all__ = ['set_preempt_handler', 'start']
+import smach
+
+__all__ = ['set_preempt_handler', 'start', 'RosLogSink']
+
+
+class RosLogSink(smach.LogSink):
+    """SMACH log sink writing to rosout.
+
+    Messages and their arguments are handed to the rospy logging functions
+    unformatted, so messages below the level of the rosout logger are never
+    formatted.
+    """
+
+    def __init__(self):
+        self._loggers = {
+            smach.log.DEBUG: rospy.logdebug,
+            smach.log.INFO: rospy.loginfo,
+            smach.log.WARN: rospy.logwarn,
+            smach.log.ERROR: rospy.logerr}
+
+    def log(self, level, msg, args):
+        self._loggers[level](msg, *args)
 
 
 # Signal handler
@@ -17,13 +39,18 @@ def set_preempt_handler(sc):
     @param sc: Container to preempt on ROS shutdown.
     """
 
+    # Set when the container terminates
+    terminated = threading.Event()
+    sc.register_termination_cb(lambda *args: terminated.set())
+
     ### Define handler
     def handler(sc):
+        terminated.clear()
         sc.request_preempt()
 
-        while sc.is_running():
+        while sc.is_running() and not terminated.is_set():
             rospy.loginfo("Received shutdown request... sent preempt... waiting for state machine to terminate.")
-            rospy.sleep(1.0)
+            terminated.wait(1.0)
 
     ### Add handler
     rospy.core.add_client_shutdown_hook(lambda: handler(sc))
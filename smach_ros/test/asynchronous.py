@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import rospy
+import rostest
+
+import asyncio
+import unittest
+
+from smach import AsyncConcurrence, AsyncIterator, AsyncState, AsyncStateMachine, \
+    Concurrence, Iterator, State, StateMachine, execute_async
+
+
+### Custom state classes
+class Sleep(AsyncState):
+    """State that sleeps on the event loop"""
+
+    def __init__(self, duration):
+        AsyncState.__init__(self, ['done', 'preempted'], [], ['slept'])
+        self.duration = duration
+
+    async def execute(self, ud):
+        await asyncio.sleep(self.duration)
+        ud.slept = self.duration
+        return 'done'
+
+
+class Setter(State):
+    """State that sets the key 'a' in its userdata"""
+
+    def __init__(self):
+        State.__init__(self, ['done'], [], ['a'])
+
+    def execute(self, ud):
+        ud.a = 'A'
+        return 'done'
+
+
+### Test harness
+class TestAsyncContainers(unittest.TestCase):
+    def test_state_machine(self):
+        """Test async state machine with async and sync states."""
+        sm = AsyncStateMachine(['done', 'preempted'])
+        with sm:
+            StateMachine.add('SLEEP', Sleep(0.01), {'done': 'SETTER'})
+            StateMachine.add('SETTER', Setter(), {'done': 'done'})
+
+        outcome = asyncio.run(execute_async(sm))
+
+        assert outcome == 'done'
+        assert sm.userdata.slept == 0.01
+        assert sm.userdata.a == 'A'
+
+    def test_concurrence(self):
+        """Test that many async children share the event loop."""
+        cc = AsyncConcurrence(['done'], 'done')
+        with cc:
+            for i in range(500):
+                Concurrence.add('SLEEP_%d' % i, Sleep(0.5))
+
+        start = rospy.get_time()
+        outcome = asyncio.run(execute_async(cc))
+
+        assert outcome == 'done'
+        assert rospy.get_time() - start < 5.0
+
+    def test_concurrence_preempt(self):
+        """Test that siblings are cancelled once the outcome is decided."""
+        cc = AsyncConcurrence(['succeeded', 'done'], 'done',
+                              outcome_map={'succeeded': {'SHORT': 'done', 'LONG': 'preempted'}},
+                              child_termination_cb=lambda so: True)
+        with cc:
+            Concurrence.add('SHORT', Sleep(0.01))
+            Concurrence.add('LONG', Sleep(60.0))
+
+        outcome = asyncio.run(execute_async(cc))
+
+        assert outcome == 'succeeded'
+
+    def test_state_machine_preempt(self):
+        """Test preempting an async state machine from another thread."""
+        sm = AsyncStateMachine(['done', 'preempted'])
+        with sm:
+            StateMachine.add('SLEEP', Sleep(60.0), {'done': 'done'})
+
+        async def run():
+            task = asyncio.ensure_future(execute_async(sm))
+            await asyncio.sleep(0.1)
+            await asyncio.get_running_loop().run_in_executor(None, sm.request_preempt)
+            return await task
+
+        outcome = asyncio.run(run())
+
+        assert outcome == 'preempted'
+        assert not sm.preempt_requested()
+
+    def test_iterator(self):
+        """Test async iterator."""
+        it = AsyncIterator(['done'], [], ['slept'], it=[0.01, 0.02], exhausted_outcome='done')
+        with it:
+            Iterator.set_contained_state('SLEEP', Sleep(0.01), loop_outcomes=['done'])
+
+        outcome = asyncio.run(execute_async(it))
+
+        assert outcome == 'done'
+
+    def test_iterator_results(self):
+        """Test collecting the results of an async iterator."""
+        it = AsyncIterator(['done'], [], ['durations'], it=[0.01, 0.02], exhausted_outcome='done',
+                           result_key='durations', item_result_key='slept')
+        with it:
+            Iterator.set_contained_state('SLEEP', Sleep(0.01), loop_outcomes=['done'])
+
+        outcome = asyncio.run(execute_async(it))
+
+        assert outcome == 'done'
+        assert it.userdata.durations == [0.01, 0.01]
+
+    def test_iterator_reduce(self):
+        """Test folding the results of an async iterator."""
+        it = AsyncIterator(['done'], [], ['total'], it=[0.01, 0.02, 0.03], exhausted_outcome='done',
+                           item_result_key='slept', reduce_cb=lambda acc, r: acc.append(r) or acc,
+                           accumulator_key='total', initial_value=[])
+        with it:
+            Iterator.set_contained_state('SLEEP', Sleep(0.01), loop_outcomes=['done'])
+
+        assert asyncio.run(execute_async(it)) == 'done'
+        assert it.userdata.total == [0.01, 0.01, 0.01]
+        # Each execution starts from a copy of the initial value
+        assert asyncio.run(execute_async(it)) == 'done'
+        assert it.userdata.total == [0.01, 0.01, 0.01]
+
+    def test_iterator_parallel(self):
+        """Test that async iterators reject the parallel map mode."""
+        self.assertRaises(ValueError, AsyncIterator, ['done'], [], [], max_concurrency=4)
+
+
+def main():
+    rospy.init_node('asynchronous_test', log_level=rospy.DEBUG)
+    rostest.rosrun('smach', 'asynchronous_test', TestAsyncContainers)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,7 @@ import unittest
 from actionlib import *
 from actionlib.msg import *
 
-from smach import Concurrence, State, StateMachine
+from smach import Concurrence, State, StateMachine, WorkerPool
 
 # Static goals
 g1 = TestGoal(1)  # This goal should succeed
@@ -125,6 +125,40 @@ class TestStateMachine(unittest.TestCase):
         assert cc.userdata.a == 'A'
         assert cc.userdata.b == 'A'
 
+    def test_decided_outcome(self):
+        """Test that siblings are preempted once the outcome map is decided."""
+        child_outcomes = []
+        cc = Concurrence(['succeeded', 'done'],
+                         default_outcome='done',
+                         child_termination_cb=lambda so: child_outcomes.append(dict(so)) or False,
+                         outcome_map={'succeeded': {'SETTER': 'done'}})
+        with cc:
+            Concurrence.add('SETTER', Setter())
+            Concurrence.add('GETTER', Getter())
+
+        outcome = cc.execute()
+
+        assert outcome == 'succeeded'
+        assert child_outcomes[-1]['GETTER'] == 'preempted'
+
+    def test_executor_reuse(self):
+        """Test that repeated executions reuse the executor's workers."""
+        pool = WorkerPool(max_workers=2)
+        cc = Concurrence(['succeeded', 'done'],
+                         default_outcome='done',
+                         child_termination_cb=lambda so: True,
+                         outcome_map={'succeeded': {'SETTER': 'done', 'GETTER': 'preempted'}},
+                         executor=pool)
+        with cc:
+            Concurrence.add('SETTER', Setter())
+            Concurrence.add('GETTER', Getter())
+
+        for i in range(3):
+            assert cc.execute() == 'succeeded'
+        assert pool.get_num_workers() == 2
+        pool.shutdown()
+        assert pool.get_num_workers() == 0
+
 
 def main():
     rospy.init_node('concurrence_test', log_level=rospy.DEBUG)
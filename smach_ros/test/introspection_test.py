@@ -3,12 +3,17 @@
 import rospy
 import rostest
 
+import pickle
 import threading
 
 import unittest
 
 from smach import State, StateMachine, UserData
 from smach_ros import IntrospectionClient, IntrospectionServer
+from smach_ros.codec import decode_local_data, encode_local_data, get_codec_names
+from smach_ros.introspection import ContainerProxy, LocalDataDecoder, compatible_decode, compatible_encode
+from smach_msgs.msg import SmachContainerStatus, SmachContainerStructure
+from std_msgs.msg import String
 
 
 ### Custom state classe
@@ -88,6 +93,110 @@ class TestIntrospection(unittest.TestCase):
 
         assert outcome == 'done'
 
+    def test_local_data_delta(self):
+        """Test rebuilding userdata from delta-encoded status messages."""
+        def status(base_version, ud):
+            (version, data) = ud.get_changes(base_version)
+            return version, SmachContainerStatus(
+                path='/sm',
+                local_data=compatible_decode(pickle.dumps(data, 2)),
+                data_version=version,
+                base_version=base_version)
+
+        ud = UserData()
+        ud.a = 'A'
+        ud.b = 'B'
+        decoder = LocalDataDecoder()
+        (v1, msg) = status(0, ud)
+        assert decoder.update(msg) == {'a': 'A', 'b': 'B'}
+
+        ud.b = 'C'
+        (v2, msg) = status(v1, ud)
+        assert pickle.loads(compatible_encode(msg.local_data)) == {'b': 'C'}
+        assert decoder.update(msg) == {'a': 'A', 'b': 'C'}
+
+        # A missed message invalidates the data until the next keyframe
+        ud.a = 'D'
+        (v3, msg) = status(v2, ud)
+        ud.b = 'E'
+        (v4, msg) = status(v3, ud)
+        assert decoder.update(msg) is None
+        (v5, msg) = status(0, ud)
+        assert decoder.update(msg) == {'a': 'D', 'b': 'E'}
+
+    def test_status_deltas(self):
+        """Test that status messages only hold changed keys on request."""
+        for send_deltas in (False, True):
+            sm = StateMachine(['done'])
+            with sm:
+                StateMachine.add('SETTER', Setter(), {'done': 'done'})
+            sm.userdata.a = 'A'
+            sm.userdata.b = 'B'
+
+            proxy = ContainerProxy('delta_test', sm, '/delta_test', send_deltas=send_deltas)
+            published = []
+            proxy._status_pub.publish = published.append
+            proxy._publish_status()
+            sm.userdata.b = 'C'
+            proxy._publish_status()
+
+            assert published[0].base_version == 0
+            data = decode_local_data(published[1].local_data_codec, published[1].local_data)
+            if send_deltas:
+                assert published[1].base_version == published[0].data_version
+                assert data == {'b': 'C'}
+            else:
+                assert published[1].base_version == 0
+                assert data == {'a': 'A', 'b': 'C'}
+
+    def test_proxy_startup(self):
+        """Test the construction and start of container proxies."""
+        sm = StateMachine(['done'])
+        with sm:
+            StateMachine.add('SETTER', Setter(), {'done': 'done'})
+
+        update_rate = rospy.Duration(5.0)
+        proxy = ContainerProxy('startup_test', sm, '/startup_test', update_rate)
+        assert proxy._update_rate is update_rate
+        self.assertRaises(TypeError, ContainerProxy, 'startup_test', sm, '/startup_test', update_rate,
+                          keyframe_period=update_rate)
+
+        # Starting publishes the structure, but no second status
+        published = []
+        proxy._status_pub.publish = published.append
+        proxy._structure_pub.publish = published.append
+        proxy.start(heartbeat=False)
+        assert [type(msg) for msg in published] == [SmachContainerStructure]
+        proxy.stop()
+
+    def test_codecs(self):
+        """Test encoding userdata with each codec."""
+        data = {'a': 1, 'b': [1.5, 'x'], 'msg': String(data='hello')}
+        for name in get_codec_names():
+            for compression in [None, 'zlib']:
+                (codec, local_data) = encode_local_data(data, name, compression, 0)
+                assert decode_local_data(codec, local_data) == data, codec
+
+        # JSON rejects values it would alter, other codecs keep them
+        for value in [(1, 2), {1: 'x'}, [{'a': (1,)}]]:
+            for name in get_codec_names():
+                if name == 'json':
+                    self.assertRaises(TypeError, encode_local_data, {'a': value}, name)
+                else:
+                    (codec, local_data) = encode_local_data({'a': value}, name)
+                    assert decode_local_data(codec, local_data) == {'a': value}, codec
+
+        # Compression only applies above the threshold
+        (codec, _) = encode_local_data(data, 'json', 'zlib', 1 << 20)
+        assert codec == 'json'
+
+        # Pickled data is refused if only JSON is allowed
+        (codec, local_data) = encode_local_data(data, 'genpy')
+        self.assertRaises(ValueError, decode_local_data, codec, local_data, ['json'])
+
+        # JSON does not encode arbitrary objects
+        self.assertRaises(TypeError, encode_local_data, {'a': object()}, 'json')
+
 
 def main():
     rospy.init_node('introspection_test', log_level=rospy.DEBUG)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+import rospy
+import rostest
+
+import collections
+import os
+import struct
+import tempfile
+import threading
+import unittest
+
+from smach import BufferItems, InvalidConstructionError, Iterator, State, StateMachine, UserData
+
+
+### Custom state classes
+class Scale(State):
+    """State that multiplies the item by 'factor' and stores it in 'res'.
+    Processing item 5 is slower, and item 7 breaks the iteration."""
+
+    def __init__(self, running=None):
+        State.__init__(self, ['continue', 'found', 'preempted'], ['it_data', 'factor'], ['res'])
+        self._running = running
+
+    def execute(self, ud):
+        if self._running is not None:
+            with self._running[0]:
+                self._running[1] += 1
+                self._running[2] = max(self._running[2], self._running[1])
+        try:
+            end = rospy.Time.now() + rospy.Duration(0.3 if ud.it_data == 5 else 0.05)
+            while rospy.Time.now() < end:
+                if self.preempt_requested():
+                    self.service_preempt()
+                    return 'preempted'
+                rospy.sleep(0.01)
+            ud.res = ud.it_data * ud.factor
+            return 'found' if ud.it_data == 7 else 'continue'
+        finally:
+            if self._running is not None:
+                with self._running[0]:
+                    self._running[1] -= 1
+
+
+def build_iterator(items, **kwargs):
+    it = Iterator(['found', 'preempted'], ['factor'], ['results'], it=items,
+                  result_key='results', item_result_key='res', **kwargs)
+    with it:
+        Iterator.set_contained_state('SCALE', Scale(), loop_outcomes=['continue'])
+    return it
+
+
+class Sum(State):
+    """State that sums a batch of items into 'res'."""
+
+    def __init__(self):
+        State.__init__(self, ['continue'], ['it_data'], ['res'])
+
+    def execute(self, ud):
+        ud.res = sum(ud.it_data)
+        return 'continue'
+
+
+class Double(State):
+    """State that doubles the item into 'res', and writes nothing for None."""
+
+    def __init__(self):
+        State.__init__(self, ['continue'], ['it_data'], ['res'])
+
+    def execute(self, ud):
+        if ud.it_data is not None:
+            ud.res = 2 * ud.it_data
+        return 'continue'
+
+
+class SumDoubles(State):
+    """State that sums a batch of packed doubles into 'res'."""
+
+    def __init__(self):
+        State.__init__(self, ['continue'], ['it_data'], ['res'])
+
+    def execute(self, ud):
+        data = ud.it_data.tobytes()
+        ud.res = sum(struct.unpack('<%dd' % (len(data) // 8), data))
+        return 'continue'
+
+
+### Test harness
+class TestIterator(unittest.TestCase):
+    def test_parallel_map(self):
+        """Test mapping a state over items in parallel."""
+        running = [threading.Lock(), 0, 0]
+        it = build_iterator(range(7), max_concurrency=3,
+                            state_factory=lambda: Scale(running))
+        ud = UserData()
+        ud.factor = 2
+
+        outcome = it.execute(ud)
+
+        assert outcome == 'exhausted'
+        assert ud.results == [0, 2, 4, 6, 8, 10, 12]
+        assert running[2] == 3
+
+    def test_parallel_map_unordered(self):
+        """Test collecting results in completion order."""
+        it = build_iterator(range(7), max_concurrency=3, ordered=False)
+        ud = UserData()
+        ud.factor = 1
+
+        assert it.execute(ud) == 'exhausted'
+        assert sorted(ud.results) == list(range(7))
+        # Item 5 is the slowest
+        assert ud.results[-1] == 5
+
+    def test_parallel_map_break(self):
+        """Test that a break outcome preempts the items in flight."""
+        it = build_iterator(range(20), max_concurrency=4)
+        ud = UserData()
+        ud.factor = 1
+
+        assert it.execute(ud) == 'found'
+        assert 7 in ud.results
+        assert 19 not in ud.results
+
+    def test_parallel_map_container(self):
+        """Test mapping a state machine over items in parallel."""
+        def build_sm():
+            sm = StateMachine(['continue', 'found', 'preempted'], ['it_data', 'factor'], ['res'])
+            with sm:
+                StateMachine.add('SCALE', Scale())
+            return sm
+
+        it = Iterator(['found', 'preempted'], ['factor'], ['results'], it=range(7),
+                      max_concurrency=3, result_key='results', item_result_key='res')
+        # State machines can not be copied, so a factory is required
+        it.open()
+        try:
+            with self.assertRaises(InvalidConstructionError):
+                Iterator.set_contained_state('SM', build_sm(), loop_outcomes=['continue'])
+        finally:
+            it.close()
+
+        it = Iterator(['found', 'preempted'], ['factor'], ['results'], it=range(7),
+                      max_concurrency=3, state_factory=build_sm,
+                      result_key='results', item_result_key='res')
+        with it:
+            Iterator.set_contained_state('SM', build_sm(), loop_outcomes=['continue'])
+        ud = UserData()
+        ud.factor = 2
+
+        assert it.execute(ud) == 'exhausted'
+        assert ud.results == [0, 2, 4, 6, 8, 10, 12]
+
+    def test_reduce(self):
+        """Test folding the results of the items into an accumulator."""
+        for (max_concurrency, ordered) in [(1, True), (3, True), (3, False)]:
+            it = Iterator(['found', 'preempted'], ['factor'], ['total'], it=range(7),
+                          item_result_key='res', max_concurrency=max_concurrency,
+                          ordered=ordered, reduce_cb=lambda acc, res: acc + [res],
+                          accumulator_key='total', initial_value=[])
+            with it:
+                Iterator.set_contained_state('SCALE', Scale(), loop_outcomes=['continue'])
+            ud = UserData()
+            ud.factor = 2
+
+            assert it.execute(ud) == 'exhausted'
+            assert sorted(ud.total) == [0, 2, 4, 6, 8, 10, 12]
+            if ordered:
+                assert ud.total == [0, 2, 4, 6, 8, 10, 12]
+            # Each execution starts from the initial value
+            assert it.execute(ud) == 'exhausted'
+            assert len(ud.total) == 7
+
+    def test_missing_results(self):
+        """Test items that do not write a result."""
+        it = Iterator(['done'], [], ['results', 'total'], it=[1, None, 2],
+                      result_key='results', item_result_key='res',
+                      reduce_cb=lambda acc, res: acc + [res], accumulator_key='total', initial_value=[])
+        with it:
+            Iterator.set_contained_state('DOUBLE', Double(), loop_outcomes=['continue'])
+        ud = UserData()
+
+        assert it.execute(ud) == 'exhausted'
+        assert ud.results == [2, None, 4]
+        assert ud.total == [2, None, 4]
+
+    def test_batches(self):
+        """Test delivering batches of items."""
+        for items in [list(range(10)), (i for i in range(10)), collections.deque(range(10))]:
+            it = Iterator(['done'], [], ['results'], it=items, batch_size=4,
+                          result_key='results', item_result_key='res')
+            with it:
+                Iterator.set_contained_state('SUM', Sum(), loop_outcomes=['continue'])
+            ud = UserData()
+
+            assert it.execute(ud) == 'exhausted'
+            assert ud.results == [6, 22, 17]
+
+    def test_item_errors(self):
+        """Test that errors raised by the items are not taken for exhaustion."""
+        def items():
+            yield [1]
+            raise ValueError()
+
+        it = Iterator(['done'], [], [], it=items)
+        with it:
+            Iterator.set_contained_state('SUM', Sum(), loop_outcomes=['continue'])
+
+        self.assertRaises(ValueError, it.execute, UserData())
+
+    def test_buffer_items(self):
+        """Test iterating over batches of items in a memory-mapped file."""
+        (fd, path) = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(struct.pack('<10d', *range(10)))
+            items = BufferItems.from_file(path, item_size=8, prefetch=4)
+            it = Iterator(['done'], [], ['results'], it=items, batch_size=4,
+                          result_key='results', item_result_key='res')
+            with it:
+                Iterator.set_contained_state('SUM', SumDoubles(), loop_outcomes=['continue'])
+            ud = UserData()
+
+            assert len(items) == 10
+            assert it.execute(ud) == 'exhausted'
+            assert ud.results == [6, 22, 17]
+            items.close()
+        finally:
+            os.remove(path)
+
+
+    def test_buffer_items_array(self):
+        """Test items given as rows of a NumPy array."""
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("NumPy is not installed")
+        waypoints = numpy.arange(12, dtype=numpy.float64).reshape(4, 3)
+
+        items = BufferItems(waypoints, offset=24)
+        assert len(items) == 3
+        assert list(items[0]) == [3.0, 4.0, 5.0]
+        self.assertRaises(ValueError, BufferItems, waypoints, offset=8)
+
+def main():
+    rospy.init_node('iterator_test', log_level=rospy.DEBUG)
+    rostest.rosrun('smach', 'iterator_test', TestIterator)
+
+
+if __name__ == "__main__":
+    main()
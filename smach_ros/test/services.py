@@ -7,7 +7,7 @@ import unittest
 
 import std_srvs.srv as std_srvs
 
-from smach import StateMachine
+from smach import InvalidStateError, StateMachine, UserData
 from smach_ros import ServiceState
 
 
@@ -43,6 +43,28 @@ class TestServices(unittest.TestCase):
 
         assert outcome == 'done'
 
+    def test_service_warm(self):
+        """Test connecting to a service in the background."""
+
+        srv = rospy.Service('/empty_warm', std_srvs.Empty, empty_server)
+
+        state = ServiceState('/empty_warm', std_srvs.Empty)
+        state.warm()
+
+        start_time = rospy.Time.now()
+        while state._proxy is None and rospy.Time.now() - start_time < rospy.Duration(10):
+            rospy.sleep(0.1)
+        assert state._proxy is not None
+
+        assert state.execute(UserData()) == 'succeeded'
+
+
+    def test_service_slots(self):
+        """Test that request and response slots are checked."""
+        self.assertRaises(InvalidStateError, ServiceState, '/empty', std_srvs.Empty,
+                          request_slots=['missing'])
+        self.assertRaises(InvalidStateError, ServiceState, '/empty', std_srvs.Empty,
+                          response_slots=['missing'])
 
 def main():
     rospy.init_node('services_test', log_level=rospy.DEBUG)
@@ -8,8 +8,8 @@ import unittest
 from actionlib import *
 from actionlib.msg import *
 
-from smach import cb_interface, CBInterface, Sequence, State
-from smach_ros import ActionServerWrapper, SimpleActionState
+from smach import cb_interface, CBInterface, Concurrence, InvalidStateError, Sequence, State, UserData
+from smach_ros import ActionServerWrapper, MultiGoalActionState, SimpleActionState
 
 # Static goals
 g1 = TestGoal(1)  # This goal should succeed
@@ -158,6 +158,49 @@ class TestActionlib(unittest.TestCase):
         sq_outcome = sq.execute()
         assert sq_outcome == 'foobar'
 
+    def test_shared_action_client(self):
+        """Test simple action states sharing an action client"""
+        cc = Concurrence(['succeeded', 'aborted', 'preempted'], 'aborted',
+                         outcome_map={'succeeded': {'SUCCEED': 'succeeded', 'ABORT': 'aborted'}})
+
+        with cc:
+            Concurrence.add('SUCCEED', SimpleActionState("reference_action", TestAction, goal=g1))
+            Concurrence.add('ABORT', SimpleActionState("reference_action", TestAction, goal=g2))
+
+        assert cc['SUCCEED']._action_client is cc['ABORT']._action_client
+        # Each state gets the result of its own goal
+        assert cc.execute() == 'succeeded'
+
+    def test_action_client_lazy(self):
+        """Test simple action states connecting on first execution"""
+        state = SimpleActionState("reference_action", TestAction, goal=g1, lazy_connect=True)
+        assert state._action_client is None
+
+        assert state.execute(UserData()) == 'succeeded'
+        assert state._action_client is not None
+        state.close()
+
+    def test_multi_goal_action_state(self):
+        """Test sending several goals at once"""
+        ud = UserData()
+        ud.goals = [g1, g1, g2]
+
+        state = MultiGoalActionState("reference_action", TestAction, statuses_key='statuses')
+        assert state.execute(ud) == 'aborted'
+        assert len(ud.results) == 3
+        assert ud.statuses == [GoalStatus.SUCCEEDED, GoalStatus.SUCCEEDED, GoalStatus.ABORTED]
+
+        state = MultiGoalActionState("reference_action", TestAction, policy=2)
+        assert state.execute(ud) == 'succeeded'
+
+        state = MultiGoalActionState("reference_action", TestAction, policy='any')
+        assert state.execute(ud) == 'succeeded'
+
+        # Policies must require at least one goal
+        for policy in (0, -1, True, False, 'some'):
+            self.assertRaises(InvalidStateError, MultiGoalActionState,
+                              "reference_action", TestAction, policy=policy, lazy_connect=True)
+
     def test_action_server_wrapper(self):
         """Test action server wrapper."""
         sq = Sequence(['succeeded', 'aborted', 'preempted'], 'succeeded')
@@ -3,12 +3,15 @@
 import rospy
 import rostest
 
+import gc
 import unittest
+import weakref
 
 from actionlib import *
 from actionlib.msg import *
 
-from smach import State, StateMachine
+from smach import CBState, CompactUserData, Remapper, State, StateMachine, UserData
+from smach.user_data import Const
 from smach_ros import ConditionState, SimpleActionState
 
 # Static goals
@@ -121,6 +124,177 @@ class TestStateMachine(unittest.TestCase):
         assert sm.userdata.x == 'A'
         assert sm.userdata.y == 'A'
 
+    def test_userdata_snapshot(self):
+        """Test that snapshots of userdata are immutable."""
+        sm = StateMachine(['done'])
+        with sm:
+            StateMachine.add('SETTER', Setter(), {'done': 'done'})
+
+        snapshots = []
+        sm.register_termination_cb(lambda ud, states, outcome: snapshots.append(ud))
+        before = sm.userdata.snapshot()
+
+        outcome = sm.execute()
+
+        assert outcome == 'done'
+        assert 'a' not in before
+        assert snapshots[0].a == 'A'
+        assert sm.userdata.get_version() == snapshots[0].get_version()
+        sm.userdata.a = 'B'
+        assert snapshots[0].a == 'A'
+        self.assertRaises(TypeError, setattr, snapshots[0], 'a', 'C')
+
+    def test_const_inputs(self):
+        """Test read-only views of input-only userdata keys."""
+        class Point(object):
+            def __init__(self):
+                self.x = 0
+
+        ud = UserData()
+        ud.p = Point()
+        remapper = Remapper(ud, ['p'], [])
+        assert remapper.p is remapper.p
+        assert remapper.p.x == 0
+        self.assertRaises(TypeError, setattr, remapper.p, 'x', 1)
+        assert Remapper(ud, ['p'], [], const_inputs=False).p is ud.p
+
+        # The cached view does not keep a replaced value alive
+        old = weakref.ref(ud.p)
+        ud.p = Point()
+        gc.collect()
+        assert old() is None
+        assert remapper.p.x == 0
+
+        # Repeated reads reuse the views of the value and of its fields
+        ud.p.inner = Point()
+        assert remapper.p.inner.x == 0
+        created = []
+        const_init = Const.__init__
+        Const.__init__ = lambda view, obj: created.append(obj) or const_init(view, obj)
+        try:
+            for i in range(1000):
+                assert remapper.p.inner.x == 0
+        finally:
+            Const.__init__ = const_init
+        assert created == []
+
+    def test_chained_userdata(self):
+        """Test reading input keys through chained userdata scopes."""
+        sm = StateMachine(['done'], input_keys=['a'], output_keys=['b'])
+        sm2 = StateMachine(['done'], input_keys=['x'], output_keys=['b'])
+        with sm:
+            StateMachine.add('NEST', sm2, {'done': 'done'}, remapping={'x': 'a'})
+            with sm2:
+                StateMachine.add('GETTER', Getter(), {'done': 'done'}, remapping={'a': 'x'})
+        sm.set_chained_userdata()
+
+        ud = UserData()
+        ud.a = ['A']
+        assert sm.execute(ud) == 'done'
+        assert ud.b is ud.a
+
+        # Values from the previous execution do not shadow new inputs
+        ud.a = ['B']
+        assert sm.execute(ud) == 'done'
+        assert ud.b is ud.a
+
+    def test_chained_userdata_shadowing(self):
+        """Test that writes in a chained scope shadow the enclosing scope."""
+        sm = StateMachine(['done'], input_keys=['a'], output_keys=['b'])
+        sm2 = StateMachine(['done'], input_keys=['a'], output_keys=['b'])
+        sm3 = StateMachine(['done'], input_keys=['a'], output_keys=['b'])
+        with sm:
+            StateMachine.add('NEST', sm2, {'done': 'done'})
+            with sm2:
+                StateMachine.add('GETTER1', Getter(), {'done': 'SETTER'})
+                StateMachine.add('SETTER', Setter(), {'done': 'NEST'})
+                StateMachine.add('NEST', sm3, {'done': 'done'})
+                with sm3:
+                    StateMachine.add('GETTER2', Getter(), {'done': 'done'})
+        sm.set_chained_userdata()
+
+        ud = UserData()
+        ud.a = 'X'
+        assert sm.execute(ud) == 'done'
+        assert ud.b == 'A'
+        assert ud.a == 'X'
+        assert sm2.userdata.a == 'A'
+
+    def test_chained_userdata_epochs(self):
+        """Test that resolved chains are only invalidated along their chain."""
+        top = UserData()
+        top.a = 'A'
+        middle = UserData()
+        middle._chain(top, frozenset(['a']))
+        bottom = UserData()
+        bottom._chain(middle, frozenset(['a']))
+        other = UserData()
+        other._chain(top, frozenset(['a']))
+
+        assert bottom.a == 'A'
+        entry = bottom._resolved_chains['a']
+
+        # Writes in another chain keep the resolution
+        other.a = 'X'
+        assert bottom.a == 'A'
+        assert bottom._resolved_chains['a'] is entry
+
+        # Writes along the chain shadow the enclosing scope
+        middle.a = 'B'
+        assert bottom.a == 'B'
+        assert top.a == 'A'
+
+    def test_compact_userdata(self):
+        """Test containers with compact userdata storage."""
+        sm = StateMachine(['done'], input_keys=['a'], output_keys=['b'])
+        sm2 = StateMachine(['done'], input_keys=['x'], output_keys=['b'])
+        with sm:
+            StateMachine.add('NEST', sm2, {'done': 'done'}, remapping={'x': 'a'})
+            with sm2:
+                StateMachine.add('GETTER', Getter(), {'done': 'done'}, remapping={'a': 'x'})
+        sm.set_compact_userdata()
+
+        assert isinstance(sm2.userdata, CompactUserData)
+        assert sm2.userdata._layout.keys == ('b', 'x')
+
+        ud = UserData()
+        ud.a = 'A'
+        assert sm.execute(ud) == 'done'
+        assert ud.b == 'A'
+        assert sm2.userdata.get_changes(0)[1] == {'b': 'A', 'x': 'A'}
+
+        # Undeclared keys are stored as well
+        sm2.userdata.c = 'C'
+        assert 'c' in sm2.userdata
+        assert sm2.userdata.c == 'C'
+
+    def test_compiled_dispatch(self):
+        """Test that the compiled and interpreted paths resolve alike."""
+        for compiled in (False, True):
+            sm = StateMachine(['done', 'aborted'], compiled=compiled)
+            with sm:
+                StateMachine.add('SETTER', Setter(), {'done': 'GETTER'})
+                StateMachine.add('GETTER', Getter(), {'done': 'FALLTHROUGH'})
+                StateMachine.add('FALLTHROUGH', CBState(lambda ud: 'aborted', outcomes=['aborted']))
+
+            assert sm.execute() == 'aborted'
+            assert sm.userdata.b == 'A'
+            # Executing again reuses the dispatch table
+            assert sm.execute() == 'aborted'
+
+    def test_late_key_registration(self):
+        """Test states registering keys after their container was closed."""
+        for compiled in (False, True):
+            setter = CBState(lambda ud: setattr(ud, 'late', 'L') or 'done', outcomes=['done'])
+            sm = StateMachine(['done'], compiled=compiled)
+            with sm:
+                StateMachine.add('LATE', setter)
+
+            setter.register_output_keys(['late'])
+
+            assert sm.execute() == 'done'
+            assert sm.userdata.late == 'L'
+
     def test_sequence(self):
         """Test adding a sequence of states."""
         sm = StateMachine(['succeeded', 'aborted', 'preempted', 'done'])